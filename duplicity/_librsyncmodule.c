@@ -34,6 +34,13 @@
 #ifndef Py_TYPE
     #define Py_TYPE(ob) (((PyObject*)(ob))->ob_type)
 #endif
+#if PY_VERSION_HEX < 0x02050000 && !defined(PY_SSIZE_T_MIN)
+    typedef int Py_ssize_t;
+#endif
+/* Buffers can be locked while the GIL is released from Python 2.6 on */
+#if PY_VERSION_HEX >= 0x02060000
+    #define HAVE_PY_BUFFER
+#endif
 
 static PyObject *librsyncError;
 
@@ -46,6 +53,98 @@ _librsync_seterror(rs_result result, char *location)
   PyErr_SetString(librsyncError, error_string);
 }
 
+/* Run one cycle of job.  Take a chunk of input in a string or other
+   buffer, and return a triple (done, bytes_used, output), where done
+   is true iff there is no more output coming and bytes_used is the
+   number of bytes of the input processed.  If a writable buffer is
+   given as second argument, as much output as fits is written to it
+   and output is the number of bytes written.  Otherwise output is a
+   string of up to RS_JOB_BLOCKSIZE bytes.
+
+   The GIL is released while librsync works, so jobs in different
+   threads run at the same time.  busy keeps other threads from
+   entering the same job meanwhile.
+*/
+static PyObject *
+_librsync_cycle(rs_job_t *job, int *busy, PyObject *args, char *location)
+{
+  PyObject *outobj = NULL, *cycle_result = NULL;
+  char outstring[RS_JOB_BLOCKSIZE];
+  size_t inbuf_length, outbuf_length;
+  rs_buffers_t buf;
+  rs_result result;
+#ifdef HAVE_PY_BUFFER
+  Py_buffer inview, outview;
+
+  if (!PyArg_ParseTuple(args, "s*|O:cycle", &inview, &outobj))
+    return NULL;
+  buf.next_in = inview.buf;
+  buf.avail_in = (size_t)inview.len;
+  if (outobj) {
+    if (PyObject_GetBuffer(outobj, &outview, PyBUF_WRITABLE) < 0) {
+      PyBuffer_Release(&inview);
+      return NULL;
+    }
+    buf.next_out = outview.buf;
+    buf.avail_out = (size_t)outview.len;
+  }
+#else
+  char *inbuf;
+  int inbuf_int_length;
+  void *outptr;
+  Py_ssize_t outptr_length;
+
+  if (!PyArg_ParseTuple(args, "s#|O:cycle", &inbuf, &inbuf_int_length,
+                        &outobj))
+    return NULL;
+  buf.next_in = inbuf;
+  buf.avail_in = (size_t)inbuf_int_length;
+  if (outobj) {
+    if (PyObject_AsWriteBuffer(outobj, &outptr, &outptr_length) < 0)
+      return NULL;
+    buf.next_out = outptr;
+    buf.avail_out = (size_t)outptr_length;
+  }
+#endif
+  if (!outobj) {
+    buf.next_out = outstring;
+    buf.avail_out = (size_t)RS_JOB_BLOCKSIZE;
+  }
+  inbuf_length = buf.avail_in;
+  outbuf_length = buf.avail_out;
+  buf.eof_in = (inbuf_length == 0);
+
+  if (*busy) {
+    PyErr_SetString(librsyncError, "job already running in another thread");
+    goto release;
+  }
+  *busy = 1;
+  Py_BEGIN_ALLOW_THREADS
+  result = rs_job_iter(job, &buf);
+  Py_END_ALLOW_THREADS
+  *busy = 0;
+
+  if (result != RS_DONE && result != RS_BLOCKED)
+    _librsync_seterror(result, location);
+  else if (outobj)
+    cycle_result = Py_BuildValue("(ill)", (result == RS_DONE),
+                                 (long)(inbuf_length - buf.avail_in),
+                                 (long)(outbuf_length - buf.avail_out));
+  else
+    cycle_result = Py_BuildValue("(ils#)", (result == RS_DONE),
+                                 (long)(inbuf_length - buf.avail_in),
+                                 outstring,
+                                 (int)(outbuf_length - buf.avail_out));
+
+ release:
+#ifdef HAVE_PY_BUFFER
+  if (outobj)
+    PyBuffer_Release(&outview);
+  PyBuffer_Release(&inview);
+#endif
+  return cycle_result;
+}
+
 
 /* --------------- SigMaker Object for incremental signatures */
 static PyTypeObject _librsync_SigMakerType;
@@ -53,6 +152,7 @@ static PyTypeObject _librsync_SigMakerType;
 typedef struct {
   PyObject_HEAD
   rs_job_t *sig_job;
+  int busy;
 } _librsync_SigMakerObject;
 
 static PyObject*
@@ -69,6 +169,7 @@ _librsync_new_sigmaker(PyObject* self, PyObject* args)
 
   sm->sig_job = rs_sig_begin((size_t)blocklen,
                              (size_t)RS_DEFAULT_STRONG_LEN);
+  sm->busy = 0;
   return (PyObject*)sm;
 }
 
@@ -79,38 +180,13 @@ _librsync_sigmaker_dealloc(PyObject* self)
   PyObject_Del(self);
 }
 
-/* Take an input string, and generate a signature from it.  The output
-   will be a triple (done, bytes_used, signature_string), where done
-   is true iff there is no more data coming and bytes_used is the
-   number of bytes of the input string processed.
+/* Take a chunk of the input file, and generate a signature from it.
+   See _librsync_cycle for the arguments and result.
 */
 static PyObject *
 _librsync_sigmaker_cycle(_librsync_SigMakerObject *self, PyObject *args)
 {
-  char *inbuf, outbuf[RS_JOB_BLOCKSIZE];
-  int inbuf_length;
-  rs_buffers_t buf;
-  rs_result result;
-
-  if (!PyArg_ParseTuple(args, "s#:cycle", &inbuf, &inbuf_length))
-    return NULL;
-
-  buf.next_in = inbuf;
-  buf.avail_in = (size_t)inbuf_length;
-  buf.next_out = outbuf;
-  buf.avail_out = (size_t)RS_JOB_BLOCKSIZE;
-  buf.eof_in = (inbuf_length == 0);
-
-  result = rs_job_iter(self->sig_job, &buf);
-
-  if (result != RS_DONE && result != RS_BLOCKED) {
-    _librsync_seterror(result, "signature cycle");
-    return NULL;
-  }
-
-  return Py_BuildValue("(ils#)", (result == RS_DONE),
-                       (long)inbuf_length - (long)buf.avail_in,
-                       outbuf, RS_JOB_BLOCKSIZE - (long)buf.avail_out);
+  return _librsync_cycle(self->sig_job, &self->busy, args, "signature cycle");
 }
 
 static PyMethodDef _librsync_sigmaker_methods[] = {
@@ -158,6 +234,7 @@ typedef struct {
   PyObject_HEAD
   rs_job_t *delta_job;
   rs_signature_t *sig_ptr;
+  int busy;
 } _librsync_DeltaMakerObject;
 
 /* Call with the entire signature loaded into one big string */
@@ -175,10 +252,8 @@ _librsync_new_deltamaker(PyObject* self, PyObject* args)
   if (!PyArg_ParseTuple(args,"s#:new_deltamaker", &sig_string, &sig_length))
     return NULL;
 
-  dm = PyObject_New(_librsync_DeltaMakerObject, &_librsync_DeltaMakerType);
-  if (dm == NULL) return NULL;
-
-  /* Put signature at sig_ptr and build hash */
+  /* Put signature at sig_ptr and build hash, without the GIL */
+  Py_BEGIN_ALLOW_THREADS
   sig_loader = rs_loadsig_begin(&sig_ptr);
   buf.next_in = sig_string;
   buf.avail_in = (size_t)sig_length;
@@ -187,17 +262,22 @@ _librsync_new_deltamaker(PyObject* self, PyObject* args)
   buf.eof_in = 1;
   result = rs_job_iter(sig_loader, &buf);
   rs_job_free(sig_loader);
+  if (result == RS_DONE)
+    result = rs_build_hash_table(sig_ptr);
+  Py_END_ALLOW_THREADS
   if (result != RS_DONE) {
     _librsync_seterror(result, "delta rs_signature_t builder");
     return NULL;
   }
-  if ((result = rs_build_hash_table(sig_ptr)) != RS_DONE) {
-    _librsync_seterror(result, "delta rs_build_hash_table");
+
+  dm = PyObject_New(_librsync_DeltaMakerObject, &_librsync_DeltaMakerType);
+  if (dm == NULL) {
+    rs_free_sumset(sig_ptr);
     return NULL;
   }
-
   dm->sig_ptr = sig_ptr;
   dm->delta_job = rs_delta_begin(sig_ptr);
+  dm->busy = 0;
   return (PyObject*)dm;
 }
 
@@ -212,37 +292,13 @@ _librsync_deltamaker_dealloc(PyObject* self)
   PyObject_Del(self);
 }
 
-/* Take a chunk of the new file in an input string, and return a
-   triple (done bytes_used, delta_string), where done is true iff no
-   more data is coming and bytes_used is the number of bytes of the
-   input string processed.
+/* Take a chunk of the new file, and return the delta of it.  See
+   _librsync_cycle for the arguments and result.
 */
 static PyObject *
 _librsync_deltamaker_cycle(_librsync_DeltaMakerObject *self, PyObject *args)
 {
-  char *inbuf, outbuf[RS_JOB_BLOCKSIZE];
-  int inbuf_length;
-  rs_buffers_t buf;
-  rs_result result;
-
-  if (!PyArg_ParseTuple(args, "s#:cycle", &inbuf, &inbuf_length))
-    return NULL;
-
-  buf.next_in = inbuf;
-  buf.avail_in = (size_t)inbuf_length;
-  buf.next_out = outbuf;
-  buf.avail_out = (size_t)RS_JOB_BLOCKSIZE;
-  buf.eof_in = (inbuf_length == 0);
-
-  result = rs_job_iter(self->delta_job, &buf);
-  if (result != RS_DONE && result != RS_BLOCKED) {
-    _librsync_seterror(result, "delta cycle");
-    return NULL;
-  }
-
-  return Py_BuildValue("(ils#)", (result == RS_DONE),
-                       (long)inbuf_length - (long)buf.avail_in,
-                       outbuf, RS_JOB_BLOCKSIZE - (long)buf.avail_out);
+  return _librsync_cycle(self->delta_job, &self->busy, args, "delta cycle");
 }
 
 static PyMethodDef _librsync_deltamaker_methods[] = {
@@ -291,6 +347,7 @@ typedef struct {
   PyObject_HEAD
   rs_job_t *patch_job;
   PyObject *basis_file;
+  int busy;
 } _librsync_PatchMakerObject;
 
 /* Call with the basis file */
@@ -317,6 +374,7 @@ _librsync_new_patchmaker(PyObject* self, PyObject* args)
   pm->basis_file = python_file;
   cfile = fdopen(fd, "rb");
   pm->patch_job = rs_patch_begin(rs_file_copy_cb, cfile);
+  pm->busy = 0;
 
   return (PyObject*)pm;
 }
@@ -330,37 +388,15 @@ _librsync_patchmaker_dealloc(PyObject* self)
   PyObject_Del(self);
 }
 
-/* Take a chunk of the delta file in an input string, and return a
-   triple (done, bytes_used, patched_string), where done is true iff
-   there is no more data coming out and bytes_used is the number of
-   bytes of the input string processed.
+/* Take a chunk of the delta file, and return the patched data.  See
+   _librsync_cycle for the arguments and result.  The basis file is
+   read by librsync without the GIL, so it must not be used by other
+   threads meanwhile.
 */
 static PyObject *
 _librsync_patchmaker_cycle(_librsync_PatchMakerObject *self, PyObject *args)
 {
-  char *inbuf, outbuf[RS_JOB_BLOCKSIZE];
-  int inbuf_length;
-  rs_buffers_t buf;
-  rs_result result;
-
-  if (!PyArg_ParseTuple(args, "s#:cycle", &inbuf, &inbuf_length))
-    return NULL;
-
-  buf.next_in = inbuf;
-  buf.avail_in = (size_t)inbuf_length;
-  buf.next_out = outbuf;
-  buf.avail_out = (size_t)RS_JOB_BLOCKSIZE;
-  buf.eof_in = (inbuf_length == 0);
-
-  result = rs_job_iter(self->patch_job, &buf);
-  if (result != RS_DONE && result != RS_BLOCKED) {
-    _librsync_seterror(result, "patch cycle");
-    return NULL;
-  }
-
-  return Py_BuildValue("(ils#)", (result == RS_DONE),
-                       (long)inbuf_length - (long)buf.avail_in,
-                       outbuf, RS_JOB_BLOCKSIZE - (long)buf.avail_out);
+  return _librsync_cycle(self->patch_job, &self->busy, args, "patch cycle");
 }
 
 static PyMethodDef _librsync_patchmaker_methods[] = {
@@ -429,6 +465,7 @@ moduleinit(void)
 
   Py_TYPE(&_librsync_SigMakerType) = &PyType_Type;
   Py_TYPE(&_librsync_DeltaMakerType) = &PyType_Type;
+  Py_TYPE(&_librsync_PatchMakerType) = &PyType_Type;
 
   MOD_DEF(m, "_librsync", "", _librsyncMethods)
   if (m == NULL)
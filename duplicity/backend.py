@@ -379,8 +379,14 @@ class Backend:
     Optional:
 
       - move
+
+    Sub-classes whose put/query_info may safely be called from several
+    threads at once (for example because every call runs in its own
+    process or works on the local filesystem) should set
+    concurrency_safe to True.  Otherwise uploads are serialized.
     """
-    
+    concurrency_safe = False
+
     def __init__(self, parsed_url):
         self.parsed_url = parsed_url
 
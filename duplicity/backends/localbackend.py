@@ -37,6 +37,9 @@ class LocalBackend(duplicity.backend.Backend):
     gotten with extra slash (file:///usr/local).
 
     """
+    # transfers work directly on the local filesystem
+    concurrency_safe = True
+
     def __init__(self, parsed_url):
         duplicity.backend.Backend.__init__(self, parsed_url)
         # The URL form "file:MyFile" is not a valid duplicity target.
@@ -34,6 +34,9 @@ class RsyncBackend(duplicity.backend.Backend):
         Copyright 2010 by Edgar Soldin <edgar.soldin@web.de>
 
     """
+    # every transfer runs in its own rsync process
+    concurrency_safe = True
+
     def __init__(self, parsed_url):
         """rsyncBackend initializer"""
         duplicity.backend.Backend.__init__(self, parsed_url)
@@ -0,0 +1,216 @@
+# -*- Mode:Python; indent-tabs-mode:nil; tab-width:4 -*-
+#
+# This file is part of duplicity.
+#
+# Duplicity is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 2 of the License, or (at your
+# option) any later version.
+#
+# Duplicity is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with duplicity; if not, write to the Free Software Foundation,
+# Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+
+"""
+Incremental backups driven by a list of changed files
+
+Normally an incremental backup walks the whole source directory and
+compares every file with the signatures of the chain.  When the files
+changed since the last backup are known, for instance from inotify or
+a snapshot diff, only those need to be looked at: the others are
+taken from the signatures, as if they had been found unchanged.
+
+The list must name every file created, changed or deleted since the
+last backup; files missing from it are assumed not to have changed.
+"""
+
+import itertools
+import os
+
+from duplicity import log
+from duplicity import robust
+from duplicity import util
+
+
+class ChangeListError(Exception):
+    """
+    Exception raised for a bad list of changed files
+    """
+    pass
+
+
+def read_changed(changed_fp, select):
+    """
+    Return sorted list of the indicies of the files in changed_fp
+
+    Lines are separated like in filelists and must name files under
+    the root of select.  The directories above the changed files are
+    added to the list, so their attributes are checked too.
+    """
+    prefix = select.prefix.rstrip("/")
+    changed = {(): None}
+    for line in select.filelist_read_lines(changed_fp):
+        if not line:
+            continue
+        if line != prefix and not line.startswith(prefix + "/"):
+            raise ChangeListError(_("Changed file '%s' is not in %s") %
+                                  (line, select.prefix))
+        index = tuple(filter(lambda x: x, line[len(prefix):].split("/")))
+        while index not in changed:
+            changed[index] = None
+            index = index[:-1]
+    changed = changed.keys()
+    changed.sort()
+    return changed
+
+
+def get_path_iters(select, sig_iter, changed):
+    """
+    Return (path_iter, sig_iter) to pass to diffdir.DirDelta
+
+    sig_iter is the combined signature path iterator of the chain.  It
+    is read by both returned iterators, which are meant to be read in
+    step, as diffdir.get_delta_iter does.
+    """
+    sig_iter1, sig_iter2 = itertools.tee(sig_iter)
+    def sig_gen():
+        for sig_path in sig_iter2:
+            yield sig_path
+    return ChangedPathIter(select, sig_iter1, changed), sig_gen()
+
+
+def ChangedPathIter(select, sig_iter, changed):
+    """
+    Iterate the source paths, looking only at the changed ones
+
+    Paths in the sorted list of indicies changed (see read_changed)
+    are looked up on disk and run through select.  New directories are
+    walked like select would.  Other paths are yielded from sig_iter,
+    so diffdir finds them unchanged.
+
+    Directories select would only scan (val 2) are held back until
+    something under them is yielded, like select.Iterate does.
+    """
+    delayed_path_stack = []
+    for path, delay in changed_paths(select, sig_iter, changed):
+        while delayed_path_stack:
+            top = delayed_path_stack[-1].index
+            if path.index[:len(top)] == top:
+                break
+            delayed_path_stack.pop() # nothing selected under it
+        if delay:
+            delayed_path_stack.append(path)
+            continue
+        for delayed_path in delayed_path_stack:
+            yield delayed_path
+        del delayed_path_stack[:]
+        yield path
+
+
+def changed_paths(select, sig_iter, changed):
+    """
+    Iterate (path, delay) pairs for ChangedPathIter
+
+    delay is true for directories that select would only scan.
+
+    Signature paths must be read before sig_iter moves past them, so
+    it is never read further than the index about to be yielded.
+    """
+    def next_sig():
+        for sig_path in sig_iter:
+            return sig_path
+        return None
+
+    def within(index, top):
+        return top is not None and index[:len(top)] == top
+
+    sig_path = next_sig()
+    skip = None # index of subtree that is not taken from the signatures
+    for index in changed:
+        while sig_path and sig_path.index < index:
+            if sig_path.type and not within(sig_path.index, skip):
+                yield (sig_path, 0)
+            sig_path = next_sig()
+        if within(index, skip):
+            continue
+        if sig_path and sig_path.index == index and sig_path.type:
+            old_path = sig_path
+        else:
+            old_path = None
+
+        new_path, val = get_path(select, index)
+        if new_path and new_path.isdir() and not (old_path and old_path.isdir()):
+            # new directory, nothing under it is in the signatures
+            for path in walk(select, new_path, val):
+                yield (path, 0)
+            skip = index
+        elif new_path:
+            yield (new_path, val == 2)
+            if not new_path.isdir():
+                skip = index # was a directory maybe, nothing is under it now
+        else:
+            skip = index # gone or excluded, and so is everything under it
+
+        if sig_path and sig_path.index == index:
+            sig_path = next_sig()
+
+    while sig_path:
+        if sig_path.type and not within(sig_path.index, skip):
+            yield (sig_path, 0)
+        sig_path = next_sig()
+
+
+def get_path(select, index):
+    """
+    Return (Path, val) if the file at index exists and is selected
+
+    val is what select.Select returns for it: directories which would
+    only be scanned (val 2) are returned too, see walk.  If the file
+    is missing or not selected, (None, None) is returned.
+    """
+    def error_handler(exc, index):
+        log.Warn(_("Error initializing file %s") % os.path.join(select.prefix, *index),
+                 log.WarningCode.cannot_iterate,
+                 util.escape(os.path.join(select.prefix, *index)))
+        return None
+
+    new_path = robust.check_common_error(error_handler,
+                                         select.rootpath.new_index, (index,))
+    if not new_path or not new_path.type:
+        return (None, None)
+    if new_path.type in ["reg", "dir"] and not os.access(new_path.name, os.R_OK):
+        log.Warn(_("Error accessing possibly locked file %s") % new_path.name,
+                 log.WarningCode.cannot_read,
+                 util.escape(new_path.name))
+        return (None, None)
+    if index == ():
+        return (new_path, 1) # the root is always selected
+    val = select.Select(new_path)
+    if val == 1 or (val == 2 and new_path.isdir()):
+        return (new_path, val)
+    return (None, None)
+
+
+def walk(select, path, val):
+    """
+    Iterate path and the selected paths under it, like select would
+
+    path and val come from get_path.  If select would only scan path
+    (val 2), it is only yielded if something under it is.
+    """
+    path_iter = select.Iterate(path)
+    path_iter.next() # path itself
+    if val == 2:
+        for first in path_iter:
+            yield path
+            yield first
+            break
+    else:
+        yield path
+    for subpath in path_iter:
+        yield subpath
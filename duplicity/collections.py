@@ -306,7 +306,7 @@ class BackupChain:
         else:
             if (self.incset_list
                 and incset.start_time == self.incset_list[-1].start_time
-                and incset.end_time > self.incset_list[-1]):
+                and incset.end_time > self.incset_list[-1].end_time):
                 log.Info(_("Preferring Backupset over previous one!"))
                 self.incset_list[-1] = incset
             else:
@@ -816,6 +816,17 @@ class CollectionsStatus:
         map(add_to_sets, filename_list)
         sets, incomplete_sets = self.get_sorted_sets(sets)
 
+        # A set merging incremental sets (see merge-incrementals) starts
+        # with the first of them.  Of the sets starting at the same time,
+        # only the one ending last is used, so the old sets left behind
+        # by an interrupted merge are orphaned whatever the listing order.
+        longest_incs = {}
+        for set in sets:
+            if set.type == "inc":
+                longest = longest_incs.get(set.start_time)
+                if not longest or set.end_time > longest.end_time:
+                    longest_incs[set.start_time] = set
+
         chains, orphaned_sets = [], []
         def add_to_chains(set):
             """
@@ -826,6 +837,10 @@ class CollectionsStatus:
                 new_chain.set_full(set)
                 chains.append(new_chain)
                 log.Debug(_("Found backup chain %s") % (new_chain.short_desc()))
+            elif longest_incs[set.start_time] is not set:
+                log.Debug(_("Found orphaned set %s, superseded by a longer set") %
+                          (set.get_timestr(),))
+                orphaned_sets.append(set)
             else:
                 assert set.type == "inc"
                 for chain in chains:
@@ -891,9 +906,12 @@ class CollectionsStatus:
                 elif pr.type == "new-sig":
                     new_sig_filenames.append(filename)
 
-        # compare by file time
+        # compare by file time, the one ending last first of those starting
+        # at the same time, like get_backup_chains prefers it
         def by_start_time(a, b):
-            return int(file_naming.parse(a).start_time) - int(file_naming.parse(b).start_time)
+            pra, prb = file_naming.parse(a), file_naming.parse(b)
+            return (cmp(int(pra.start_time), int(prb.start_time)) or
+                    cmp(int(prb.end_time), int(pra.end_time)))
 
         # Try adding new signatures to existing chains
         orphaned_filenames = []
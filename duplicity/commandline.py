@@ -50,16 +50,20 @@ list_current = None         # Will be set to true if list-current command given
 collection_status = None    # Will be set to true if collection-status command given
 cleanup = None              # Set to true if cleanup command given
 verify = None               # Set to true if verify command given
+synthetic_full = None       # Set to true if synthetic-full command given
+merge_incrementals = None   # Set to true if merge-incrementals command given
 
 commands = ["cleanup",
             "collection-status",
             "full",
             "incremental",
             "list-current-files",
+            "merge-incrementals",
             "remove-older-than",
             "remove-all-but-n-full",
             "remove-all-inc-of-but-n-full",
             "restore",
+            "synthetic-full",
             "verify",
             ]
 
@@ -201,6 +205,7 @@ def parse_cmdline_options(arglist):
     """Parse argument list"""
     global select_opts, select_files, full_backup
     global list_current, collection_status, cleanup, remove_time, verify
+    global synthetic_full, merge_incrementals
 
     def use_gio(*args):
         try:
@@ -257,6 +262,16 @@ def parse_cmdline_options(arglist):
     parser.add_option("--asynchronous-upload", action="store_const", const=1,
                       dest="async_concurrency")
 
+    # --asynchronous-upload-concurrency <number>
+    # Number of volumes that may be uploaded at the same time.
+    parser.add_option("--asynchronous-upload-concurrency", type="int", metavar=_("number"),
+                      dest="async_concurrency")
+
+    # --changed-files <filename>
+    # List of changed files to look at instead of walking the source
+    # in incremental backups.
+    parser.add_option("--changed-files", type="file", metavar=_("filename"))
+
     # config dir for future use
     parser.add_option("--config-dir", type="file", metavar=_("path"),
                       help=optparse.SUPPRESS_HELP)
@@ -265,6 +280,16 @@ def parse_cmdline_options(arglist):
     parser.add_option("--current-time", type="int",
                       dest="current_time", help=optparse.SUPPRESS_HELP)
 
+    # store chunks of files only once per backup chain
+    parser.add_option("--dedup", action="store_true")
+
+    # --delta-readahead <number>
+    # Number of changed files whose deltas are computed ahead in parallel.
+    parser.add_option("--delta-readahead", type="int", metavar=_("number"))
+
+    # back up moved files as deltas against where they were moved from
+    parser.add_option("--detect-renames", action="store_true")
+
     # Don't actually do anything, but still report what would be done
     parser.add_option("--dry-run", action="store_true")
 
@@ -350,6 +375,9 @@ def parse_cmdline_options(arglist):
 
     parser.add_option("--gpg-options", action="extend", metavar=_("options"))
 
+    # Record SHA256 hashes of volumes as well as SHA1
+    parser.add_option("--hash-sha256", action="store_true")
+
     # TRANSL: Used in usage help to represent an ID for a hidden GnuPG key. Example:
     # --hidden-encrypt-key <gpg_key_id>
     parser.add_option("--hidden-encrypt-key", type="string", metavar=_("gpg-key-id"),
@@ -431,6 +459,10 @@ def parse_cmdline_options(arglist):
                       callback=lambda o, s, v, p: (setattr(p.values, o.dest, True),
                                                    old_fn_deprecation(s)))
 
+    # --parallel-volumes <number>
+    # Number of volumes to compress/encrypt in parallel.
+    parser.add_option("--parallel-volumes", type="int", metavar=_("number"))
+
     # option to trigger Pydev debugger
     parser.add_option("--pydevd", action="store_true")
 
@@ -438,6 +470,14 @@ def parse_cmdline_options(arglist):
     parser.add_option("--rename", type="file", action="callback", nargs=2,
                       callback=add_rename)
 
+    # --restore-prefetch <number>
+    # Number of volumes to download ahead during restore.
+    parser.add_option("--restore-prefetch", type="int", metavar=_("number"))
+
+    # --restore-writers <number>
+    # Number of threads writing restored files.
+    parser.add_option("--restore-writers", type="int", metavar=_("number"))
+
     # Restores will try to bring back the state as of the following time.
     # If it is None, default to current time.
     # TRANSL: Used in usage help to represent a time spec for a previous
@@ -475,6 +515,10 @@ def parse_cmdline_options(arglist):
     if sys.version_info[:2] >= (2,6):
         parser.add_option("--s3-use-multiprocessing", action="store_true")
 
+    # --scan-workers <number>
+    # Number of threads scanning directories ahead of selection.
+    parser.add_option("--scan-workers", type="int", metavar=_("number"))
+
     # scp command to use (ssh pexpect backend)
     parser.add_option("--scp-command", metavar=_("command"))
 
@@ -493,6 +537,9 @@ def parse_cmdline_options(arglist):
                       dest="", action="callback",
                       callback=lambda o, s, v, p: set_sign_key(v))
 
+    # keep an index of the current signature chain in the archive dir
+    parser.add_option("--signature-index", action="store_true")
+
     # default to batch mode using public-key encryption
     parser.add_option("--ssh-askpass", action="store_true")
 
@@ -507,6 +554,12 @@ def parse_cmdline_options(arglist):
 
     parser.add_option("--ssl-no-check-certificate", action="store_true")
 
+    # keep stat data of the last backup to find unchanged files
+    parser.add_option("--stat-cache", action="store_true")
+
+    # restore to a tar stream instead of a directory
+    parser.add_option("--tar-output", action="store_true")
+
     # Working directory for the tempfile module. Defaults to /tmp on most systems.
     parser.add_option("--tempdir", dest="temproot", type="file", metavar=_("path"))
 
@@ -557,6 +610,12 @@ def parse_cmdline_options(arglist):
 
     socket.setdefaulttimeout(globals.timeout)
 
+    if globals.hash_sha256 and not gpg.sha256:
+        command_line_error("--hash-sha256 needs Python 2.5 or later")
+
+    if globals.async_concurrency < 0:
+        command_line_error("--asynchronous-upload-concurrency must be 0 or more")
+
     # expect no cmd and two positional args
     cmd = ""
     num_expect = 2
@@ -590,6 +649,9 @@ def parse_cmdline_options(arglist):
     elif cmd == "list-current-files":
         list_current = True
         num_expect = 1
+    elif cmd == "merge-incrementals":
+        merge_incrementals = True
+        num_expect = 1
     elif cmd == "remove-older-than":
         try:
             arg = args.pop(0)
@@ -610,6 +672,9 @@ def parse_cmdline_options(arglist):
         if not globals.keep_chains > 0:
             command_line_error(cmd + " count must be > 0")
         num_expect = 1
+    elif cmd == "synthetic-full":
+        synthetic_full = True
+        num_expect = 1
     elif cmd == "verify":
         verify = True
 
@@ -794,9 +859,11 @@ def usage():
   duplicity collection-status [%(options)s] %(target_url)s
   duplicity list-current-files [%(options)s] %(target_url)s
   duplicity cleanup [%(options)s] %(target_url)s
+  duplicity merge-incrementals [%(options)s] %(target_url)s
   duplicity remove-older-than %(time)s [%(options)s] %(target_url)s
   duplicity remove-all-but-n-full %(count)s [%(options)s] %(target_url)s
   duplicity remove-all-inc-of-but-n-full %(count)s [%(options)s] %(target_url)s
+  duplicity synthetic-full [%(options)s] %(target_url)s
 
 """ % dict
 
@@ -829,10 +896,12 @@ def usage():
   full <%(source_dir)s> <%(target_url)s>
   incr <%(source_dir)s> <%(target_url)s>
   list-current-files <%(target_url)s>
+  merge-incrementals <%(target_url)s>
   restore <%(target_url)s> <%(source_dir)s>
   remove-older-than <%(time)s> <%(target_url)s>
   remove-all-but-n-full <%(count)s> <%(target_url)s>
   remove-all-inc-of-but-n-full <%(count)s> <%(target_url)s>
+  synthetic-full <%(target_url)s>
   verify <%(target_url)s> <%(source_dir)s>""" % dict
 
     return msg
@@ -913,6 +982,9 @@ def set_backend(arg1, arg2):
 
 def process_local_dir(action, local_pathname):
     """Check local directory, set globals.local_path"""
+    if action == "restore" and globals.tar_output and local_pathname == "-":
+        globals.local_path = None # standard output
+        return
     local_path = path.Path(path.Path(local_pathname).get_canonical())
     if action == "restore":
         if (local_path.exists() and not local_path.isemptydir()) and not globals.force:
@@ -945,9 +1017,11 @@ def check_consistency(action):
                 n+=1
         assert n <= 1, "Invalid syntax, two conflicting modes specified"
     if action in ["list-current", "collection-status",
-                  "cleanup", "remove-old", "remove-all-but-n-full", "remove-all-inc-of-but-n-full"]:
+                  "cleanup", "remove-old", "remove-all-but-n-full", "remove-all-inc-of-but-n-full",
+                  "merge-incrementals", "synthetic-full"]:
         assert_only_one([list_current, collection_status, cleanup,
-                         globals.remove_time is not None])
+                         globals.remove_time is not None, merge_incrementals,
+                         synthetic_full])
     elif action == "restore" or action == "verify":
         if full_backup:
             command_line_error("--full option cannot be used when "
@@ -955,6 +1029,9 @@ def check_consistency(action):
         elif globals.incremental:
             command_line_error("--incremental option cannot be used when "
                                "restoring or verifying")
+        if globals.tar_output and action == "verify":
+            command_line_error("--tar-output option cannot be used when "
+                               "verifying")
         if select_opts and action == "restore":
             log.Warn( _("Command line warning: %s") % _("Selection options --exclude/--include\n"
                                                         "currently work only when backing up,"
@@ -967,13 +1044,17 @@ def check_consistency(action):
         if globals.restore_dir:
             command_line_error("restore option incompatible with %s backup"
                                % (action,))
+        if globals.tar_output:
+            command_line_error("--tar-output option cannot be used when "
+                               "backing up")
 
 
 def ProcessCommandLine(cmdline_list):
     """Process command line, set globals, return action
 
     action will be "list-current", "collection-status", "cleanup",
-    "remove-old", "restore", "verify", "full", or "inc".
+    "remove-old", "merge-incrementals", "synthetic-full", "restore",
+    "verify", "full", or "inc".
 
     """
     globals.gpg_profile = gpg.GPGProfile()
@@ -1000,6 +1081,10 @@ def ProcessCommandLine(cmdline_list):
             action = "remove-all-but-n-full"
         elif globals.remove_all_inc_of_but_n_full_mode:
             action = "remove-all-inc-of-but-n-full"
+        elif merge_incrementals:
+            action = "merge-incrementals"
+        elif synthetic_full:
+            action = "synthetic-full"
         else:
             command_line_error("Too few arguments")
         globals.backend = backend.get_backend(args[0])
@@ -0,0 +1,405 @@
+# -*- Mode:Python; indent-tabs-mode:nil; tab-width:4 -*-
+#
+# This file is part of duplicity.
+#
+# Duplicity is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 2 of the License, or (at your
+# option) any later version.
+#
+# Duplicity is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with duplicity; if not, write to the Free Software Foundation,
+# Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+
+"""
+Deduplication of file contents across the files of a backup chain
+
+Regular files stored whole ("snapshot" entries) can instead be stored
+as "chunked" entries.  The file is cut into chunks at places which
+depend only on the bytes around them, so the same data gets the same
+chunks even when shifted within a file or found in another file.  A
+chunk already stored in the chain is replaced by a reference to the
+file it was first stored with: its index, the number of the backup
+set in the chain (0 for the full backup), and the offset of the chunk
+in the contents of that file at that time.
+
+The chunks stored so far are kept in a chunk index in the archive
+dir, so later incremental backups of the chain can refer to them.
+References never go to another chain, so chains can still be deleted
+on their own.
+"""
+
+import re, struct, marshal, tempfile, zlib
+
+from duplicity import dup_time
+from duplicity import log
+from duplicity import tempdir
+
+try:
+    from hashlib import sha1
+except ImportError:
+    from sha import new as sha1
+
+# Chunks are cut after an anchor byte whose window of preceding bytes
+# has a crc32 with the chunk_mask bits clear, or at chunk_max.  With
+# these values chunks are about 80KB on average.
+chunk_min = 16 * 1024
+chunk_max = 256 * 1024
+chunk_window = 32
+chunk_mask = 0x3ff
+anchor_re = re.compile("[\n\x8f\x9d\xb3]")
+
+# Bump when the chunk index layout changes; old indexes are then ignored.
+index_version = 1
+
+# Records of chunked entries: a literal chunk, a chunk stored earlier
+# in the same file, or a reference to a chunk stored in another file.
+literal_header = ">cI20s"      # "L", length, sha1
+self_ref_header = ">cI20sQ"    # "S", length, sha1, offset
+ref_header = ">cI20sIQH"       # "R", length, sha1, set, offset,
+                               # length of name, then name
+
+
+class DedupError(Exception):
+    """
+    Exception raised when a chunked entry cannot be decoded
+    """
+    pass
+
+
+def find_cut(buf, start, end):
+    """
+    Return end of the chunk of buf starting at start
+
+    buf must hold chunk_max bytes from start, unless the file ends at
+    end.
+    """
+    limit = min(end, start + chunk_max)
+    pos = start + chunk_min - 1
+    while pos < limit:
+        match = anchor_re.search(buf, pos, limit)
+        if not match:
+            break
+        pos = match.start()
+        if not zlib.crc32(buf[pos - chunk_window + 1:pos + 1]) & chunk_mask:
+            return pos + 1
+        pos += 1
+    return limit
+
+
+class ChunkIndex:
+    """
+    Index of the chunks stored in a backup chain
+
+    The file in archive_dir is a marshal stream of a header, the list
+    of the names of the files chunks were stored with, and a dict from
+    the sha1 digest of each chunk to (name number, set number, offset,
+    length).  The header holds the number of backup sets the index
+    covers.  It takes about 150 bytes of memory per chunk.
+    """
+    def __init__(self, archive_dir, chain_time, set_num):
+        """
+        ChunkIndex initializer, reads the index of the chain
+
+        @type archive_dir: path.Path
+        @param archive_dir: directory holding the index
+        @type chain_time: int
+        @param chain_time: time of the full backup of the chain
+        @type set_num: int
+        @param set_num: number in the chain of the set being backed up
+        """
+        self.archive_dir = archive_dir
+        self.index_path = archive_dir.append("chunkindex.%s" %
+                                             dup_time.timetostring(chain_time))
+        self.set_num = set_num
+        self.names = []
+        self.name_nums = {}
+        self.chunks = {}
+        self.load()
+
+    def load(self):
+        """
+        Read index from disk, if it is usable for set_num
+        """
+        self.index_path.setdata()
+        if not self.index_path.exists():
+            return
+        fp = self.index_path.open("rb")
+        try:
+            try:
+                header = marshal.load(fp)
+                if (type(header) is not dict
+                    or header.get("version") != index_version
+                    or header.get("sets") > self.set_num):
+                    log.Info(_("Ignoring chunk index %s") % (self.index_path.name,))
+                    return
+                names = marshal.load(fp)
+                chunks = marshal.load(fp)
+            except (EOFError, ValueError, TypeError):
+                log.Info(_("Ignoring chunk index %s") % (self.index_path.name,))
+                return
+        finally:
+            fp.close()
+        self.names, self.chunks = names, chunks
+        for i in range(len(names)):
+            self.name_nums[names[i]] = i
+
+    def get(self, digest):
+        """
+        Return (name, set number, offset) of chunk digest, or None
+        """
+        value = self.chunks.get(digest)
+        if value is None:
+            return None
+        return (self.names[value[0]], value[1], value[2])
+
+    def add(self, digest, name, offset, length):
+        """
+        Record chunk digest stored at offset of file name in this set
+        """
+        name_num = self.name_nums.get(name)
+        if name_num is None:
+            name_num = self.name_nums[name] = len(self.names)
+            self.names.append(name)
+        self.chunks[digest] = (name_num, self.set_num, offset, length)
+
+    def truncate(self, num_sets):
+        """
+        Forget the chunks of the sets from num_sets on, and save index
+
+        Used when those sets are replaced, so later sets of the chain
+        do not refer to them.
+        """
+        for digest, value in self.chunks.items():
+            if value[1] >= num_sets:
+                del self.chunks[digest]
+        self.set_num = num_sets - 1
+        self.save()
+
+    def save(self):
+        """
+        Write index once the backup set is complete
+
+        The indexes of other chains are deleted.
+        """
+        new_path = self.archive_dir.append(self.index_path.get_filename() + ".new")
+        fp = new_path.open("wb")
+        marshal.dump({"version": index_version, "sets": self.set_num + 1}, fp)
+        marshal.dump(self.names, fp)
+        marshal.dump(self.chunks, fp)
+        assert not fp.close()
+        new_path.rename(self.index_path)
+        for filename in self.archive_dir.listdir():
+            if (filename.startswith("chunkindex.")
+                and filename != self.index_path.get_filename()):
+                log.Info(_("Deleting stale chunk index %s") % (filename,))
+                self.archive_dir.append(filename).delete()
+
+
+class ChunkEncoder:
+    """
+    File-like object returning the chunked entry of a file
+
+    The file is read from infp, and its new chunks are added to
+    chunk_index as they are read.
+    """
+    def __init__(self, infp, chunk_index, index):
+        """ChunkEncoder initializer"""
+        self.infp = infp
+        self.chunk_index = chunk_index
+        self.name = "/".join(index)
+        self.buf, self.pos = "", 0 # data read, and start of next chunk
+        self.at_eof = False
+        self.offset = 0 # offset of next chunk in the file
+        self.outbuf = []
+        self.outlen = 0
+
+    def read(self, length = -1):
+        while length < 0 or self.outlen < length:
+            if not self.encode_chunk():
+                break
+        data = "".join(self.outbuf)
+        if length >= 0:
+            data, rest = data[:length], data[length:]
+            self.outbuf, self.outlen = [rest], len(rest)
+        else:
+            self.outbuf, self.outlen = [], 0
+        return data
+
+    def fill(self):
+        """
+        Read until chunk_max bytes are buffered after pos, or EOF
+        """
+        if self.pos:
+            self.buf, self.pos = self.buf[self.pos:], 0
+        pieces = [self.buf]
+        size = len(self.buf)
+        while size < chunk_max and not self.at_eof:
+            data = self.infp.read(chunk_max)
+            if not data:
+                self.at_eof = True
+            pieces.append(data)
+            size += len(data)
+        self.buf = "".join(pieces)
+
+    def encode_chunk(self):
+        """
+        Add record of next chunk to output, return false at end
+        """
+        if len(self.buf) - self.pos < chunk_max and not self.at_eof:
+            self.fill()
+        if self.pos >= len(self.buf):
+            return False
+        cut = find_cut(self.buf, self.pos, len(self.buf))
+        chunk = self.buf[self.pos:cut]
+        self.pos = cut
+        digest = sha1(chunk).digest()
+        stored = self.chunk_index.get(digest)
+        if not stored:
+            self.chunk_index.add(digest, self.name, self.offset, len(chunk))
+            self.output(struct.pack(literal_header, "L", len(chunk), digest), chunk)
+        elif (stored[0] == self.name and
+              stored[1] == self.chunk_index.set_num):
+            self.output(struct.pack(self_ref_header, "S", len(chunk), digest,
+                                    stored[2]))
+        else:
+            self.output(struct.pack(ref_header, "R", len(chunk), digest,
+                                    stored[1], stored[2], len(stored[0])),
+                        stored[0])
+        self.offset += len(chunk)
+        return True
+
+    def output(self, *strings):
+        for s in strings:
+            self.outbuf.append(s)
+            self.outlen += len(s)
+
+    def close(self):
+        return self.infp.close()
+
+
+def decode(fp, get_basis = None):
+    """
+    Return temporary file with the contents of chunked entry fp
+
+    get_basis is the BasisCache of the restore, used to read chunks
+    stored with other files.  The literal chunks of fp are added to it.
+    """
+    outfp = tempfile.TemporaryFile(dir = tempdir.default().dir())
+    size = 0
+    while 1:
+        kind = fp.read(1)
+        if not kind:
+            break
+        if kind == "L":
+            length, digest = read_header(fp, literal_header, kind)[1:]
+            chunk = fp.read(length)
+        elif kind == "S":
+            length, digest, offset = read_header(fp, self_ref_header, kind)[1:]
+            outfp.seek(offset)
+            chunk = outfp.read(length)
+            outfp.seek(size)
+        elif kind == "R":
+            length, digest, set_num, offset, name_len = \
+                    read_header(fp, ref_header, kind)[1:]
+            name = fp.read(name_len)
+            if not get_basis:
+                raise DedupError("Chunk stored with %s cannot be read" % (name,))
+            chunk = get_basis.get_chunk(digest, length,
+                                        tuple(name.split("/")), set_num + 1)
+        else:
+            raise DedupError("Bad chunk record type %r" % (kind,))
+        if len(chunk) != length or sha1(chunk).digest() != digest:
+            raise DedupError("Chunk at offset %d does not match its digest" %
+                             (size,))
+        if kind == "L" and get_basis:
+            get_basis.add_chunk(digest, chunk)
+        outfp.write(chunk)
+        size += length
+    assert not fp.close()
+    outfp.seek(0)
+    return outfp
+
+
+def read_header(fp, header_format, kind):
+    """
+    Return unpacked record header of type kind, whose first byte was read
+    """
+    size = struct.calcsize(header_format)
+    data = kind + fp.read(size - 1)
+    if len(data) != size:
+        raise DedupError("Truncated chunk record")
+    return struct.unpack(header_format, data)
+
+
+class BasisCache:
+    """
+    Keep the chunks and files restored to read references from
+
+    Every literal chunk decoded during the restore is appended to a
+    temporary file, so a chunk referred to by a later file is read
+    from there directly.  A chunk not seen yet (its file was replaced
+    later in the chain, or is not being restored) is found by
+    restoring the file it was stored with once, which adds its chunks.
+
+    Calling the cache like get_basis(index, num_sets) returns a new
+    real file object of a restored file, which the caller closes;
+    moved files are restored from these.  The last max_files of them
+    are kept in temporary files.
+    """
+    def __init__(self, get_basis, max_files = 16):
+        """
+        BasisCache initializer
+
+        get_basis(index, num_sets) restores a file from the first
+        num_sets sets of the chain and returns the path.Path of a
+        temporary file holding it, which the cache deletes.
+        """
+        self.get_basis = get_basis
+        self.max_files = max_files
+        self.files = {} # (index, num_sets) -> temporary path
+        self.order = [] # keys, most recently used last
+        self.chunk_fp = None
+        self.chunk_offsets = {} # sha1 digest -> offset in chunk_fp
+        self.chunk_size = 0
+
+    def __call__(self, index, num_sets):
+        key = (index, num_sets)
+        if key in self.files:
+            self.order.remove(key)
+        else:
+            self.files[key] = self.get_basis(index, num_sets)
+            if len(self.order) >= self.max_files:
+                self.files.pop(self.order.pop(0)).delete()
+        self.order.append(key)
+        return self.files[key].open("rb")
+
+    def add_chunk(self, digest, chunk):
+        """
+        Keep chunk with sha1 digest, unless it is kept already
+        """
+        if digest in self.chunk_offsets:
+            return
+        if not self.chunk_fp:
+            self.chunk_fp = tempfile.TemporaryFile(dir = tempdir.default().dir())
+        self.chunk_fp.seek(self.chunk_size)
+        self.chunk_fp.write(chunk)
+        self.chunk_offsets[digest] = self.chunk_size
+        self.chunk_size += len(chunk)
+
+    def get_chunk(self, digest, length, index, num_sets):
+        """
+        Return chunk stored with file index in the first num_sets sets
+        """
+        if digest not in self.chunk_offsets:
+            log.Info(_("Restoring %s to read its chunks") % ("/".join(index),))
+            self.get_basis(index, num_sets).delete()
+            if digest not in self.chunk_offsets:
+                raise DedupError("Chunk not found in %s" % ("/".join(index),))
+        self.chunk_fp.seek(self.chunk_offsets[digest])
+        return self.chunk_fp.read(length)
@@ -27,8 +27,12 @@ first, the signature or delta is constructed of a ROPath iterator.  In
 the second, the ROPath iterator is put into tar block form.
 """
 
-import cStringIO, types
+import cStringIO, types, tempfile
+from duplicity import asyncscheduler
+from duplicity import dedup
+from duplicity import misc
 from duplicity import statistics
+from duplicity import tempdir
 from duplicity import util
 from duplicity.path import * #@UnusedWildImport
 from duplicity.lazy import * #@UnusedWildImport
@@ -36,6 +40,15 @@ from duplicity.lazy import * #@UnusedWildImport
 # A StatsObj will be written to this from DirDelta_WriteSig only.
 stats = None
 
+# Smaller files are backed up again when moved, see RenameFinder.
+rename_min_size = 1024 * 1024
+
+# Larger files are spooled to disk, see TarStreamBlockIter.
+stream_memory_size = 1024 * 1024
+
+# Only deltas of smaller files are computed ahead, see get_delta_iter.
+readahead_max_size = 1024 * 1024
+
 
 class DiffDirException(Exception):
     pass
@@ -60,28 +73,41 @@ def DirFull(path_iter):
     return DirDelta(path_iter, cStringIO.StringIO(""))
 
 
-def DirFull_WriteSig(path_iter, sig_outfp):
+def DirFull_WriteSig(path_iter, sig_outfp, stat_cache = None,
+                     chunk_index = None):
     """
     Return full backup like above, but also write signature to sig_outfp
+
+    If stat_cache is given, the stat data of the files are written to
+    it.  For chunk_index, see get_delta_iter.
     """
-    return DirDelta_WriteSig(path_iter, cStringIO.StringIO(""), sig_outfp)
+    return DirDelta_WriteSig(path_iter, cStringIO.StringIO(""), sig_outfp,
+                             stat_cache, chunk_index = chunk_index)
 
 
-def DirDelta(path_iter, dirsig_fileobj_list):
+def DirDelta(path_iter, dirsig_fileobj_list, stat_cache = None,
+             rename_finder = None, chunk_index = None):
     """
     Produce tarblock diff given dirsig_fileobj_list and pathiter
 
     dirsig_fileobj_list should either be a tar fileobj or a list of
-    those, sorted so the most recent is last.
+    those, sorted so the most recent is last.  It may also be an
+    already combined signature path iterator, like the one from
+    sigindex.SigIndex.get_path_iter().  For stat_cache, rename_finder
+    and chunk_index, see get_delta_iter.
     """
     global stats
     stats = statistics.StatsDeltaProcess()
     if type(dirsig_fileobj_list) is types.ListType:
         sig_iter = combine_path_iters(map(sigtar2path_iter,
                                           dirsig_fileobj_list))
+    elif type(dirsig_fileobj_list) is types.GeneratorType:
+        sig_iter = dirsig_fileobj_list
     else:
         sig_iter = sigtar2path_iter(dirsig_fileobj_list)
-    delta_iter = get_delta_iter(path_iter, sig_iter)
+    delta_iter = get_delta_iter(path_iter, sig_iter, stat_cache = stat_cache,
+                                rename_finder = rename_finder,
+                                chunk_index = chunk_index)
     if globals.dry_run:
         return DummyBlockIter(delta_iter)
     else:
@@ -102,10 +128,15 @@ def delta_iter_error_handler(exc, new_path, sig_path, sig_tar = None):
     return None
 
 
-def get_delta_path(new_path, sig_path, sigTarFile = None):
+def get_delta_path(new_path, sig_path, sigTarFile = None, read_stats = None,
+                   chunk_index = None):
     """
     Return new delta_path which, when read, writes sig to sig_fileobj,
     if sigTarFile is not None
+
+    Bytes read from new_path are counted in read_stats if given,
+    otherwise in the module stats.  If chunk_index is given, regular
+    files are stored as "chunked" instead of "snapshot" (see dedup).
     """
     assert new_path
     if sigTarFile:
@@ -125,7 +156,7 @@ def get_delta_path(new_path, sig_path, sigTarFile = None):
     if new_path.isreg() and sig_path and sig_path.isreg() and sig_path.difftype == "signature":
         delta_path.difftype = "diff"
         old_sigfp = sig_path.open("rb")
-        newfp = FileWithReadCounter(new_path.open("rb"))
+        newfp = FileWithReadCounter(new_path.open("rb"), read_stats)
         if sigTarFile:
             newfp = FileWithSignature(newfp, callback,
                                       new_path.getsize())
@@ -140,10 +171,13 @@ def get_delta_path(new_path, sig_path, sigTarFile = None):
             if stats:
                 stats.SourceFileSize += delta_path.getsize()
         else:
-            newfp = FileWithReadCounter(new_path.open("rb"))
+            newfp = FileWithReadCounter(new_path.open("rb"), read_stats)
             if sigTarFile:
                 newfp = FileWithSignature(newfp, callback,
                                           new_path.getsize())
+            if chunk_index:
+                delta_path.difftype = "chunked"
+                newfp = dedup.ChunkEncoder(newfp, chunk_index, new_path.index)
             delta_path.setfileobj(newfp)
     new_path.copy_attribs(delta_path)
     delta_path.stat.st_size = new_path.stat.st_size
@@ -154,13 +188,21 @@ def log_delta_path(delta_path, new_path = None, stats = None):
     """
     Look at delta path and log delta.  Add stats if new_path is set
     """
-    if delta_path.difftype == "snapshot":
+    if delta_path.difftype in ("snapshot", "chunked"):
         if new_path and stats:
             stats.add_new_file(new_path)
         log.Info(_("A %s") %
                  (delta_path.get_relative_path(),),
                  log.InfoCode.diff_file_new,
                  util.escape(delta_path.get_relative_path()))
+    elif delta_path.difftype == "moved":
+        if new_path and stats:
+            stats.add_new_file(new_path)
+        log.Info(_("A %s (moved from %s)") %
+                 (delta_path.get_relative_path(),
+                  "/".join(delta_path.moved_from)),
+                 log.InfoCode.diff_file_new,
+                 util.escape(delta_path.get_relative_path()))
     else:
         if new_path and stats:
             stats.add_changed_file(new_path)
@@ -170,7 +212,23 @@ def log_delta_path(delta_path, new_path = None, stats = None):
                  util.escape(delta_path.get_relative_path()))
 
 
-def get_delta_iter(new_iter, sig_iter, sig_fileobj=None):
+def read_ahead_delta(new_path, sig_path, delta_path):
+    """
+    Read the delta of delta_path into memory
+
+    Used by get_delta_iter to do the librsync work in a worker thread,
+    ahead of the delta being written out.  Returns delta_path.
+    """
+    fin = delta_path.open("rb")
+    buf = fin.read()
+    assert not fin.close()
+    delta_path.fileobj = None
+    delta_path.setfileobj(cStringIO.StringIO(buf))
+    return delta_path
+
+
+def get_delta_iter(new_iter, sig_iter, sig_fileobj=None, stat_cache=None,
+                   rename_finder=None, chunk_index=None):
     """
     Generate delta iter from new Path iter and sig Path iter.
 
@@ -179,20 +237,73 @@ def get_delta_iter(new_iter, sig_iter, sig_fileobj=None):
     instead of Paths.
 
     If sig_fileobj is not None, will also write signatures to sig_fileobj.
+
+    If globals.delta_readahead is above 1, the deltas of up to that many
+    changed files of at most readahead_max_size bytes are computed
+    ahead in worker threads and held in memory.  Paths are still
+    yielded, and their signatures written, in index order.
+
+    If stat_cache (a statcache.StatCache) is being written, the stat
+    data of the new paths are added to it.  If it was opened for
+    reading, it is used to pass over unchanged files, see
+    collate_stat_cache.
+
+    If rename_finder (a RenameFinder) is given, new files which were
+    moved from another path get a delta against the signature of that
+    path, with difftype "moved", instead of a snapshot.
+
+    If chunk_index (a dedup.ChunkIndex) is given, regular files which
+    would be stored whole are stored as "chunked", referring to the
+    chunks already stored in the chain.
     """
-    collated = collate2iters(new_iter, sig_iter)
+    if stat_cache and stat_cache.fp:
+        collated = collate_stat_cache(new_iter, sig_iter, stat_cache)
+    else:
+        collated = collate2iters(new_iter, sig_iter)
     if sig_fileobj:
         sigTarFile = util.make_tarfile("w", sig_fileobj)
     else:
         sigTarFile = None
+
+    if globals.delta_readahead > 1:
+        scheduler = asyncscheduler.AsyncScheduler(globals.delta_readahead)
+    else:
+        scheduler = None
+    pending = [] # (waiter, new_path, read_stats, deferred_tar) in order
+
+    def finish_pending(keep = 0):
+        """
+        Wait for all but the last keep read-ahead deltas, and return
+        those that succeeded, with their signatures written
+        """
+        ready = []
+        while len(pending) > keep:
+            waiter, new_path, read_stats, deferred_tar = pending.pop(0)
+            delta_path = waiter()
+            stats.SourceFileSize += read_stats.SourceFileSize
+            if delta_path:
+                if deferred_tar:
+                    deferred_tar.replay(sigTarFile)
+                log_delta_path(delta_path, new_path, stats)
+                ready.append(delta_path)
+            else:
+                stats.Errors += 1
+                if stat_cache:
+                    stat_cache.add_failed(new_path.index)
+        return ready
+
     for new_path, sig_path in collated:
         log.Debug(_("Comparing %s and %s") % (new_path and new_path.index,
                                               sig_path and sig_path.index))
+        if stat_cache and new_path and new_path.type:
+            stat_cache.add(new_path)
         if not new_path or not new_path.type:
             # File doesn't exist (but ignore attempts to delete base dir;
             # old versions of duplicity could have written out the sigtar in
             # such a way as to fool us; LP: #929067)
             if sig_path and sig_path.exists() and sig_path.index != ():
+                for delta_path in finish_pending():
+                    yield delta_path
                 # but signature says it did
                 log.Info(_("D %s") %
                          (sig_path.get_relative_path(),),
@@ -204,11 +315,47 @@ def get_delta_iter(new_iter, sig_iter, sig_fileobj=None):
                     sigTarFile.addfile(ti)
                 stats.add_deleted_file()
                 yield ROPath(sig_path.index)
-        elif not sig_path or new_path != sig_path:
+        elif (scheduler and sig_path and path_changed(new_path, sig_path)
+              and new_path.isreg() and sig_path.isreg() and sig_path.difftype == "signature"
+              and new_path.getsize() <= readahead_max_size):
+            # Delta against an old signature, compute it ahead
+            read_stats = statistics.StatsDeltaProcess()
+            if sigTarFile:
+                deferred_tar = DeferredTarFile()
+            else:
+                deferred_tar = None
+            delta_path = robust.check_common_error(delta_iter_error_handler,
+                                                   get_delta_path,
+                                                   (new_path, sig_path,
+                                                    deferred_tar, read_stats))
+            if delta_path:
+                waiter = scheduler.schedule_task(robust.check_common_error,
+                                                 (delta_iter_error_handler,
+                                                  read_ahead_delta,
+                                                  (new_path, sig_path, delta_path)))
+                pending.append((waiter, new_path, read_stats, deferred_tar))
+                for delta_path in finish_pending(globals.delta_readahead):
+                    yield delta_path
+            else:
+                stats.Errors += 1
+                if stat_cache:
+                    stat_cache.add_failed(new_path.index)
+        elif not sig_path or path_changed(new_path, sig_path):
+            for delta_path in finish_pending():
+                yield delta_path
+            moved_sig_path = None
+            if not sig_path and rename_finder:
+                moved_sig_path = rename_finder.find(new_path)
             # Must calculate new signature and create delta
             delta_path = robust.check_common_error(delta_iter_error_handler,
                                                    get_delta_path,
-                                                   (new_path, sig_path, sigTarFile))
+                                                   (new_path,
+                                                    sig_path or moved_sig_path,
+                                                    sigTarFile, None,
+                                                    chunk_index))
+            if delta_path and moved_sig_path:
+                delta_path.difftype = "moved"
+                delta_path.moved_from = moved_sig_path.index
             if delta_path:
                 # log and collect stats
                 log_delta_path(delta_path, new_path, stats)
@@ -216,8 +363,12 @@ def get_delta_iter(new_iter, sig_iter, sig_fileobj=None):
             else:
                 # if not, an error must have occurred
                 stats.Errors += 1
+                if stat_cache:
+                    stat_cache.add_failed(new_path.index)
         else:
             stats.add_unchanged_file(new_path)
+    for delta_path in finish_pending():
+        yield delta_path
     stats.close()
     if sigTarFile:
         sigTarFile.close()
@@ -226,6 +377,11 @@ def get_delta_iter(new_iter, sig_iter, sig_fileobj=None):
 def sigtar2path_iter(sigtarobj):
     """
     Convert signature tar file object open for reading into path iter
+
+    The signatures of unchanged files are never read, but as sigtars
+    are gzip streams, tarfile still decompresses them to skip them.
+    Paths of a sigindex.SigIndex (--signature-index) carry only the
+    stat data, and read signatures from its blob file when needed.
     """
     tf = util.make_tarfile("r", sigtarobj)
     tf.debug = 1
@@ -297,6 +453,97 @@ def collate2iters(riter1, riter2):
             relem2 = None
 
 
+def collate_stat_cache(new_iter, sig_iter, stat_cache):
+    """
+    Collate new_iter and sig_iter like collate2iters, using stat_cache
+
+    New paths whose stat data are the same as in stat_cache are paired
+    with themselves, so they are found unchanged, and paths recorded
+    in stat_cache but not in new_iter are paired with an ROPath, to be
+    found deleted.  sig_iter is only read when a signature is needed,
+    for the new paths which may have changed.  Regular files changed
+    without a new mtime get stat_changed set, see StatCache.unchanged.
+    """
+    sig_path = None
+    sig_iter_done = False
+    for new_path in new_iter:
+        for record in stat_cache.pass_to(new_path.index):
+            yield (None, record2ropath(record))
+        if stat_cache.unchanged(new_path):
+            yield (new_path, new_path)
+            continue
+        while (not sig_iter_done and
+               (not sig_path or sig_path.index < new_path.index)):
+            try:
+                sig_path = sig_iter.next()
+            except StopIteration:
+                sig_path, sig_iter_done = None, True
+        if sig_path and sig_path.index == new_path.index:
+            yield (new_path, sig_path)
+        else:
+            yield (new_path, None)
+    for record in stat_cache.pass_rest():
+        yield (None, record2ropath(record))
+
+
+class RenameFinder:
+    """
+    Find where new files were moved from since the last backup
+
+    Files are recognized by their device and inode numbers, as kept
+    in the stat cache of the last backup.  The signature of the path
+    a file was moved from is looked up in the signature index, so the
+    file can be backed up as a delta against it.
+    """
+    def __init__(self, stat_cache, sig_index):
+        """
+        RenameFinder initializer
+
+        @type stat_cache: statcache.StatCache
+        @param stat_cache: stat cache of the last backup, opened for reading
+        @type sig_index: sigindex.SigIndex
+        @param sig_index: signature index of the chain, up to date
+        """
+        self.stat_cache = stat_cache
+        self.sig_index = sig_index
+
+    def find(self, new_path):
+        """
+        Return signature ROPath of the path new_path was moved from,
+        or None if it is not known to have been moved
+        """
+        if not new_path.isreg() or new_path.getsize() < rename_min_size:
+            return None
+        old_index = self.stat_cache.find_inode(new_path.stat.st_dev,
+                                               new_path.stat.st_ino)
+        if old_index is None or old_index == new_path.index:
+            return None
+        sig_path = self.sig_index.get_path(old_index)
+        if (sig_path and sig_path.isreg()
+            and sig_path.difftype == "signature"):
+            return sig_path
+        return None
+
+
+def path_changed(new_path, sig_path):
+    """
+    Return true if new_path has to be backed up again
+
+    Besides what the signature shows, the stat cache can tell a
+    file changed without its mtime changing, see collate_stat_cache.
+    """
+    return new_path != sig_path or getattr(new_path, "stat_changed", False)
+
+
+def record2ropath(record):
+    """
+    Return ROPath of a stat cache record, for a file found deleted
+    """
+    ropath = ROPath(record[0])
+    ropath.type = record[1]
+    return ropath
+
+
 def combine_path_iters(path_iter_list):
     """
     Produce new iterator by combining the iterators in path_iter_list
@@ -348,21 +595,26 @@ def combine_path_iters(path_iter_list):
         refresh_triple_list(triple_list)
 
 
-def DirDelta_WriteSig(path_iter, sig_infp_list, newsig_outfp):
+def DirDelta_WriteSig(path_iter, sig_infp_list, newsig_outfp,
+                      stat_cache = None, rename_finder = None,
+                      chunk_index = None):
     """
     Like DirDelta but also write signature into sig_fileobj
 
-    Like DirDelta, sig_infp_list can be a tar fileobj or a sorted list
-    of those.  A signature will only be written to newsig_outfp if it
+    Like DirDelta, sig_infp_list can be a tar fileobj, a sorted list
+    of those, or a combined signature path iterator.  A signature will only be written to newsig_outfp if it
     is different from (the combined) sig_infp_list.
     """
     global stats
     stats = statistics.StatsDeltaProcess()
     if type(sig_infp_list) is types.ListType:
         sig_path_iter = get_combined_path_iter(sig_infp_list)
+    elif type(sig_infp_list) is types.GeneratorType:
+        sig_path_iter = sig_infp_list
     else:
         sig_path_iter = sigtar2path_iter(sig_infp_list)
-    delta_iter = get_delta_iter(path_iter, sig_path_iter, newsig_outfp)
+    delta_iter = get_delta_iter(path_iter, sig_path_iter, newsig_outfp,
+                                stat_cache, rename_finder, chunk_index)
     if globals.dry_run:
         return DummyBlockIter(delta_iter)
     else:
@@ -380,9 +632,14 @@ class FileWithReadCounter:
     """
     File-like object which also computes amount read as it is read
     """
-    def __init__(self, infile):
-        """FileWithReadCounter initializer"""
+    def __init__(self, infile, read_stats = None):
+        """FileWithReadCounter initializer
+
+        The amount read is added to read_stats if given, otherwise to
+        the module stats.
+        """
         self.infile = infile
+        self.read_stats = read_stats
 
     def read(self, length = -1):
         try:
@@ -390,7 +647,9 @@ class FileWithReadCounter:
         except IOError, ex:
             buf = ""
             log.Warn(_("Error %s getting delta for %s") % (str(ex), self.infile.name))
-        if stats:
+        if self.read_stats is not None:
+            self.read_stats.SourceFileSize += len(buf)
+        elif stats:
             stats.SourceFileSize += len(buf)
         return buf
 
@@ -434,6 +693,26 @@ class FileWithSignature:
         return self.infile.close()
 
 
+class DeferredTarFile:
+    """
+    Stand-in for a TarFile which records added entries
+
+    Lets signatures computed in a worker thread be added to the real
+    signature tarfile later, in order, with replay().
+    """
+    def __init__(self):
+        """DeferredTarFile initializer"""
+        self.entries = []
+
+    def addfile(self, tarinfo, fileobj = None):
+        self.entries.append((tarinfo, fileobj))
+
+    def replay(self, tarfile):
+        for tarinfo, fileobj in self.entries:
+            tarfile.addfile(tarinfo, fileobj)
+        self.entries = []
+
+
 class TarBlock:
     """
     Contain information to add next file to tar
@@ -642,11 +921,18 @@ class DeltaTarBlockIter(TarBlockIter):
                 add_prefix(ti, "snapshot")
             elif delta_ropath.difftype == "diff":
                 add_prefix(ti, "diff")
+            elif delta_ropath.difftype == "moved":
+                add_prefix(ti, "moved")
+                ti.linkname = "/".join(delta_ropath.moved_from)
+            elif delta_ropath.difftype == "chunked":
+                add_prefix(ti, "chunked")
             else:
                 assert 0, "Unknown difftype"
             return self.tarinfo2tarblock(index, ti, data)
 
         # Finally, do multivol snapshot or diff case
+        if delta_ropath.difftype == "moved":
+            ti.linkname = "/".join(delta_ropath.moved_from)
         full_name = "multivol_%s/%s" % (delta_ropath.difftype, ti.name)
         ti.name = full_name + "/1"
         self.process_prefix = full_name
@@ -691,6 +977,83 @@ class DeltaTarBlockIter(TarBlockIter):
         return self.tarinfo2tarblock(index, ti, data)
 
 
+class TarStreamBlockIter(TarBlockIter):
+    """
+    TarBlockIter that yields blocks of a plain tar of ROPaths
+
+    Used to restore to a tar stream.  The size of a patched file is
+    only known once it is read, and comes before the data in the tar
+    header, so files are read into memory, or into a temporary file
+    if larger than stream_memory_size, before being returned.
+    """
+    def __init__(self, input_iter, root_name = "."):
+        """
+        TarStreamBlockIter initializer
+
+        root_name is the tar name of the root, if it is not a
+        directory (when restoring a single file).
+        """
+        TarBlockIter.__init__(self, input_iter)
+        self.root_name = root_name
+        self.process_fp = None
+        self.process_left = 0
+
+    def process(self, ropath):
+        """
+        Return first tarblock of ropath
+        """
+        ti = ropath.get_tarinfo()
+        index = ropath.index
+        if not index and not ropath.isdir():
+            ti.name = self.root_name
+        if not ropath.isreg():
+            return self.tarinfo2tarblock(index, ti)
+
+        fp = ropath.open("rb")
+        data = fp.read(stream_memory_size + 1)
+        if len(data) <= stream_memory_size:
+            if fp.close():
+                raise DiffDirException("Error closing file")
+            return self.tarinfo2tarblock(index, ti, data)
+
+        tmpfp = tempfile.TemporaryFile(dir = tempdir.default().dir())
+        tmpfp.write(data)
+        ti.size = len(data) + misc.copyfileobj(fp, tmpfp)
+        if fp.close():
+            raise DiffDirException("Error closing file")
+        tmpfp.seek(0)
+        self.process_fp = tmpfp
+        self.process_left = ti.size
+        self.process_waiting = True
+        return TarBlock(index, ti.tobuf())
+
+    def process_continued(self):
+        """
+        Return next data block of a spooled file
+        """
+        index = self.previous_index
+        data = self.process_fp.read(min(self.get_read_size(), self.process_left))
+        if not data:
+            raise DiffDirException("Spooled file of %s too short" %
+                                   ("/".join(index),))
+        self.process_left -= len(data)
+        if not self.process_left:
+            assert not self.process_fp.close()
+            self.process_fp = None
+            self.process_waiting = False
+            remainder = (self.offset + len(data)) % tarfile.BLOCKSIZE
+            if remainder:
+                data += "\0" * (tarfile.BLOCKSIZE - remainder)
+        return TarBlock(index, data)
+
+    def get_footer(self):
+        """
+        Return end of archive, two zero blocks padded to a record
+        """
+        self.offset += 2 * tarfile.BLOCKSIZE
+        return "\0" * (2 * tarfile.BLOCKSIZE) + TarBlockIter.get_footer(self)
+
+
 def write_block_iter(block_iter, out_obj):
     """
     Write block_iter to filename, path, or file object
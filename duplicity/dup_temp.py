@@ -104,6 +104,45 @@ class TempDupPath(path.DupPath):
     """
     Like TempPath, but build around DupPath
     """
+    hash_name = None
+
+    def hash_writes(self, hash_name):
+        """
+        Hash data written to self through open("wb") with hash_name
+
+        Backends writing the file this way (like the local and webdav
+        backends) then give its hash for free; see get_written_hash.
+        """
+        self.hash_name = hash_name
+        self.hash_obj = None
+        self.hash_size = 0
+
+    def open(self, mode = "rb"):
+        """
+        Return fileobj associated with self, hashing writes if asked
+        """
+        fileobj = path.DupPath.open(self, mode)
+        if self.hash_name and mode == "wb":
+            # the file is being written from the start again
+            self.hash_obj = gpg.new_hash(self.hash_name)
+            self.hash_size = 0
+            fileobj = HashedWriteFile(fileobj, self)
+        return fileobj
+
+    def get_written_hash(self):
+        """
+        Return hex hash of data written to self, or None if unknown
+
+        None is returned if the file on disk was not (entirely)
+        written through open, so it has to be read to be hashed.
+        """
+        if not self.hash_name or not self.hash_obj:
+            return None
+        self.setdata()
+        if not self.isreg() or self.getsize() != self.hash_size:
+            return None
+        return self.hash_obj.hexdigest()
+
     def delete(self):
         """
         Forget and delete
@@ -129,6 +168,44 @@ class TempDupPath(path.DupPath):
         return fh
 
 
+class HashedWriteFile:
+    """
+    Simulate a file open for writing, hashing the data into a TempDupPath
+    """
+    def __init__(self, fileobj, tdp):
+        """
+        Initializer.  fileobj is the file object to simulate
+        """
+        self.fileobj = fileobj
+        self.tdp = tdp
+
+    def write(self, buf):
+        """
+        Write fileobj and hash buf
+        """
+        self.tdp.hash_obj.update(buf)
+        self.tdp.hash_size += len(buf)
+        return self.fileobj.write(buf)
+
+    def flush(self):
+        """
+        Flush fileobj
+        """
+        return self.fileobj.flush()
+
+    def fileno(self):
+        """
+        Return fileno of fileobj
+        """
+        return self.fileobj.fileno()
+
+    def close(self):
+        """
+        Close fileobj, return result of close()
+        """
+        return self.fileobj.close()
+
+
 class FileobjHooked:
     """
     Simulate a file, but add hook on close
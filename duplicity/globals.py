@@ -61,6 +61,10 @@ restore_time = None
 # whole root.
 restore_dir = None
 
+# If true, restore writes a tar stream of the files to the local path,
+# or to standard output if it is "-", instead of a directory tree.
+tar_output = False
+
 # The backend representing the remote side
 backend = None
 
@@ -153,6 +157,51 @@ webdav_proto = 'http'
 # (default of 0 disables asynchronicity).
 async_concurrency = 0
 
+# Number of volumes to compress/encrypt in parallel (0 or 1 builds
+# volumes one at a time, in line with reading the source).
+parallel_volumes = 0
+
+# Number of changed files whose deltas and signatures are computed
+# ahead in worker threads (0 or 1 computes them as they are written).
+delta_readahead = 0
+
+# If true, record SHA256 hashes of volumes in the manifest, besides
+# the SHA1 hashes older versions use.
+hash_sha256 = False
+
+# Number of volumes to download and verify ahead of the restore in
+# background threads (default of 0 fetches each volume when needed).
+restore_prefetch = 0
+
+# Number of threads writing restored files and setting their attributes
+# (0 or 1 writes them one at a time, in line with reading the backup).
+restore_writers = 0
+
+# Number of threads listing and stat'ing directories ahead of file
+# selection (0 or 1 scans directories as they are selected).
+scan_workers = 0
+
+# File listing the files changed since the last backup; if set,
+# incremental backups only look at those instead of the whole source.
+changed_files = None
+
+# If true, keep an index of the combined signatures of the current
+# chain in the archive dir, and use it for incremental backups.
+signature_index = False
+
+# If true, keep the stat data of the files of the last backup in the
+# archive dir, and use them to pass over unchanged files.
+stat_cache = False
+
+# If true, regular files stored whole are cut into chunks, and chunks
+# already stored in the backup chain are not stored again.
+dedup = False
+
+# If true, files moved since the last backup are backed up as deltas
+# against the path they were moved from (needs stat_cache and
+# signature_index).
+detect_renames = False
+
 # Whether to use "new-style" subdomain addressing for S3 buckets. Such
 # use is not backwards-compatible with upper-case buckets, or buckets
 # that are otherwise not expressable in a valid hostname.
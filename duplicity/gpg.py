@@ -29,15 +29,18 @@ import os, types, tempfile, re, gzip
 
 from duplicity import misc
 from duplicity import globals
+from duplicity import dup_threading
 from duplicity import gpginterface
 from duplicity import tempdir
 
 try:
     from hashlib import sha1
     from hashlib import md5
+    from hashlib import sha256
 except ImportError:
     from sha import new as sha1
     from md5 import new as md5
+    sha256 = None
 
 blocksize = 256 * 1024
 
@@ -87,7 +90,7 @@ class GPGFile:
     """
     File-like object that encrypts decrypts another file on the fly
     """
-    def __init__(self, encrypt, encrypt_path, profile):
+    def __init__(self, encrypt, encrypt_path, profile, hashes = None):
         """
         GPGFile initializer
 
@@ -99,6 +102,10 @@ class GPGFile:
 
         If passphrase is false, do not set passphrase - GPG program
         should prompt for it.
+
+        When encrypting, hashes may be a dictionary of hash objects
+        (see new_hash), which are updated with the encrypted data as
+        it is written to encrypt_path.
         """
         self.status_fp = None # used to find signature
         self.closed = None # set to true after file closed
@@ -106,6 +113,9 @@ class GPGFile:
         self.stderr_fp = tempfile.TemporaryFile( dir=tempdir.default().dir() )
         self.name = encrypt_path
         self.byte_count = 0
+        self.hashes = hashes
+        self.output_thread = None # copies gpg output when hashing
+        self.output_error = None
 
         # Start GPG process - copied from GnuPGInterface docstring.
         gnupg = gpginterface.GnuPG()
@@ -149,14 +159,27 @@ class GPGFile:
                 gnupg_fhs = ['stdin',]
             else:
                 gnupg_fhs = ['stdin','passphrase']
+            attach_fhs = {'stderr': self.stderr_fp,
+                          'logger': self.logger_fp}
+            if hashes and dup_threading.threading_supported():
+                # gpg output goes through a thread that hashes it;
+                # unbuffered, so GPGWriteFile sees the size on disk
+                gnupg_fhs.append('stdout')
+                self.output_fp = open(encrypt_path.name, "wb", 0)
+            else:
+                attach_fhs['stdout'] = encrypt_path.open("wb")
             p1 = gnupg.run(cmdlist, create_fhs=gnupg_fhs,
-                           attach_fhs={'stdout': encrypt_path.open("wb"),
-                                       'stderr': self.stderr_fp,
-                                       'logger': self.logger_fp})
+                           attach_fhs=attach_fhs)
             if not(globals.use_agent):
                 p1.handles['passphrase'].write(passphrase)
                 p1.handles['passphrase'].close()
             self.gpg_input = p1.handles['stdin']
+            if 'stdout' in p1.handles:
+                self.gpg_output = p1.handles['stdout']
+                threading = dup_threading.threading_module()
+                self.output_thread = threading.Thread(target = self.copy_output)
+                self.output_thread.setDaemon(True)
+                self.output_thread.start()
         else:
             if (profile.recipients or profile.hidden_recipients) and profile.encrypt_secring:
                 cmdlist.append('--secret-keyring')
@@ -191,8 +214,7 @@ class GPGFile:
     def write(self, buf):
         try:
             res = self.gpg_input.write(buf)
-            if res is not None:
-                self.byte_count += len(res)
+            self.byte_count += len(buf)
         except Exception:
             self.gpg_failed()
         return res
@@ -200,6 +222,31 @@ class GPGFile:
     def tell(self):
         return self.byte_count
 
+    def copy_output(self):
+        """
+        Copy gpg output to the encrypted file, updating the hashes
+
+        Runs in its own thread while encrypting.  All of the output is
+        read even after an error, so gpg never blocks on a full pipe.
+        """
+        fd = self.gpg_output.fileno()
+        try:
+            while 1:
+                buf = os.read(fd, blocksize)
+                if not buf:
+                    break
+                if self.output_error:
+                    continue
+                try:
+                    for hash_obj in self.hashes.values():
+                        hash_obj.update(buf)
+                    self.output_fp.write(buf)
+                except Exception, e:
+                    self.output_error = e
+        except Exception, e:
+            self.output_error = e
+        self.gpg_output.close()
+
     def seek(self, offset):
         assert not self.encrypt
         assert offset >= self.byte_count, "%d < %d" % (offset, self.byte_count)
@@ -225,12 +272,21 @@ class GPGFile:
                 self.gpg_input.close()
             except Exception:
                 self.gpg_failed()
+            if self.output_thread:
+                self.output_thread.join()
+                if self.output_fp.close() and not self.output_error:
+                    self.output_error = GPGError("Error closing %s" % (self.name.name,))
             if self.status_fp:
                 self.set_signature()
             try:
                 self.gpg_process.wait()
             except Exception:
                 self.gpg_failed()
+            if self.output_error:
+                raise GPGError("Error writing %s: %s" % (self.name.name, self.output_error))
+            if self.hashes and not self.output_thread:
+                # no threads, so hash the file after the fact
+                hash_file(self.hashes, self.name)
         else:
             res = 1
             while res:
@@ -280,7 +336,8 @@ class GPGFile:
 
 def GPGWriteFile(block_iter, filename, profile,
                  size = 200 * 1024 * 1024,
-                 max_footer_size = 16 * 1024):
+                 max_footer_size = 16 * 1024,
+                 hashes = None):
     """
     Write GPG compressed file of given size
 
@@ -298,6 +355,10 @@ def GPGWriteFile(block_iter, filename, profile,
     bytes_in bytes into gpg will result in bytes_out = bytes_in out.
     However, do assume that bytes_out <= bytes_in approximately.
 
+    If hashes is given, it is a dictionary of hash objects (see
+    new_hash) to update with the output, so the file need not be read
+    again to hash it.
+
     Returns true if succeeded in writing until end of block_iter.
     """
 
@@ -308,25 +369,35 @@ def GPGWriteFile(block_iter, filename, profile,
         """
         Add bytes of incompressible data to to_gpg_fp
 
-        In this case we take the incompressible data from the
-        beginning of filename (it should contain enough because size
-        >> largest block size).
+        Random data is used, so the output file does not have to be
+        reopened and read back.
         """
-        incompressible_fp = open(filename, "rb")
-        assert misc.copyfileobj(incompressible_fp, file.gpg_input, bytes) == bytes
-        incompressible_fp.close()
+        while bytes > 0:
+            buf = os.urandom(min(bytes, blocksize))
+            file.write(buf)
+            bytes -= len(buf)
 
     def get_current_size():
         return os.stat(filename).st_size
 
     target_size = size - 50 * 1024 # fudge factor, compensate for gpg buffering
     data_size = target_size - max_footer_size
-    file = GPGFile(True, path.Path(filename), profile)
+    file = GPGFile(True, path.Path(filename), profile, hashes)
     at_end_of_blockiter = 0
+
+    # Since bytes_out <= bytes_in, the size at the last stat plus the
+    # bytes written to gpg since then bounds the current size.  Only
+    # stat filename again when that bound says the volume may be full.
+    stat_size = 0
+    stat_byte_count = 0
     while True:
-        bytes_to_go = data_size - get_current_size()
+        bytes_to_go = data_size - (stat_size + file.byte_count - stat_byte_count)
         if bytes_to_go < block_iter.get_read_size():
-            break
+            stat_size = get_current_size()
+            stat_byte_count = file.byte_count
+            bytes_to_go = data_size - stat_size
+            if bytes_to_go < block_iter.get_read_size():
+                break
         try:
             data = block_iter.next().data
         except StopIteration:
@@ -346,7 +417,8 @@ def GPGWriteFile(block_iter, filename, profile,
 
 def GzipWriteFile(block_iter, filename,
                   size = 200 * 1024 * 1024,
-                  max_footer_size = 16 * 1024):
+                  max_footer_size = 16 * 1024,
+                  hashes = None):
     """
     Write gzipped compressed file of given size
 
@@ -355,24 +427,11 @@ def GzipWriteFile(block_iter, filename,
     place, because it doesn't deal with GPG at all, but it is very
     similar to GPGWriteFile so they might as well be defined together.
 
-    The input requirements on block_iter and the output is the same as
-    GPGWriteFile (returns true if wrote until end of block_iter).
+    The input requirements on block_iter, hashes, and the output are
+    the same as GPGWriteFile (returns true if wrote until end of
+    block_iter).
     """
-    class FileCounted:
-        """
-        Wrapper around file object that counts number of bytes written
-        """
-        def __init__(self, fileobj):
-            self.fileobj = fileobj
-            self.byte_count = 0
-        def write(self, buf):
-            result = self.fileobj.write(buf)
-            self.byte_count += len(buf)
-            return result
-        def close(self):
-            return self.fileobj.close()
-
-    file_counted = FileCounted(open(filename, "wb"))
+    file_counted = FileCounted(open(filename, "wb"), hashes)
     gzip_file = gzip.GzipFile(None, "wb", 6, file_counted)
     at_end_of_blockiter = 0
     while True:
@@ -390,28 +449,104 @@ def GzipWriteFile(block_iter, filename,
     return at_end_of_blockiter
 
 
-def get_hash(hash, path, hex = 1):
+def GPGCopyFile(fileobj, filename, profile, hashes = None):
     """
-    Return hash of path
+    Write all of fileobj to filename, encrypted with profile
 
-    hash should be "MD5" or "SHA1".  The output will be in hexadecimal
-    form if hex is true, and in text (base64) otherwise.
+    Unlike GPGWriteFile, this makes no attempt to reach a given size.
+    It is used by the parallel volume builders, where the volume
+    boundary has already been chosen on the uncompressed tar stream.
+    hashes is as for GPGWriteFile.
+    """
+    # workaround for circular module imports
+    from duplicity import path
+
+    file = GPGFile(True, path.Path(filename), profile, hashes)
+    misc.copyfileobj(fileobj, file)
+    file.close()
+
+
+def GzipCopyFile(fileobj, filename, hashes = None):
+    """
+    Write all of fileobj to filename, gzip compressed
+
+    This is the gzip counterpart of GPGCopyFile.
+    """
+    outfp = FileCounted(open(filename, "wb"), hashes)
+    gzip_file = gzip.GzipFile(None, "wb", 6, outfp)
+    misc.copyfileobj(fileobj, gzip_file)
+    assert not gzip_file.close() and not outfp.close()
+
+
+class FileCounted:
+    """
+    Wrapper around file object that counts number of bytes written
+
+    If hashes is given, its hash objects are updated with the data.
+    """
+    def __init__(self, fileobj, hashes = None):
+        self.fileobj = fileobj
+        self.byte_count = 0
+        self.hashes = hashes
+    def write(self, buf):
+        result = self.fileobj.write(buf)
+        self.byte_count += len(buf)
+        if self.hashes:
+            for hash_obj in self.hashes.values():
+                hash_obj.update(buf)
+        return result
+    def close(self):
+        return self.fileobj.close()
+
+
+def new_hash(hash):
+    """
+    Return new hash object for hash: "MD5", "SHA1", or "SHA256"
     """
-    #assert path.isreg()
-    fp = path.open("rb")
     if hash == "SHA1":
-        hash_obj = sha1()
+        return sha1()
     elif hash == "MD5":
-        hash_obj = md5()
+        return md5()
+    elif hash == "SHA256" and sha256:
+        return sha256()
     else:
         assert 0, "Unknown hash %s" % (hash,)
 
+
+def new_hashes(hash_names):
+    """
+    Return dictionary of new hash objects, keyed by hash name
+    """
+    hashes = {}
+    for hash_name in hash_names:
+        hashes[hash_name] = new_hash(hash_name)
+    return hashes
+
+
+def hash_file(hashes, path):
+    """
+    Update the hash objects in dictionary hashes with the data of path
+    """
+    fp = path.open("rb")
     while 1:
         buf = fp.read(blocksize)
         if not buf:
             break
-        hash_obj.update(buf)
+        for hash_obj in hashes.values():
+            hash_obj.update(buf)
     assert not fp.close()
+
+
+def get_hash(hash, path, hex = 1):
+    """
+    Return hash of path
+
+    hash should be "MD5", "SHA1" or "SHA256".  The output will be in
+    hexadecimal form if hex is true, and in text (base64) otherwise.
+    """
+    #assert path.isreg()
+    hash_obj = new_hash(hash)
+    hash_file({hash: hash_obj}, path)
     if hex:
         return hash_obj.hexdigest()
     else:
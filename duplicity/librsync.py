@@ -27,10 +27,22 @@ which is written in C.  The goal was to use C as little as possible...
 """
 
 import _librsync
-import types, array
+import types, array, bisect, struct, cStringIO
 
 blocksize = _librsync.RS_JOB_BLOCKSIZE
 
+# Bytes of input given to each cycle of the makers of _librsync, and
+# size of the buffer they write their output to.  They run without
+# the GIL, so larger cycles let more of the work run in parallel.
+cycle_size = 4 * blocksize
+
+# Deltas start with this magic number, followed by commands, see
+# prototab.h of librsync.  Each command is an opcode byte followed by
+# big-endian integers of 1, 2, 4 or 8 bytes.
+delta_magic = "rs\x026"
+_int_formats = {1: ">B", 2: ">H", 4: ">I", 8: ">Q"}
+_int_sizes = (1, 2, 4, 8)
+
 class librsyncError(Exception):
     """Signifies error in internal librsync processing (bad signature, etc.)
 
@@ -58,6 +70,7 @@ class LikeFile:
         self.closed = self.infile_closed = None
         self.inbuf = ""
         self.outbuf = array.array('c')
+        self.cyclebuf = None # output buffer of the maker, see new_cyclebuf
         self.eof = self.infile_eof = None
 
     def check_file(self, file, need_seek = None):
@@ -69,6 +82,19 @@ class LikeFile:
         if need_seek and not hasattr(file, "seek"):
             raise TypeError("Basis file must have a seek() method")
 
+    def new_cyclebuf(self):
+        """Return buffer for the output of a maker of _librsync
+
+        The maker writes to it directly, instead of returning a new
+        string each cycle.  Returns None before Python 2.6, which has
+        no bytearray to lend.
+
+        """
+        try:
+            return bytearray(cycle_size)
+        except NameError:
+            return None
+
     def read(self, length = -1):
         """Build up self.outbuf, return first length bytes"""
         if length == -1:
@@ -89,17 +115,27 @@ class LikeFile:
         if not self.infile_eof:
             self._add_to_inbuf()
         try:
-            self.eof, len_inbuf_read, cycle_out = self.maker.cycle(self.inbuf)
+            if self.cyclebuf is None:
+                self.eof, len_inbuf_read, cycle_out = \
+                          self.maker.cycle(self.inbuf)
+            else:
+                self.eof, len_inbuf_read, len_out = \
+                          self.maker.cycle(self.inbuf, self.cyclebuf)
+                cycle_out = buffer(self.cyclebuf, 0, len_out)
         except _librsync.librsyncError, e:
             raise librsyncError(str(e))
         self.inbuf = self.inbuf[len_inbuf_read:]
         self.outbuf.fromstring(cycle_out)
 
     def _add_to_inbuf(self):
-        """Make sure len(self.inbuf) >= blocksize"""
+        """Make sure len(self.inbuf) >= blocksize, or cycle_size"""
         assert not self.infile_eof
-        while len(self.inbuf) < blocksize:
-            new_in = self.infile.read(blocksize)
+        if self.cyclebuf is None:
+            size = blocksize
+        else:
+            size = cycle_size
+        while len(self.inbuf) < size:
+            new_in = self.infile.read(size)
             if not new_in:
                 self.infile_eof = 1
                 assert not self.infile.close()
@@ -128,6 +164,7 @@ class SigFile(LikeFile):
             self.maker = _librsync.new_sigmaker(blocksize)
         except _librsync.librsyncError, e:
             raise librsyncError(str(e))
+        self.cyclebuf = self.new_cyclebuf()
 
 class DeltaFile(LikeFile):
     """File-like object which incrementally generates a librsync delta"""
@@ -150,6 +187,7 @@ class DeltaFile(LikeFile):
             self.maker = _librsync.new_deltamaker(sig_string)
         except _librsync.librsyncError, e:
             raise librsyncError(str(e))
+        self.cyclebuf = self.new_cyclebuf()
 
 
 class PatchedFile(LikeFile):
@@ -158,17 +196,288 @@ class PatchedFile(LikeFile):
         """PatchedFile initializer - call with basis delta
 
         Here basis_file must be a true Python file, because we may
-        need to seek() around in it a lot, and this is done in C.
-        delta_file only needs read() and close() methods.
+        need to seek() around in it a lot, and this is done in C.  It
+        can also be a string holding the whole basis, which is then
+        patched by a PatchMaker.  delta_file only needs read() and
+        close() methods.
 
         """
         LikeFile.__init__(self, delta_file)
+        if type(basis_file) is types.StringType:
+            self.maker = PatchMaker(basis_file)
+            return
         if type(basis_file) is not types.FileType:
-            raise TypeError("basis_file must be a (true) file")
+            raise TypeError("basis_file must be a (true) file or a string")
         try:
             self.maker = _librsync.new_patchmaker(basis_file)
         except _librsync.librsyncError, e:
             raise librsyncError(str(e))
+        self.cyclebuf = self.new_cyclebuf()
+
+
+class PatchMaker:
+    """Apply a delta to a basis held in a string
+
+    Works like the patch maker of _librsync, with the same cycle()
+    method, but the basis does not have to be written to a file first.
+    Copies from the basis are returned at most blocksize bytes at a
+    time.
+
+    """
+    def __init__(self, basis):
+        """PatchMaker initializer - call with basis string"""
+        self.basis = basis
+        self.got_magic = None
+        self.done = None
+        self.literal_left = 0 # bytes of literal command still to read
+        self.copy_pos = self.copy_left = 0 # rest of copy command
+
+    def cycle(self, inbuf):
+        """Patch from inbuf, return (done, bytes_used, patched_string)"""
+        pos, outlen, out = 0, 0, []
+        while not self.done and outlen < blocksize:
+            if self.copy_left:
+                length = min(self.copy_left, blocksize - outlen)
+                data = self.basis[self.copy_pos:self.copy_pos + length]
+                if len(data) != length:
+                    raise librsyncError("Delta copies past end of basis")
+                self.copy_pos += length
+                self.copy_left -= length
+            elif self.literal_left:
+                data = inbuf[pos:pos + min(self.literal_left,
+                                           blocksize - outlen)]
+                if not data:
+                    break
+                pos += len(data)
+                self.literal_left -= len(data)
+            else:
+                used = self.read_command(inbuf, pos)
+                if not used:
+                    break
+                pos += used
+                continue
+            out.append(data)
+            outlen += len(data)
+        if not self.done and not pos and not out:
+            # LikeFile gives us at least blocksize bytes until the delta
+            # file runs out, so a cycle that can't move means the delta
+            # ends in the middle of a command
+            raise librsyncError("Unexpected end of delta")
+        return (self.done, pos, "".join(out))
+
+    def read_command(self, inbuf, pos):
+        """Read delta command at pos of inbuf, return bytes used
+
+        0 is returned if inbuf does not hold the whole command yet.
+
+        """
+        if not self.got_magic:
+            if len(inbuf) - pos < len(delta_magic):
+                return 0
+            if inbuf[pos:pos + len(delta_magic)] != delta_magic:
+                raise librsyncError("Bad delta magic number")
+            self.got_magic = 1
+            return len(delta_magic)
+        command = parse_command(inbuf, pos)
+        if not command:
+            return 0
+        used, kind, first, second = command
+        if kind == "end":
+            self.done = 1
+        elif kind == "literal":
+            self.literal_left = first
+        else:
+            self.copy_pos, self.copy_left = first, second
+        return used
+
+
+def parse_command(buf, pos):
+    """Parse delta command at pos of buf (after the magic number)
+
+    Returns (bytes used, kind, first, second) where kind is "end",
+    "literal" with the length of the data following as first, or
+    "copy" with the start and length in the basis as first and
+    second.  None is returned if buf does not hold the whole command.
+
+    """
+    if pos >= len(buf):
+        return None
+    op = ord(buf[pos])
+    if op == 0:
+        return (1, "end", None, None)
+    elif op <= 0x40:
+        return (1, "literal", op, None)
+    elif op <= 0x44:
+        sizes = (_int_sizes[op - 0x41],)
+    elif op <= 0x54:
+        sizes = (_int_sizes[(op - 0x45) // 4], _int_sizes[(op - 0x45) % 4])
+    else:
+        raise librsyncError("Bad delta command %#x" % (op,))
+    used = 1 + sum(sizes)
+    if len(buf) - pos < used:
+        return None
+    values, argpos = [], pos + 1
+    for size in sizes:
+        values.append(struct.unpack(_int_formats[size],
+                                    buf[argpos:argpos + size])[0])
+        argpos += size
+    if len(values) == 1:
+        return (used, "literal", values[0], None)
+    return (used, "copy", values[0], values[1])
+
+
+def delta_commands(delta_file):
+    """Yield commands of the delta read from delta_file, then close it
+
+    Copies are yielded as (start, length) in the basis, and the data
+    of literals as (None, data), in pieces of at most blocksize bytes.
+
+    """
+    buf, pos, eof = "", 0, None
+    def fill(buf, pos):
+        """Return rest of buf from pos with more data from delta_file"""
+        new_in = delta_file.read(blocksize)
+        return buf[pos:] + new_in, 0, not new_in
+
+    while len(buf) < len(delta_magic) and not eof:
+        buf, pos, eof = fill(buf, pos)
+    if buf[:len(delta_magic)] != delta_magic:
+        raise librsyncError("Bad delta magic number")
+    pos = len(delta_magic)
+    while 1:
+        command = parse_command(buf, pos)
+        if not command:
+            if eof:
+                raise librsyncError("Unexpected end of delta")
+            buf, pos, eof = fill(buf, pos)
+            continue
+        used, kind, first, second = command
+        pos += used
+        if kind == "end":
+            break
+        elif kind == "copy":
+            yield (first, second)
+            continue
+        while first:
+            if pos >= len(buf):
+                if eof:
+                    raise librsyncError("Unexpected end of delta")
+                buf, pos, eof = fill(buf, pos)
+                continue
+            data = buf[pos:pos + min(first, blocksize)]
+            pos += len(data)
+            first -= len(data)
+            yield (None, data)
+    assert not delta_file.close()
+
+
+class ComposedDelta:
+    """Chain of deltas merged into one delta against the first basis
+
+    Deltas are added in patch order, each against the result of the
+    ones before.  A copy from that result is replaced by the commands
+    of the earlier deltas which made the bytes copied, so in the end
+    every command copies from the first basis or adds literal data.
+    Literal data is kept in literal_file, which must be seekable.
+
+    """
+    def __init__(self, literal_file):
+        """ComposedDelta initializer"""
+        self.literal_file = literal_file
+        self.literal_size = 0
+        self.starts = None # position of each command in the result
+        self.commands = None # [is_literal, offset, length] of each command
+
+    def add(self, delta_file):
+        """Add delta read from delta_file, which is closed"""
+        starts, commands = [], []
+        result_size = [0]
+        def output(is_literal, offset, length):
+            """Add command to new lists, merging with the last one"""
+            if not length:
+                return
+            if commands:
+                last = commands[-1]
+                if (last[0] == is_literal and
+                    last[1] + last[2] == offset):
+                    last[2] += length
+                    result_size[0] += length
+                    return
+            starts.append(result_size[0])
+            commands.append([is_literal, offset, length])
+            result_size[0] += length
+
+        for start, data in delta_commands(delta_file):
+            if start is None:
+                self.literal_file.seek(self.literal_size)
+                self.literal_file.write(data)
+                output(True, self.literal_size, len(data))
+                self.literal_size += len(data)
+            elif self.commands is None:
+                output(False, start, data)
+            else:
+                self.copy_result(start, data, output)
+        self.starts, self.commands = starts, commands
+
+    def copy_result(self, start, length, output):
+        """Output commands making length bytes of result from start"""
+        i = bisect.bisect_right(self.starts, start) - 1
+        while length:
+            if i < 0 or i >= len(self.commands):
+                raise librsyncError("Delta copies past end of basis")
+            is_literal, offset, command_length = self.commands[i]
+            skip = start - self.starts[i]
+            size = min(command_length - skip, length)
+            output(is_literal, offset + skip, size)
+            start += size
+            length -= size
+            i += 1
+
+
+class ComposedPatchedFile:
+    """File-like object applying a ComposedDelta to its basis
+
+    The basis can be a string or a file object that can seek().
+
+    """
+    def __init__(self, basis, composed):
+        """ComposedPatchedFile initializer"""
+        if type(basis) is types.StringType:
+            basis = cStringIO.StringIO(basis)
+        self.basis = basis
+        self.composed = composed
+        self.index = 0 # of next command
+        self.done = 0 # bytes of that command already read
+
+    def read(self, length = -1):
+        """Return next length bytes of the result"""
+        commands = self.composed.commands or []
+        result, size = [], 0
+        while self.index < len(commands) and (length < 0 or size < length):
+            is_literal, offset, command_length = commands[self.index]
+            count = command_length - self.done
+            if length >= 0:
+                count = min(count, length - size)
+            if is_literal:
+                fp = self.composed.literal_file
+            else:
+                fp = self.basis
+            fp.seek(offset + self.done)
+            data = fp.read(count)
+            if len(data) != count:
+                raise librsyncError("Delta copies past end of basis")
+            result.append(data)
+            size += count
+            self.done += count
+            if self.done == command_length:
+                self.index += 1
+                self.done = 0
+        return "".join(result)
+
+    def close(self):
+        """Close basis and literal file"""
+        if self.basis.close() or self.composed.literal_file.close():
+            raise librsyncError("Error closing file object")
 
 
 class SigGenerator:
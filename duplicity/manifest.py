@@ -25,6 +25,7 @@ import re
 
 from duplicity import log
 from duplicity import globals
+from duplicity import gpg
 from duplicity import util
 
 class ManifestError(Exception):
@@ -50,7 +51,9 @@ class Manifest:
         """
         self.hostname = None
         self.local_dirname = None
+        self.dedup = None
         self.volume_info_dict = {} # dictionary vol numbers -> vol infos
+        self.volume_ranges = None # see get_volume_ranges()
         self.fh = fh
 
     def set_dirinfo(self):
@@ -62,12 +65,17 @@ class Manifest:
         @return: manifest
         """
         self.hostname = globals.hostname
-        self.local_dirname = globals.local_path.name #@UndefinedVariable
+        if globals.local_path:
+            self.local_dirname = globals.local_path.name #@UndefinedVariable
+        if globals.dedup:
+            self.dedup = "1"
         if self.fh:
             if self.hostname:
                 self.fh.write("Hostname %s\n" % self.hostname)
             if self.local_dirname:
                 self.fh.write("Localdir %s\n" % Quote(self.local_dirname))
+            if self.dedup:
+                self.fh.write("Dedup %s\n" % self.dedup)
         return self
 
     def check_dirinfo(self):
@@ -118,6 +126,7 @@ class Manifest:
         """
         vol_num = vi.volume_number
         self.volume_info_dict[vol_num] = vi
+        self.volume_ranges = None
         if self.fh:
             self.fh.write(vi.to_string() + "\n")
 
@@ -134,6 +143,7 @@ class Manifest:
             del self.volume_info_dict[vol_num]
         except Exception:
             raise ManifestError("Volume %d not present in manifest" % (vol_num,))
+        self.volume_ranges = None
 
     def to_string(self):
         """
@@ -147,6 +157,8 @@ class Manifest:
             result += "Hostname %s\n" % self.hostname
         if self.local_dirname:
             result += "Localdir %s\n" % Quote(self.local_dirname)
+        if self.dedup:
+            result += "Dedup %s\n" % self.dedup
 
         vol_num_list = self.volume_info_dict.keys()
         vol_num_list.sort()
@@ -173,6 +185,7 @@ class Manifest:
                 return Unquote(m.group(2))
         self.hostname = get_field("hostname")
         self.local_dirname = get_field("localdir")
+        self.dedup = get_field("dedup")
 
         next_vi_string_regexp = re.compile("(^|\\n)(volume\\s.*?)"
                                            "(\\nvolume\\s|$)", re.I | re.S)
@@ -226,13 +239,63 @@ class Manifest:
         assert not fout.close()
         path.setdata()
 
+    def get_volume_ranges(self):
+        """
+        Return sorted list of volume infos, or None if out of order
+
+        Volumes are written in index order, so both the starting and
+        the ending indicies never decrease from one volume to the next.
+        That is checked here, because get_containing_volumes relies on
+        it.  The result is cached until volumes are added or removed.
+        """
+        if self.volume_ranges is None:
+            vol_num_list = self.volume_info_dict.keys()
+            vol_num_list.sort()
+            vi_list = map(lambda vol_num: self.volume_info_dict[vol_num],
+                          vol_num_list)
+            for i in range(1, len(vi_list)):
+                if (vi_list[i].start_index < vi_list[i - 1].start_index or
+                    vi_list[i].end_index < vi_list[i - 1].end_index):
+                    log.Warn(_("Volumes of manifest not in index order"))
+                    vi_list = False
+                    break
+            self.volume_ranges = vi_list
+        return self.volume_ranges or None
+
     def get_containing_volumes(self, index_prefix):
         """
-        Return list of volume numbers that may contain index_prefix
-        """
-        return filter(lambda vol_num:
-                      self.volume_info_dict[vol_num].contains(index_prefix),
-                      self.volume_info_dict.keys())
+        Return sorted list of volume numbers that may contain index_prefix
+
+        The volumes which may contain index_prefix (see
+        VolumeInfo.contains) form a single run, whose ends are found by
+        binary search: the first volume ending at or after index_prefix,
+        and the last one starting at or before it.
+        """
+        vi_list = self.get_volume_ranges()
+        if vi_list is None:
+            vol_num_list = filter(lambda vol_num:
+                                  self.volume_info_dict[vol_num].contains(index_prefix),
+                                  self.volume_info_dict.keys())
+            vol_num_list.sort()
+            return vol_num_list
+
+        prefix_len = len(index_prefix)
+        lo, hi = 0, len(vi_list)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if vi_list[mid].end_index < index_prefix:
+                lo = mid + 1
+            else:
+                hi = mid
+        first = lo
+        lo, hi = first, len(vi_list)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if vi_list[mid].start_index[:prefix_len] <= index_prefix:
+                lo = mid + 1
+            else:
+                hi = mid
+        return map(lambda vi: vi.volume_number, vi_list[first:lo])
 
 
 class VolumeInfoError(Exception):
@@ -283,11 +346,14 @@ class VolumeInfo:
         """
         Return pair (hash_type, hash_data)
 
-        SHA1 is the best hash, and MD5 is the second best hash.  None
-        is returned if no hash is available.
+        SHA256 is the best hash, then SHA1, and MD5 is the worst hash.
+        SHA256 is skipped if this Python cannot compute it.  None is
+        returned if no hash is available.
         """
         if not self.hashes:
             return None
+        if gpg.sha256 and 'SHA256' in self.hashes:
+            return ("SHA256", self.hashes['SHA256'])
         try:
             return ("SHA1", self.hashes['SHA1'])
         except KeyError:
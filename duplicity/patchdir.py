@@ -23,12 +23,17 @@ import re #@UnusedImport
 import types
 import os
 import tempfile
+import cStringIO
 
 from duplicity import tarfile #@UnusedImport
+from duplicity import asyncscheduler
 from duplicity import librsync #@UnusedImport
+from duplicity import dedup
+from duplicity import dup_temp
 from duplicity import log #@UnusedImport
 from duplicity import diffdir
 from duplicity import misc
+from duplicity import robust
 from duplicity import selection
 from duplicity import tempdir
 from duplicity import util #@UnusedImport
@@ -58,6 +63,10 @@ def patch_diff_tarfile( base_path, diff_tarfile, restrict_index=() ):
     If restrict_index is set, ignore any deltas in diff_tarfile that
     don't start with restrict_index.
 
+    Files in base_path that are deleted or patched over are first
+    renamed out of the way, so later "moved" entries can still use
+    them as their basis.  They are removed at the end.
+
     """
     if base_path.exists():
         path_iter = selection.Select( base_path ).set_iter()
@@ -69,7 +78,8 @@ def patch_diff_tarfile( base_path, diff_tarfile, restrict_index=() ):
         diff_path_iter = filter_path_iter( diff_path_iter, restrict_index )
     collated = diffdir.collate2iters( path_iter, diff_path_iter )
 
-    ITR = IterTreeReducer( PathPatcher, [base_path] )
+    held = {}
+    ITR = IterTreeReducer( PathPatcher, [base_path, held] )
     for basis_path, diff_ropath in collated:
         if basis_path:
             log.Info( _( "Patching %s" ) % ( basis_path.get_relative_path(), ),
@@ -82,17 +92,33 @@ def patch_diff_tarfile( base_path, diff_tarfile, restrict_index=() ):
                      util.escape( diff_ropath.get_relative_path() ) )
             ITR( diff_ropath.index, basis_path, diff_ropath )
     ITR.Finish()
+    delete_held( held )
     base_path.setdata()
 
+def delete_held( held ):
+    """Delete the paths PathPatcher put aside, keeping parent dir mtimes"""
+    for held_path in held.values():
+        parent_dir = held_path.get_parent_dir()
+        held_path.setdata()
+        if held_path.isdir():
+            held_path.deltree()
+        else:
+            held_path.delete()
+        if parent_dir.exists():
+            os.utime( parent_dir.name,
+                      ( parent_dir.stat.st_atime, parent_dir.stat.st_mtime ) )
+
 def empty_iter():
     if 0:
         yield 1 # this never happens, but fools into generator treatment
 
-def filter_path_iter( path_iter, index ):
+def filter_path_iter( path_iter, index, at_end=None ):
     """Rewrite path elements of path_iter so they start with index
 
     Discard any that doesn't start with index, and remove the index
-    prefix from the rest.
+    prefix from the rest.  Since path_iter is in index order, stop
+    once past index.  at_end is then called if given, to close what
+    path_iter reads from (see TarFile_FromFileobjs.close).
 
     """
     assert isinstance( index, tuple ) and index, index
@@ -101,6 +127,10 @@ def filter_path_iter( path_iter, index ):
         if path.index[:l] == index:
             path.index = path.index[l:]
             yield path
+        elif path.index[:l] > index:
+            break
+    if at_end:
+        at_end()
 
 def difftar2path_iter( diff_tarfile ):
     """Turn file-like difftarobj into iterator of ROPaths"""
@@ -126,7 +156,9 @@ def difftar2path_iter( diff_tarfile ):
         ropath.difftype = difftype
         if difftype == "deleted":
             ropath.type = None
-        elif ropath.isreg():
+        elif difftype == "moved":
+            ropath.moved_from = get_moved_from( tarinfo_list[0] )
+        if ropath.isreg():
             if multivol:
                 multivol_fileobj = Multivol_Filelike( diff_tarfile, tar_iter,
                                                      tarinfo_list, index )
@@ -140,19 +172,17 @@ def difftar2path_iter( diff_tarfile ):
 
 def get_index_from_tarinfo( tarinfo ):
     """Return (index, difftype, multivol) pair from tarinfo object"""
-    for prefix in ["snapshot/", "diff/", "deleted/",
-                   "multivol_diff/", "multivol_snapshot/"]:
+    for prefix in ["snapshot/", "diff/", "deleted/", "moved/", "chunked/",
+                   "multivol_diff/", "multivol_snapshot/", "multivol_moved/",
+                   "multivol_chunked/"]:
         tiname = util.get_tarinfo_name( tarinfo )
         if tiname.startswith( prefix ):
             name = tiname[len( prefix ):] # strip prefix
             if prefix.startswith( "multivol" ):
-                if prefix == "multivol_diff/":
-                    difftype = "diff"
-                else:
-                    difftype = "snapshot"
+                difftype = prefix[len( "multivol_" ):-1]
                 multivol = 1
                 name, num_subs = \
-                      re.subn( "(?s)^multivol_(diff|snapshot)/?(.*)/[0-9]+$",
+                      re.subn( "(?s)^multivol_(diff|snapshot|moved|chunked)/?(.*)/[0-9]+$",
                               "\\2", tiname )
                 if num_subs != 1:
                     raise PatchDirException( "Unrecognized diff entry %s" %
@@ -176,6 +206,15 @@ def get_index_from_tarinfo( tarinfo ):
                                     "violation" % ( tiname, ) )
     return ( index, difftype, multivol )
 
+def get_moved_from( tarinfo ):
+    """Return index of the path a "moved" diff entry is a delta against"""
+    index = tuple( tarinfo.linkname.split( "/" ) )
+    if not tarinfo.linkname or '' in index or '.' in index or '..' in index:
+        raise PatchDirException( "Bad source %s of moved entry %s" %
+                                 ( tarinfo.linkname,
+                                   util.get_tarinfo_name( tarinfo ) ) )
+    return index
+
 
 class Multivol_Filelike:
     """Emulate a file like object from multivols
@@ -244,9 +283,15 @@ class Multivol_Filelike:
 
 class PathPatcher( ITRBranch ):
     """Used by DirPatch, process the given basis and diff"""
-    def __init__( self, base_path ):
-        """Set base_path, Path of root of tree"""
+    def __init__( self, base_path, held ):
+        """Set base_path, Path of root of tree
+
+        held is a dictionary of the basis paths put aside so far, by
+        index, shared by all the PathPatchers of the tree.
+
+        """
         self.base_path = base_path
+        self.held = held
         self.dir_diff_ropath = None
 
     def start_process( self, index, basis_path, diff_ropath ):
@@ -261,7 +306,7 @@ class PathPatcher( ITRBranch ):
             assert not basis_path.exists()
             basis_path.mkdir() # Need place for later files to go into
         elif not basis_path.isdir():
-            basis_path.delete()
+            self.hold( basis_path )
             basis_path.mkdir()
         self.dir_basis_path = basis_path
         self.dir_diff_ropath = diff_ropath
@@ -277,28 +322,75 @@ class PathPatcher( ITRBranch ):
 
     def fast_process( self, index, basis_path, diff_ropath ):
         """For use when neither is a directory"""
+        if diff_ropath and diff_ropath.difftype == "chunked":
+            # only chunks stored in this file can be read here
+            fileobj = dedup.decode( diff_ropath.open( "rb" ) )
+            diff_ropath = diff_ropath.get_ropath()
+            diff_ropath.setfileobj( fileobj )
+            diff_ropath.difftype = "snapshot"
         if not diff_ropath:
             return # no change
         elif not basis_path:
             if diff_ropath.difftype == "deleted":
                 pass # already deleted
+            elif diff_ropath.difftype == "moved":
+                self.patch_moved( self.base_path.new_index( index ),
+                                  diff_ropath )
             else:
                 # just copy snapshot over
                 diff_ropath.copy( self.base_path.new_index( index ) )
         elif diff_ropath.difftype == "deleted":
-            if basis_path.isdir():
-                basis_path.deltree()
-            else:
-                basis_path.delete()
-        elif not basis_path.isreg():
-            if basis_path.isdir():
-                basis_path.deltree()
-            else:
-                basis_path.delete()
-            diff_ropath.copy( basis_path )
+            self.hold( basis_path )
+        elif diff_ropath.difftype == "moved":
+            self.hold( basis_path )
+            self.patch_moved( basis_path, diff_ropath )
+        elif diff_ropath.difftype == "diff" and basis_path.isreg():
+            held_path = self.hold( basis_path )
+            self.patch( held_path, basis_path, diff_ropath )
         else:
-            assert diff_ropath.difftype == "diff", diff_ropath.difftype
-            basis_path.patch_with_attribs( diff_ropath )
+            self.hold( basis_path )
+            diff_ropath.copy( basis_path )
+
+    def hold( self, basis_path ):
+        """Rename basis_path out of the way, return its new Path
+
+        Only regular files and directories, which moved files may have
+        been moved from, are kept; anything else is just deleted.
+
+        """
+        if not ( basis_path.isreg() or basis_path.isdir() ):
+            basis_path.delete()
+            return None
+        held_path = basis_path.get_temp_in_same_dir()
+        basis_path.rename( held_path )
+        self.held[basis_path.index] = held_path
+        return held_path
+
+    def get_basis( self, index ):
+        """Return Path of index in the tree as it was before patching"""
+        for i in range( len( index ), 0, -1 ):
+            if index[:i] in self.held:
+                held_path = self.held[index[:i]]
+                return held_path.new_index( held_path.index + index[i:] )
+        return self.base_path.new_index( index )
+
+    def patch_moved( self, new_path, diff_ropath ):
+        """Write new_path by patching the file diff_ropath was moved from"""
+        basis_path = self.get_basis( diff_ropath.moved_from )
+        if not basis_path.isreg():
+            raise PatchDirException( "Basis %s of moved file %s not found" %
+                                     ( "/".join( diff_ropath.moved_from ),
+                                       diff_ropath.get_relative_path() ) )
+        self.patch( basis_path, new_path, diff_ropath )
+
+    def patch( self, basis_path, new_path, diff_ropath ):
+        """Write new_path by applying delta diff_ropath to basis_path"""
+        temp_path = new_path.get_temp_in_same_dir()
+        fp = librsync.PatchedFile( basis_path.open( "rb" ),
+                                   diff_ropath.open( "rb" ) )
+        temp_path.writefileobj( fp )
+        diff_ropath.copy_attribs( temp_path )
+        temp_path.rename( new_path )
 
 
 class TarFile_FromFileobjs:
@@ -321,6 +413,7 @@ class TarFile_FromFileobjs:
         """Set tarfile from next file object, or raise StopIteration"""
         if self.current_fp:
             assert not self.current_fp.close()
+            self.current_fp = None
         self.current_fp = self.fileobj_iter.next()
         self.tarfile = util.make_tarfile("r", self.current_fp)
         self.tar_iter = iter( self.tarfile )
@@ -339,6 +432,17 @@ class TarFile_FromFileobjs:
         """Return data associated with given tarinfo"""
         return self.tarfile.extractfile( tarinfo )
 
+    def close( self ):
+        """Close the file object being read, leaving the next ones unread
+
+        Closing a volume decrypted by gpg still reads the rest of it
+        (see gpg.GPGFile.close), but it is not parsed as tar.
+
+        """
+        if self.current_fp:
+            assert not self.current_fp.close()
+            self.current_fp = None
+
 
 def collate_iters( iter_list ):
     """Collate iterators by index
@@ -457,8 +561,78 @@ def normalize_ps( patch_sequence ):
         i -= 1
     return result_list
 
-def patch_seq2ropath( patch_seq ):
-    """Apply the patches in patch_seq, return single ropath"""
+# Bases and literal data of composed deltas (see patch_seq2ropath) up
+# to this size are kept in memory; larger ones are written to a
+# temporary file.  testing/manual/patchbench.py shows reading them from
+# memory only saves the time to write the temporary file, which is
+# small next to composing and patching.
+basis_memory_size = 1024 * 1024
+
+def get_patch_basis( fileobj ):
+    """Return basis for librsync.ComposedPatchedFile with the data of fileobj
+
+    A real file is used as it is.  Otherwise the data is read into a
+    string if it fits in basis_memory_size, else into a temporary
+    file in the duplicity.tempdir.  fileobj is closed.
+
+    """
+    if isinstance( fileobj, file ):
+        return fileobj
+    data = fileobj.read( basis_memory_size + 1 )
+    if len( data ) <= basis_memory_size:
+        assert not fileobj.close()
+        return data
+    tempfp = tempfile.TemporaryFile( dir=tempdir.default().dir() )
+    tempfp.write( data )
+    del data
+    misc.copyfileobj( fileobj, tempfp )
+    assert not fileobj.close()
+    tempfp.seek( 0 )
+    return tempfp
+
+class SpooledFile:
+    """Seekable file kept in memory until it grows past max_size
+
+    Its data is then moved to a temporary file in the duplicity.tempdir.
+    Data must be written at the end of the file.
+
+    """
+    def __init__( self, max_size ):
+        """SpooledFile initializer"""
+        self.max_size = max_size
+        self.fp = cStringIO.StringIO()
+        self.spilled = None
+
+    def write( self, data ):
+        self.fp.write( data )
+        if not self.spilled and self.fp.tell() > self.max_size:
+            tempfp = tempfile.TemporaryFile( dir=tempdir.default().dir() )
+            tempfp.write( self.fp.getvalue() )
+            self.fp = tempfp
+            self.spilled = 1
+
+    def seek( self, offset ):
+        self.fp.seek( offset )
+
+    def read( self, length=-1 ):
+        return self.fp.read( length )
+
+    def close( self ):
+        return self.fp.close()
+
+def patch_seq2ropath( patch_seq, get_basis=None ):
+    """Apply the patches in patch_seq, return single ropath
+
+    get_basis is called to get the file a moved file was moved from,
+    or which chunks of a chunked file are stored with.  It is a
+    dedup.BasisCache, called with the index of the file and the
+    number of backup sets to restore it from, returning a real file
+    object open for reading.
+
+    A chain of several deltas is merged into a librsync.ComposedDelta,
+    so the file is patched in one pass instead of once per delta.
+
+    """
     first = patch_seq[0]
     assert first.difftype != "diff", patch_seq
     if not first.isreg():
@@ -466,62 +640,148 @@ def patch_seq2ropath( patch_seq ):
         assert len( patch_seq ) == 1, len( patch_seq )
         return first.get_ropath()
 
-    current_file = first.open( "rb" )
+    deltas = list( patch_seq[1:] )
+    if first.difftype == "moved":
+        if not get_basis:
+            raise PatchDirException( "No basis for moved file %s" %
+                                     ( first.get_relative_path(), ) )
+        log.Info( _( "Restoring %s from %s" ) %
+                  ( first.get_relative_path(), "/".join( first.moved_from ) ) )
+        basis_file = get_basis( first.moved_from, first.set_num )
+        deltas.insert( 0, first )
+    elif first.difftype == "chunked":
+        basis_file = dedup.decode( first.open( "rb" ), get_basis )
+    else:
+        basis_file = first.open( "rb" )
 
     for delta_ropath in patch_seq[1:]:
         assert delta_ropath.difftype == "diff", delta_ropath.difftype
-        if not isinstance( current_file, file ):
+    if not deltas:
+        current_file = basis_file
+    elif len( deltas ) == 1:
+        if not isinstance( basis_file, file ):
             """
             librsync insists on a real file object, which we create manually
             by using the duplicity.tempdir to tell us where.
             """
             tempfp = tempfile.TemporaryFile( dir=tempdir.default().dir() )
-            misc.copyfileobj( current_file, tempfp )
-            assert not current_file.close()
+            misc.copyfileobj( basis_file, tempfp )
+            assert not basis_file.close()
             tempfp.seek( 0 )
-            current_file = tempfp
-        current_file = librsync.PatchedFile( current_file,
-                                            delta_ropath.open( "rb" ) )
+            basis_file = tempfp
+        current_file = librsync.PatchedFile( basis_file,
+                                            deltas[0].open( "rb" ) )
+    else:
+        # Merge the deltas, so the file is patched in one pass
+        composed = librsync.ComposedDelta( SpooledFile( basis_memory_size ) )
+        for delta_ropath in deltas:
+            composed.add( delta_ropath.open( "rb" ) )
+        current_file = librsync.ComposedPatchedFile( get_patch_basis( basis_file ),
+                                                    composed )
     result = patch_seq[-1].get_ropath()
     result.setfileobj( current_file )
     return result
 
-def integrate_patch_iters( iter_list ):
+def integrate_patch_iters( iter_list, get_basis=None ):
     """Combine a list of iterators of ropath patches
 
     The iter_list should be sorted in patch order, and the elements in
     each iter_list need to be orderd by index.  The output will be an
-    iterator of the final ROPaths in index order.
+    iterator of the final ROPaths in index order.  For get_basis, see
+    patch_seq2ropath.
 
     """
     collated = collate_iters( iter_list )
     for patch_seq in collated:
-        final_ropath = patch_seq2ropath( normalize_ps( patch_seq ) )
+        for i in range( len( patch_seq ) ):
+            if patch_seq[i]:
+                patch_seq[i].set_num = i
+        final_ropath = patch_seq2ropath( normalize_ps( patch_seq ),
+                                         get_basis )
         if final_ropath.exists():
             # otherwise final patch was delete
             yield final_ropath
 
-def tarfiles2rop_iter( tarfile_list, restrict_index=() ):
+def tarfiles2rop_iter( tarfile_list, restrict_index=(), get_basis=None ):
     """Integrate tarfiles of diffs into single ROPath iter
 
     Then filter out all the diffs in that index which don't start with
-    the restrict_index.
+    the restrict_index.  For get_basis, see patch_seq2ropath.
 
     """
-    diff_iters = map( difftar2path_iter, tarfile_list )
     if restrict_index:
         # Apply filter before integration
-        diff_iters = map( lambda i: filter_path_iter( i, restrict_index ),
-                         diff_iters )
-    return integrate_patch_iters( diff_iters )
+        diff_iters = [ filter_path_iter( difftar2path_iter( tf ),
+                                         restrict_index, tf.close )
+                       for tf in tarfile_list ]
+    else:
+        diff_iters = map( difftar2path_iter, tarfile_list )
+    return integrate_patch_iters( diff_iters, get_basis )
+
+def tarfiles2basis( tarfile_list, index, get_basis=None ):
+    """Restore regular file at index from tarfiles, return its path
+
+    Used to get the file a moved file was moved from, or which chunks
+    are stored with (see patch_seq2ropath).  The file is written to a
+    dup_temp.TempPath, so it can be read while the tarfiles of the
+    restore are.  The tarfiles are closed.
+
+    """
+    temppath = None
+    for ropath in tarfiles2rop_iter( tarfile_list, index, get_basis ):
+        if ropath.index == () and ropath.isreg():
+            fp = ropath.open( "rb" )
+            temppath = dup_temp.new_temppath()
+            tempfp = temppath.open( "wb" )
+            misc.copyfileobj( fp, tempfp )
+            assert not fp.close()
+            assert not tempfp.close()
+            temppath.setdata()
+        break
+    for tf in tarfile_list:
+        tf.close()
+    if not temppath:
+        raise PatchDirException( "Basis file %s not found in archive" %
+                                 ( "/".join( index ), ) )
+    return temppath
+
+def spool_rop_iter( rop_iter ):
+    """Yield ropaths of rop_iter with the real size of regular files
+
+    The size of a patched ropath is the one of its last diff.  The
+    data of regular files is written to a temporary file first, so
+    they can be backed up again like files on disk (see the
+    synthetic-full action).
+
+    """
+    for ropath in rop_iter:
+        if ropath.isreg():
+            fp = ropath.open( "rb" )
+            tempfp = tempfile.TemporaryFile( dir=tempdir.default().dir() )
+            ropath.stat.st_size = misc.copyfileobj( fp, tempfp )
+            assert not fp.close()
+            tempfp.seek( 0 )
+            ropath.fileobj = None
+            ropath.setfileobj( tempfp )
+        yield ropath
+
+# Regular files up to this size are read into memory and written by a
+# restore writer thread; larger ones are written as they are read.
+writer_memory_size = 64 * 1024
 
 def Write_ROPaths( base_path, rop_iter ):
     """Write out ropaths in rop_iter starting at base_path
 
-    Returns 1 if something was actually written, 0 otherwise.
+    Returns 1 if something was actually written, 0 otherwise.  With
+    globals.restore_writers above 1, files are written and their
+    attributes set by that many threads.
 
     """
-    ITR = IterTreeReducer( ROPath_IterWriter, [base_path] )
+    if globals.restore_writers > 1:
+        scheduler = asyncscheduler.AsyncScheduler( globals.restore_writers )
+    else:
+        scheduler = None
+    ITR = IterTreeReducer( ROPath_IterWriter, [base_path, scheduler] )
     return_val = 0
     for ropath in rop_iter:
         return_val = 1
@@ -535,13 +795,18 @@ class ROPath_IterWriter( ITRBranch ):
 
     We need to use an ITR because we have to update the
     permissions/times of directories after we write the files in them.
+    When a scheduler is given, the files of a directory are written by
+    its threads, and are all waited for before the attributes of the
+    directory are set.
 
     """
-    def __init__( self, base_path ):
+    def __init__( self, base_path, scheduler=None ):
         """Set base_path, Path of root of tree"""
         self.base_path = base_path
+        self.scheduler = scheduler
         self.dir_diff_ropath = None
         self.dir_new_path = None
+        self.waiters = []
 
     def start_process( self, index, ropath ):
         """Write ropath.  Only handles the directory case"""
@@ -564,6 +829,8 @@ class ROPath_IterWriter( ITRBranch ):
 
     def end_process( self ):
         """Update information of a directory when leaving it"""
+        while self.waiters:
+            self.waiters.pop( 0 )()
         if self.dir_diff_ropath:
             self.dir_diff_ropath.copy_attribs( self.dir_new_path )
 
@@ -577,5 +844,32 @@ class ROPath_IterWriter( ITRBranch ):
 
     def fast_process( self, index, ropath ):
         """Write non-directory ropath to destination"""
-        if ropath.exists():
-            ropath.copy( self.base_path.new_index( index ) )
+        if not ropath.exists():
+            return
+        new_path = self.base_path.new_index( index )
+        if not self.scheduler:
+            ropath.copy( new_path )
+            return
+
+        # The data must be read before the iterator moves on
+        task = ropath.copy
+        if ropath.isreg():
+            fp = ropath.open( "rb" )
+            data = fp.read( writer_memory_size + 1 )
+            if len( data ) > writer_memory_size:
+                fout = new_path.open( "wb" )
+                fout.write( data )
+                misc.copyfileobj( fp, fout )
+                if fp.close() or fout.close():
+                    raise PatchDirException( "Error closing file object" )
+                task = ropath.copy_attribs
+            else:
+                assert not fp.close()
+                ropath.fileobj = None
+                ropath.setfileobj( cStringIO.StringIO( data ) )
+        self.waiters.append( self.scheduler.schedule_task(
+            robust.check_common_error, ( self.write_error, task, ( new_path, ) ) ) )
+
+    def write_error( self, exc, new_path ):
+        """Log error writing new_path in a writer thread"""
+        self.on_error( exc, new_path.index )
@@ -53,12 +53,16 @@ def check_common_error(error_handler, function, args = ()):
             #Log.exception(1, 2)
             raise
 
-def listpath(path):
-    """Like path.listdir() but return [] if error, and sort results"""
+def listpath(path, listdir = None):
+    """Like path.listdir() but return [] if error, and sort results
+
+    If listdir is given, it is called instead of path.listdir.
+
+    """
     def error_handler(exc):
         log.Warn(_("Error listing directory %s") % path.name)
         return []
-    dir_listing = check_common_error(error_handler, path.listdir)
+    dir_listing = check_common_error(error_handler, listdir or path.listdir)
     dir_listing.sort()
     return dir_listing
 
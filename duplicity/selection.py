@@ -23,11 +23,13 @@ import os #@UnusedImport
 import re #@UnusedImport
 import stat #@UnusedImport
 import sys
+import heapq
 
 from duplicity.path import * #@UnusedWildImport
 from duplicity import log #@Reimport
 from duplicity import globals #@Reimport
 from duplicity import diffdir
+from duplicity import dup_threading
 from duplicity import util #@Reimport
 
 """Iterate exactly the requested files in a directory
@@ -37,6 +39,12 @@ documentation on what this code does can be found on the man page.
 
 """
 
+# Flags of the files in a filelist, see Select.filelist_read
+FILELIST_INCLUDE = 1
+FILELIST_EXCLUDE = 2
+FILELIST_ABOVE = 4
+
+
 class SelectError(Exception):
     """Some error dealing with the Select class"""
     pass
@@ -50,6 +58,280 @@ class GlobbingError(SelectError):
     pass
 
 
+class ScannedDir:
+    """Listing and lstat results of a directory, made by DirScanner
+
+    Errors are kept and raised again when the results are asked for,
+    so they are reported by the consumer, in order, just as if it had
+    done the system calls itself.
+
+    """
+    def __init__(self, path):
+        """Scan directory path now"""
+        self.listdir_exc = None
+        self.dir_listing = []
+        try:
+            self.dir_listing = path.listdir()
+            self.dir_listing.sort()
+        except Exception:
+            self.listdir_exc = sys.exc_info()
+
+        self.entries = {} # filename -> (new_path, exc_info)
+        self.access = {} # new_path.name -> result of os.access
+        self.subdirs = []
+        for filename in self.dir_listing:
+            new_path, exc = None, None
+            try:
+                new_path = Path.append(path, filename)
+                if new_path.type in ["reg", "dir"]:
+                    self.access[new_path.name] = os.access(new_path.name, os.R_OK)
+                if new_path.isdir():
+                    self.subdirs.append(new_path)
+            except Exception:
+                exc = sys.exc_info()
+            self.entries[filename] = (new_path, exc)
+
+    def listdir(self):
+        """Return directory listing, like Path.listdir"""
+        if self.listdir_exc:
+            raise self.listdir_exc[0], self.listdir_exc[1], self.listdir_exc[2]
+        return self.dir_listing[:]
+
+    def append(self, path, filename):
+        """Return Path of filename in directory, like Path.append"""
+        new_path, exc = self.entries[filename]
+        if exc:
+            raise exc[0], exc[1], exc[2]
+        return new_path
+
+    def readable(self, new_path):
+        """Return true if new_path, from append, is read accessible"""
+        return self.access[new_path.name]
+
+
+class NamePath:
+    """Stand-in for the Path of a file in a directory, not stat'ed
+
+    Only index and name are set, which is all the selection functions
+    with f.by_name look at.  Select.Iterate uses it to rule out
+    excluded files without stat'ing them.
+
+    """
+    def __init__(self, path, filename):
+        """Set index and name as Path.append(path, filename) would"""
+        self.index = path.rename_index(path.index + (filename,))
+        self.name = os.path.join(path.base, *self.index)
+
+
+class DirScanner:
+    """Scan directories ahead of Select.Iterate in worker threads
+
+    On network filesystems and large trees, the time taken by listing
+    directories and stat'ing their entries dominates the time spent
+    selecting files.  The workers scan directories in index order,
+    which is the order Select.Iterate descends into them, starting
+    with the subdirectories of the directories already scanned.  No
+    more than max_ahead scanned directories are kept waiting.
+
+    If may_descend is given, subdirectories for which it returns false
+    are not scanned.  Select.Iterate passes Select.may_descend, so
+    directories excluded by name (like /proc or a hung network mount)
+    are never listed.  Other subdirectories are scanned whether or not
+    they turn out to be selected, because the selection functions
+    needing stat data have to be run in order, by the consumer.  Those
+    skipped by the consumer are dropped as it moves past them.
+
+    """
+    def __init__(self, workers, max_ahead = None, may_descend = None):
+        """Start workers threads"""
+        self.max_ahead = max_ahead or 8 * workers
+        self.may_descend = may_descend
+        self.cv = dup_threading.threading_module().Condition()
+        self.todo = [] # heap of (index, path) of directories to scan
+        self.in_progress = {} # index -> True
+        self.done = {} # index -> ScannedDir
+        self.position = () # index of last directory asked for
+        self.stopped = False
+        for i in range(workers):
+            thread = dup_threading.threading_module().Thread(target = self.work)
+            thread.setDaemon(True)
+            thread.start()
+
+    def add_subdirs(self, index, scanned):
+        """Queue subdirectories found in directory index (cv acquired)"""
+        if index >= self.position:
+            for subdir in scanned.subdirs:
+                if self.may_descend and not self.may_descend(subdir):
+                    continue
+                heapq.heappush(self.todo, (subdir.index, subdir))
+            self.cv.notifyAll()
+
+    def work(self):
+        """Scan queued directories, smallest index first"""
+        self.cv.acquire()
+        try:
+            while not self.stopped:
+                if (not self.todo or
+                    len(self.done) + len(self.in_progress) >= self.max_ahead):
+                    self.cv.wait()
+                    continue
+                index, path = heapq.heappop(self.todo)
+                if index < self.position:
+                    continue
+                self.in_progress[index] = True
+                self.cv.release()
+                try:
+                    scanned = ScannedDir(path)
+                finally:
+                    self.cv.acquire()
+                del self.in_progress[index]
+                self.done[index] = scanned
+                self.add_subdirs(index, scanned)
+        finally:
+            self.cv.release()
+
+    def get(self, path):
+        """Return ScannedDir of directory path
+
+        Directories must be asked for in index order.
+
+        """
+        def _get():
+            self.position = path.index
+            while self.todo and self.todo[0][0] <= path.index:
+                heapq.heappop(self.todo)
+            for index in self.done.keys():
+                if index < path.index:
+                    del self.done[index]
+            # A plain wait, since a timeout (as interruptably_wait
+            # uses) costs more latency than scanning one directory.
+            while path.index in self.in_progress:
+                self.cv.wait()
+            scanned = self.done.pop(path.index, None)
+            self.cv.notifyAll()
+            return scanned
+
+        scanned = dup_threading.with_lock(self.cv, _get)
+        if scanned is None:
+            scanned = ScannedDir(path)
+            dup_threading.with_lock(self.cv,
+                                    lambda: self.add_subdirs(path.index, scanned))
+        return scanned
+
+    def stop(self):
+        """Stop the workers, once they finish the directory at hand"""
+        def _stop():
+            self.stopped = True
+            self.cv.notifyAll()
+        dup_threading.with_lock(self.cv, _stop)
+
+
+class CompiledRules:
+    """Several glob selection functions merged into one
+
+    Calling an instance returns the value of the first of the
+    functions returning 0 or 1, or else 2 if any of them returns 2, or
+    else None.  As far as Select.Select is concerned, this is the same
+    as calling the functions in turn.
+
+    Normal globs are merged into a few alternations of their regular
+    expressions, each alternative ending with an empty group.  As the
+    alternatives are tried in order, the lastindex of a match gives
+    the first glob matching.  Globs without special characters (and
+    "**") match on the path index, and go into a trie.
+
+    """
+    # Python's re module supports at most 100 groups per regexp
+    max_groups = 99
+
+    def __init__(self, sel_funcs):
+        """Merge sel_funcs, which must all have glob_tuple or glob_res"""
+        self.includes = [not sf.exclude for sf in sel_funcs]
+        self.glob_res = [] # list of (compiled re, group index -> rule)
+        self.scan_res = []
+        self.trie = None
+
+        glob_alternatives, scan_alternatives = {}, {}
+        for rule in range(len(sel_funcs)):
+            sf = sel_funcs[rule]
+            if hasattr(sf, "glob_tuple"):
+                self.trie_add(sf.glob_tuple, rule)
+            else:
+                glob_re, scan_re, flags = sf.glob_res
+                glob_alternatives.setdefault(flags, []).append((glob_re, rule))
+                if scan_re:
+                    scan_alternatives.setdefault(flags, []).append(scan_re)
+
+        for flags, alternatives in glob_alternatives.items():
+            for i in range(0, len(alternatives), self.max_groups):
+                chunk = alternatives[i:i + self.max_groups]
+                regexp = re.compile("^(?:%s)" %
+                                    "|".join(["%s(?:$|/)()" % glob_re
+                                              for glob_re, rule in chunk]),
+                                    flags)
+                self.glob_res.append((regexp, [None] + [rule for glob_re, rule in chunk]))
+        for flags, alternatives in scan_alternatives.items():
+            self.scan_res.append(re.compile("^(?:%s)$" % "|".join(alternatives),
+                                            flags))
+
+    def trie_add(self, index, rule):
+        """Add rule matching index to the trie
+
+        Each node is a list [children, first rule matching the index
+        and everything under it, first include rule matching something
+        under it].  The last is because including /foo/bar also
+        includes /foo.
+
+        """
+        if not self.trie:
+            self.trie = [{}, None, None]
+        node = self.trie
+        nodes = [node]
+        for name in index:
+            if name not in node[0]:
+                node[0][name] = [{}, None, None]
+            node = node[0][name]
+            nodes.append(node)
+        if node[1] is None:
+            node[1] = rule
+        if self.includes[rule]:
+            for node in nodes:
+                if node[2] is None:
+                    node[2] = rule
+
+    def trie_match(self, index):
+        """Return first rule of the trie matching index, or None"""
+        node = self.trie
+        first = node[1]
+        for name in index:
+            node = node[0].get(name)
+            if node is None:
+                return first
+            if node[1] is not None and (first is None or node[1] < first):
+                first = node[1]
+        if node[2] is not None and (first is None or node[2] < first):
+            first = node[2]
+        return first
+
+    def __call__(self, path):
+        if self.trie:
+            first = self.trie_match(path.index)
+        else:
+            first = None
+        for regexp, rules in self.glob_res:
+            match = regexp.match(path.name)
+            if match:
+                rule = rules[match.lastindex]
+                if first is None or rule < first:
+                    first = rule
+        if first is not None:
+            return int(self.includes[first])
+        for regexp in self.scan_res:
+            if regexp.match(path.name):
+                return 2
+        return None
+
+
 class Select:
     """Iterate appropriate Paths in given directory
 
@@ -83,6 +365,14 @@ class Select:
     to signal an error if the last function only includes, which would
     be redundant and presumably isn't what the user intends.
 
+    Two more variables are optional.  f.below(dirpath) tells what f
+    can return for the paths under directory dirpath: 0 if it returns
+    0 for all of them, None if it never returns 1 for any of them, and
+    1 if it may; functions without it are taken to return 1.  This is
+    used to skip subtrees which cannot contain anything selected.  And
+    f.by_name should be true iff f only looks at path.index and
+    path.name, so it can be called before the file is stat'ed.
+
     """
     # This re should not match normal filenames, but usually just globs
     glob_re = re.compile("(.*[*?[]|ignorecase\\:)", re.I | re.S)
@@ -91,6 +381,8 @@ class Select:
         """Initializer, called with Path of root directory"""
         assert isinstance(path, Path), str(path)
         self.selection_functions = []
+        self.compiled_functions = None # see compile_selection_functions
+        self.by_name = None # true if all selection functions have by_name
         self.rootpath = path
         self.prefix = self.rootpath.name
 
@@ -139,12 +431,30 @@ class Select:
             """
             # todo: get around circular dependency issue by importing here
             from duplicity import robust #@Reimport
-            for filename in robust.listpath(path):
+            if self.compiled_functions is None:
+                self.compile_selection_functions()
+            if self.by_name:
+                # Selection only needs the names, so excluded files
+                # do not have to be stat'ed, see NamePath.
+                select_name = lambda filename: self.Select(NamePath(path, filename))
+            else:
+                select_name = lambda filename: None
+            if scanner:
+                scanned = scanner.get(path)
+                listdir, append = scanned.listdir, scanned.append
+                readable = scanned.readable
+            else:
+                listdir, append = None, Path.append
+                readable = lambda new_path: os.access(new_path.name, os.R_OK)
+            for filename in robust.listpath(path, listdir):
+                s = select_name(filename)
+                if s == 0:
+                    continue
                 new_path = robust.check_common_error(
-                    error_handler, Path.append, (path, filename))
+                    error_handler, append, (path, filename))
                 # make sure file is read accessible
                 if (new_path and new_path.type in ["reg", "dir"]
-                    and not os.access(new_path.name, os.R_OK)):
+                    and not readable(new_path)):
                     log.Warn(_("Error accessing possibly locked file %s") % new_path.name,
                              log.WarningCode.cannot_read,
                              util.escape(new_path.name))
@@ -152,10 +462,12 @@ class Select:
                         diffdir.stats.Errors +=1
                     new_path = None
                 elif new_path:
-                    s = self.Select(new_path)
+                    if s is None:
+                        s = self.Select(new_path)
                     if s == 1:
                         yield (new_path, 0)
-                    elif s == 2 and new_path.isdir():
+                    elif (s == 2 and new_path.isdir()
+                          and self.subtree_may_select(new_path)):
                         yield (new_path, 1)
 
         if not path.type:
@@ -167,6 +479,11 @@ class Select:
         yield path
         if not path.isdir():
             return
+        if globals.scan_workers > 1 and dup_threading.threading_supported():
+            scanner = DirScanner(globals.scan_workers,
+                                 may_descend = self.may_descend)
+        else:
+            scanner = None
         diryield_stack = [diryield(path)]
         delayed_path_stack = []
 
@@ -191,13 +508,19 @@ class Select:
             elif val == 1:
                 delayed_path_stack.append(subpath)
                 diryield_stack.append(diryield(subpath))
+        # No try/finally, which cannot hold a yield: if the caller stops
+        # early, the scanner's daemon threads are left waiting.
+        if scanner:
+            scanner.stop()
 
     def Select(self, path):
         """Run through the selection functions and return dominant val 0/1/2"""
         if not self.selection_functions:
             return 1
+        if self.compiled_functions is None:
+            self.compile_selection_functions()
         scan_pending = False
-        for sf in self.selection_functions[:-1]:
+        for sf in self.compiled_functions:
             result = sf(path)
             if result is 2:
                 scan_pending = True
@@ -212,6 +535,78 @@ class Select:
         else:
             return 1
 
+    def subtree_may_select(self, path):
+        """Return false if nothing under directory path can be selected
+
+        This looks at what the selection functions can return for the
+        paths under path (see f.below in the class docstring), in the
+        order Select calls them.  A true result does not mean something
+        will be selected, only that it cannot be ruled out.
+
+        """
+        if not self.selection_functions:
+            return True
+        for sf in self.selection_functions[:-1]:
+            below = self.sf_below(sf, path)
+            if below == 1:
+                return True
+            elif below == 0:
+                return False
+        # None of those can select anything under path, so it is up
+        # to the last function, or to the default of including.
+        return self.sf_below(self.selection_functions[-1], path) != 0
+
+    def may_descend(self, path):
+        """Return false if Iterate is sure not to descend into directory path
+
+        Only the selection functions looking at names alone are run,
+        so this is true unless all of them have by_name.  It is called
+        from the threads of DirScanner, which are only started once the
+        selection functions have been compiled.
+
+        """
+        if not self.by_name:
+            return True
+        result = self.Select(path)
+        if result == 0:
+            return False
+        elif result == 2:
+            return self.subtree_may_select(path)
+        return True
+
+    def sf_below(self, sf, path):
+        """Return sf.below(path), or 1 if sf does not have it"""
+        if hasattr(sf, "below"):
+            return sf.below(path)
+        else:
+            return 1
+
+    def compile_selection_functions(self):
+        """Merge runs of glob selection functions, see CompiledRules
+
+        This sets self.compiled_functions, which Select uses instead
+        of all but the last selection function.  The last one is left
+        alone, since it is only called if none of the others returns 2.
+
+        """
+        self.by_name = bool(self.selection_functions)
+        for sf in self.selection_functions:
+            if not getattr(sf, "by_name", None):
+                self.by_name = False
+        self.compiled_functions = []
+        run = []
+        for sf in self.selection_functions[:-1] + [None]:
+            if sf and (hasattr(sf, "glob_tuple") or hasattr(sf, "glob_res")):
+                run.append(sf)
+                continue
+            if len(run) > 1:
+                self.compiled_functions.append(CompiledRules(run))
+            else:
+                self.compiled_functions.extend(run)
+            run = []
+            if sf:
+                self.compiled_functions.append(sf)
+
     def ParseArgs(self, argtuples, filelists):
         """Create selection functions based on list of tuples
 
@@ -293,6 +688,7 @@ probably isn't what you meant.""") %
 
     def add_selection_func(self, sel_func, add_to_start = None):
         """Add another selection function at the end or beginning"""
+        self.compiled_functions = None
         if add_to_start:
             self.selection_functions.insert(0, sel_func)
         else:
@@ -307,32 +703,70 @@ probably isn't what you meant.""") %
         false for an exclude list.
         filelist_name is just a string used for logging.
 
+        The files are kept in a dictionary (see filelist_read), so
+        each path is looked up in time proportional to its depth,
+        whatever the size of the filelist, and paths do not have to
+        be asked about in order.
+
         """
         log.Notice(_("Reading filelist %s") % filelist_name)
-        tuple_list, something_excluded = \
+        entries, something_excluded = \
                     self.filelist_read(filelist_fp, inc_default, filelist_name)
-        log.Notice(_("Sorting filelist %s") % filelist_name)
-        tuple_list.sort()
-        i = [0] # We have to put index in list because of stupid scoping rules
+
+        def excluded(path):
+            """Return true if path or a directory above it is excluded"""
+            if something_excluded:
+                index = path.index
+                for i in range(len(index) + 1):
+                    if entries.get("/".join(index[:i]), 0) & FILELIST_EXCLUDE:
+                        return True
+            return False
 
         def selection_function(path):
-            while 1:
-                if i[0] >= len(tuple_list):
-                    return None
-                include, move_on = \
-                         self.filelist_pair_match(path, tuple_list[i[0]])
-                if move_on:
-                    i[0] += 1
-                    if include is None:
-                        continue # later line may match
-                return include
+            if excluded(path):
+                return 0 # /foo implicitly excludes /foo/bar
+            elif (entries.get("/".join(path.index), 0) &
+                  (FILELIST_INCLUDE | FILELIST_ABOVE)):
+                return 1 # /foo/bar implicitly includes /foo
+            else:
+                return None
+
+        def below(path):
+            if excluded(path):
+                return 0
+            elif entries.get("/".join(path.index), 0) & FILELIST_ABOVE:
+                return 1
+            else:
+                return None
 
         selection_function.exclude = something_excluded or inc_default == 0
         selection_function.name = "Filelist: " + filelist_name
+        selection_function.below = below
+        selection_function.by_name = 1
         return selection_function
 
+    def filelist_read_lines(self, filelist_fp):
+        """Yield the lines of filelist_fp, reading it a block at a time"""
+        separator = globals.null_separator and "\0" or "\n"
+        rest = ""
+        while 1:
+            buf = filelist_fp.read(64 * 1024)
+            if not buf:
+                break
+            lines = (rest + buf).split(separator)
+            rest = lines.pop()
+            for line in lines:
+                yield line
+        yield rest
+
     def filelist_read(self, filelist_fp, include, filelist_name):
-        """Read filelist from fp, return (tuplelist, something_excluded)"""
+        """Read filelist from fp, return (entries, something_excluded)
+
+        entries maps the index of each file in the filelist, joined
+        with "/", to FILELIST_INCLUDE and/or FILELIST_EXCLUDE, or'ed
+        with FILELIST_ABOVE for the directories above included files.
+
+        """
         prefix_warnings = [0]
         def incr_warnings(exc):
             """Warn if prefix is incorrect"""
@@ -344,22 +778,30 @@ probably isn't what you meant.""") %
                 if prefix_warnings[0] == 5:
                     log.Warn(_("Future prefix errors will not be logged."))
 
-        something_excluded, tuple_list = None, []
-        separator = globals.null_separator and "\0" or "\n"
-        for line in filelist_fp.read().split(separator):
+        something_excluded, entries = None, {}
+        for line in self.filelist_read_lines(filelist_fp):
             if not line:
                 continue # skip blanks
             try:
-                tuple = self.filelist_parse_line(line, include)
+                index, line_include = self.filelist_parse_line(line, include)
             except FilePrefixError, exc:
                 incr_warnings(exc)
                 continue
-            tuple_list.append(tuple)
-            if not tuple[1]:
+            key = "/".join(index)
+            if not line_include:
+                entries[key] = entries.get(key, 0) | FILELIST_EXCLUDE
                 something_excluded = 1
+                continue
+            entries[key] = entries.get(key, 0) | FILELIST_INCLUDE
+            while key:
+                key = key[:max(key.rfind("/"), 0)]
+                flags = entries.get(key, 0)
+                if flags & FILELIST_ABOVE:
+                    break # and so are the ones above it
+                entries[key] = flags | FILELIST_ABOVE
         if filelist_fp not in (sys.stdin,) and filelist_fp.close():
             log.Warn(_("Error closing filelist %s") % filelist_name)
-        return (tuple_list, something_excluded)
+        return (entries, something_excluded)
 
     def filelist_parse_line(self, line, include):
         """Parse a single line of a filelist, returning a pair
@@ -385,37 +827,6 @@ probably isn't what you meant.""") %
         index = tuple(filter(lambda x: x, line.split("/"))) # remove empties
         return (index, include)
 
-    def filelist_pair_match(self, path, pair):
-        """Matches a filelist tuple against a path
-
-        Returns a pair (include, move_on).  include is None if the
-        tuple doesn't match either way, and 0/1 if the tuple excludes
-        or includes the path.
-
-        move_on is true if the tuple cannot match a later index, and
-        so we should move on to the next tuple in the index.
-
-        """
-        index, include = pair
-        if include == 1:
-            if index < path.index:
-                return (None, True)
-            if index == path.index:
-                return (1, True)
-            elif index[:len(path.index)] == path.index:
-                return (1, False) # /foo/bar implicitly includes /foo
-            else:
-                return (None, False) # path greater, not initial sequence
-        elif include == 0:
-            if path.index[:len(index)] == index:
-                return (0, False) # /foo implicitly excludes /foo/bar
-            elif index < path.index:
-                return (None, True)
-            else:
-                return (None, False) # path greater, not initial sequence
-        else:
-            assert 0, "Include is %s, should be 0 or 1" % (include,)
-
     def filelist_globbing_get_sfs(self, filelist_fp, inc_default, list_name):
         """Return list of selection functions by reading fileobj
 
@@ -426,8 +837,7 @@ probably isn't what you meant.""") %
 
         """
         log.Notice(_("Reading globbing filelist %s") % list_name)
-        separator = globals.null_separator and "\0" or "\n"
-        for line in filelist_fp.read().split(separator):
+        for line in self.filelist_read_lines(filelist_fp):
             if not line: # skip blanks
                 continue
             if line[0] == "#": # skip comments
@@ -450,6 +860,8 @@ probably isn't what you meant.""") %
                 return None
         sel_func.exclude = not include
         sel_func.name = "Match other filesystems"
+        if not include:
+            sel_func.below = lambda path: None
         return sel_func
 
     def regexp_get_sf(self, regexp_string, include):
@@ -469,6 +881,9 @@ probably isn't what you meant.""") %
 
         sel_func.exclude = not include
         sel_func.name = "Regular expression: %s" % regexp_string
+        sel_func.by_name = 1
+        if not include:
+            sel_func.below = lambda path: None
         return sel_func
 
     def devfiles_get_sf(self):
@@ -483,6 +898,7 @@ probably isn't what you meant.""") %
                 return None
         sel_func.exclude = 1
         sel_func.name = "Exclude device files"
+        sel_func.below = lambda path: None
         return sel_func
 
     def glob_get_sf(self, glob_str, include):
@@ -490,6 +906,9 @@ probably isn't what you meant.""") %
         assert include == 0 or include == 1
         if glob_str == "**":
             sel_func = lambda path: include
+            sel_func.glob_tuple = () # same as the base directory
+            sel_func.below = sel_func
+            sel_func.by_name = 1
         elif not self.glob_re.match(glob_str):
             # normal file
             sel_func = self.glob_get_filename_sf(glob_str, include)
@@ -525,6 +944,7 @@ probably isn't what you meant.""") %
         sel_func.exclude = not include
         sel_func.name = "Command-line %s filename: %s" % \
                         (include and "include-if-present" or "exclude-if-present", filename)
+        sel_func.below = lambda path: None
         return sel_func
 
     def glob_get_filename_sf(self, filename, include):
@@ -563,6 +983,11 @@ probably isn't what you meant.""") %
             sel_func = exclude_sel_func
         sel_func.exclude = not include
         sel_func.name = "Tuple select %s" % (tuple,)
+        sel_func.glob_tuple = tuple
+        # A path under a directory which matches is matched too,
+        # and one under a directory which doesn't is not.
+        sel_func.below = sel_func
+        sel_func.by_name = 1
         return sel_func
 
     def glob_get_normal_sf(self, glob_str, include):
@@ -581,19 +1006,28 @@ probably isn't what you meant.""") %
 
         """
         if glob_str.lower().startswith("ignorecase:"):
-            re_comp = lambda r: re.compile(r, re.I | re.S)
+            flags = re.I | re.S
             glob_str = glob_str[len("ignorecase:"):]
         else:
-            re_comp = lambda r: re.compile(r, re.S)
+            flags = re.S
+        re_comp = lambda r: re.compile(r, flags)
 
         # matches what glob matches and any files in directory
-        glob_comp_re = re_comp("^%s($|/)" % self.glob_to_re(glob_str))
+        glob_re = self.glob_to_re(glob_str)
+        glob_comp_re = re_comp("^%s($|/)" % glob_re)
+
+        # matches directories whose contents all match glob_str
+        dir_comp_re = None
+        for suffix in ["/*", "/**"]:
+            if glob_str.endswith(suffix) and len(glob_str) > len(suffix):
+                dir_comp_re = re_comp("^%s$" %
+                                      self.glob_to_re(glob_str[:-len(suffix)]))
 
         if glob_str.find("**") != -1:
             glob_str = glob_str[:glob_str.find("**")+2] # truncate after **
 
-        scan_comp_re = re_comp("^(%s)$" %
-                               "|".join(self.glob_get_prefix_res(glob_str)))
+        scan_re = "|".join(self.glob_get_prefix_res(glob_str))
+        scan_comp_re = re_comp("^(%s)$" % scan_re)
 
         def include_sel_func(path):
             if glob_comp_re.match(path.name):
@@ -613,6 +1047,29 @@ probably isn't what you meant.""") %
         if not include_sel_func(self.rootpath):
             raise FilePrefixError(glob_str)
 
+        # for CompiledRules
+        include_sel_func.glob_res = (glob_re, scan_re, flags)
+        exclude_sel_func.glob_res = (glob_re, None, flags)
+
+        # Only a directory which matches glob_str or one of its
+        # prefixes can have something under it which matches glob_str
+        def include_below(path):
+            if include_sel_func(path):
+                return 1
+            else:
+                return None
+
+        def exclude_below(path):
+            if (glob_comp_re.match(path.name) or
+                (dir_comp_re and dir_comp_re.match(path.name))):
+                return 0
+            else:
+                return None
+
+        include_sel_func.below = include_below
+        exclude_sel_func.below = exclude_below
+        include_sel_func.by_name = exclude_sel_func.by_name = 1
+
         if include:
             return include_sel_func
         else:
@@ -0,0 +1,355 @@
+# -*- Mode:Python; indent-tabs-mode:nil; tab-width:4 -*-
+#
+# This file is part of duplicity.
+#
+# Duplicity is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 2 of the License, or (at your
+# option) any later version.
+#
+# Duplicity is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with duplicity; if not, write to the Free Software Foundation,
+# Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+
+"""
+Persistent index of the combined signatures of a signature chain
+
+Incremental backups normally read every signature tarfile of the
+chain and combine them (diffdir.get_combined_path_iter), reading all
+the rsync signatures along the way, even of files that have not
+changed.  The index kept here in the archive dir holds the combined
+result: one record per path, in index order, with the stat data and a
+pointer into a blob file holding the rsync signature.  Signatures are
+only read from the blob file when a path is found to have changed.
+"""
+
+import marshal, cStringIO
+
+from duplicity import diffdir
+from duplicity import dup_time
+from duplicity import file_naming
+from duplicity import globals
+from duplicity import log
+from duplicity import path
+
+# Bump when the record layout changes; old indexes are then rebuilt.
+index_version = 1
+
+
+class SigIndexError(Exception):
+    """
+    Exception raised when a signature index is unusable
+    """
+    pass
+
+
+class SigBlobFile:
+    """
+    File-like object returning one signature from the blob file
+
+    The signature is only read when the file is first read from.
+    """
+    def __init__(self, blobfp, offset, length):
+        """SigBlobFile initializer"""
+        self.blobfp = blobfp
+        self.offset, self.length = offset, length
+        self.buf = None
+
+    def read(self, length = -1):
+        if self.buf is None:
+            self.blobfp.seek(self.offset)
+            data = self.blobfp.read(self.length)
+            if len(data) != self.length:
+                raise SigIndexError("Short read from signature index")
+            self.buf = cStringIO.StringIO(data)
+        return self.buf.read(length)
+
+    def close(self):
+        pass
+
+
+class SigIndex:
+    """
+    Signature index of the chain starting with a given full signature
+
+    The index is made of two files in archive_dir: the .idx file is a
+    marshal stream of a header followed by one record per path, and
+    the .blob file holds the rsync signatures.  The header lists the
+    signature files merged so far, so the index can be brought up to
+    date by merging only the newer ones.
+    """
+    def __init__(self, archive_dir, fullsig):
+        """
+        SigIndex initializer
+
+        @type archive_dir: path.Path
+        @param archive_dir: directory holding the local signatures
+        @type fullsig: string
+        @param fullsig: filename of the full signature of the chain
+        """
+        self.archive_dir = archive_dir
+        self.fullsig = fullsig
+        timestr = dup_time.timetostring(file_naming.parse(fullsig).time)
+        self.idx_path = archive_dir.append("sigindex.%s.idx" % timestr)
+        self.blob_path = archive_dir.append("sigindex.%s.blob" % timestr)
+        self.records = None # name -> record, see get_path
+        self.lookup_blobfp = None
+
+    def get_header(self):
+        """
+        Return header of the index on disk, or None if there is none
+        """
+        self.idx_path.setdata()
+        self.blob_path.setdata()
+        if not self.idx_path.exists() or not self.blob_path.exists():
+            return None
+        fp = self.idx_path.open("rb")
+        try:
+            try:
+                header = marshal.load(fp)
+            except (EOFError, ValueError, TypeError):
+                return None
+        finally:
+            fp.close()
+        if (type(header) is not dict
+            or header.get("version") != index_version
+            or header.get("numeric_owner") != globals.numeric_owner):
+            return None
+        return header
+
+    def get_filenames(self):
+        """
+        Return list of signature filenames merged into the index
+        """
+        header = self.get_header()
+        if header:
+            return header["sigfiles"]
+        else:
+            return []
+
+    def record2ropath(self, record, blobfp):
+        """
+        Turn record read from the index into ROPath
+        """
+        (name, difftype, path_type, mode, uid, gid, mtime, size,
+         symtext, devnums, offset, length) = record
+        if name:
+            index = tuple(name.split("/"))
+        else:
+            index = ()
+        ropath = path.ROPath(index)
+        ropath.difftype = difftype
+        ropath.type, ropath.mode = path_type, mode
+        ropath.stat = path.StatResult()
+        ropath.stat.st_uid, ropath.stat.st_gid = uid, gid
+        ropath.stat.st_mtime, ropath.stat.st_size = mtime, size
+        if path_type == "sym":
+            ropath.symtext = symtext
+        elif path_type in ("chr", "blk"):
+            ropath.devnums = tuple(devnums)
+        if offset >= 0:
+            ropath.setfileobj(SigBlobFile(blobfp, offset, length))
+        ropath.sigindex_blob = (offset, length)
+        return ropath
+
+    def ropath2record(self, ropath, offset, length):
+        """
+        Turn ROPath into record to be written to the index
+        """
+        symtext = devnums = None
+        if ropath.issym():
+            symtext = ropath.symtext
+        elif ropath.isdev():
+            devnums = tuple(ropath.devnums)
+        return ("/".join(ropath.index), ropath.difftype, ropath.type,
+                ropath.mode, ropath.stat.st_uid, ropath.stat.st_gid,
+                int(ropath.stat.st_mtime), ropath.stat.st_size,
+                symtext, devnums, offset, length)
+
+    def get_path_iter(self):
+        """
+        Iterate the ROPaths of the index, in index order
+
+        Like diffdir.get_combined_path_iter, but deleted paths are
+        not returned, since they compare the same as missing ones.
+        """
+        if not self.get_header():
+            raise SigIndexError("No usable signature index for %s" %
+                                (self.fullsig,))
+        fp = self.idx_path.open("rb")
+        blobfp = self.blob_path.open("rb")
+        marshal.load(fp) # skip header
+        while 1:
+            try:
+                record = marshal.load(fp)
+            except EOFError:
+                break
+            yield self.record2ropath(record, blobfp)
+        fp.close()
+        blobfp.close()
+
+    def get_path(self, index):
+        """
+        Return ROPath of the index, or None if it is not in the index
+
+        The records are all read into memory the first time.
+        """
+        if self.records is None:
+            self.records = {}
+            fp = self.idx_path.open("rb")
+            marshal.load(fp) # skip header
+            while 1:
+                try:
+                    record = marshal.load(fp)
+                except EOFError:
+                    break
+                self.records[record[0]] = record
+            fp.close()
+            self.lookup_blobfp = self.blob_path.open("rb")
+        record = self.records.get("/".join(index))
+        if record is None:
+            return None
+        return self.record2ropath(record, self.lookup_blobfp)
+
+    def forget_records(self):
+        """
+        Drop the records read by get_path, before the index changes
+        """
+        self.records = None
+        if self.lookup_blobfp:
+            self.lookup_blobfp.close()
+            self.lookup_blobfp = None
+
+    def update(self, sigfiles):
+        """
+        Merge the signature files sigfiles (in archive_dir) into index
+
+        The new index is written next to the old one and renamed into
+        place, so an interrupted update leaves the old index usable.
+        Signatures are appended to the blob file, which is rewritten
+        when more than half of it is no longer referenced.
+        """
+        if not sigfiles:
+            return
+        self.forget_records()
+        header = self.get_header()
+        if header:
+            merged = header["sigfiles"]
+            path_iters = [self.get_path_iter()]
+            blob_mode = "ab"
+        else:
+            merged = []
+            path_iters = []
+            blob_mode = "wb"
+        sigfps = [path.DupPath(self.archive_dir.name, (sigfile,)).filtered_open("rb")
+                  for sigfile in sigfiles]
+        path_iters.extend(map(diffdir.sigtar2path_iter, sigfps))
+
+        log.Info(_("Updating signature index with %s") % ", ".join(sigfiles))
+        new_idx_path = self.archive_dir.append(self.idx_path.get_filename() + ".new")
+        idxfp = new_idx_path.open("wb")
+        marshal.dump({"version": index_version,
+                      "numeric_owner": globals.numeric_owner,
+                      "sigfiles": merged + list(sigfiles)}, idxfp)
+        blobfp = self.blob_path.open(blob_mode)
+        blobfp.seek(0, 2)
+        blob_size = blobfp.tell()
+        live_size = 0
+        for ropath in diffdir.combine_path_iters(path_iters):
+            if ropath.difftype == "deleted":
+                continue
+            if hasattr(ropath, "sigindex_blob"):
+                offset, length = ropath.sigindex_blob
+            elif ropath.isreg() and ropath.fileobj:
+                data = ropath.get_data()
+                offset, length = blob_size, len(data)
+                blobfp.write(data)
+                blob_size += length
+            else:
+                offset, length = -1, 0
+            live_size += length
+            marshal.dump(self.ropath2record(ropath, offset, length), idxfp)
+        assert not blobfp.close()
+        assert not idxfp.close()
+        new_idx_path.rename(self.idx_path)
+
+        if blob_size > 2 * live_size + 1024 * 1024:
+            self.compact()
+
+    def compact(self):
+        """
+        Rewrite blob file and index with only referenced signatures
+        """
+        log.Info(_("Compacting signature index of %s") % (self.fullsig,))
+        self.forget_records()
+        header = self.get_header()
+        new_idx_path = self.archive_dir.append(self.idx_path.get_filename() + ".new")
+        new_blob_path = self.archive_dir.append(self.blob_path.get_filename() + ".new")
+        idxfp = new_idx_path.open("wb")
+        blobfp = new_blob_path.open("wb")
+        marshal.dump(header, idxfp)
+        blob_size = 0
+        for ropath in self.get_path_iter():
+            offset, length = ropath.sigindex_blob
+            if offset >= 0:
+                data = ropath.get_data()
+                offset = blob_size
+                blobfp.write(data)
+                blob_size += length
+            marshal.dump(self.ropath2record(ropath, offset, length), idxfp)
+        assert not blobfp.close()
+        assert not idxfp.close()
+        # Remove the old index first, so a crash in between leaves no
+        # index pointing into the wrong blob file.
+        self.idx_path.delete()
+        new_blob_path.rename(self.blob_path)
+        new_idx_path.rename(self.idx_path)
+
+    def delete(self):
+        """
+        Remove the index files
+        """
+        for p in (self.idx_path, self.blob_path):
+            p.setdata()
+            if p.exists():
+                p.delete()
+
+
+def remove_stale(archive_dir, keep = None):
+    """
+    Delete the signature index files in archive_dir except those of keep
+    """
+    if keep:
+        keep_names = [keep.idx_path.get_filename(), keep.blob_path.get_filename()]
+    else:
+        keep_names = []
+    for filename in archive_dir.listdir():
+        if filename.startswith("sigindex.") and filename not in keep_names:
+            log.Info(_("Deleting stale signature index file %s") % (filename,))
+            archive_dir.append(filename).delete()
+
+
+def get_index(sig_chain):
+    """
+    Return SigIndex of sig_chain brought up to date, or None
+
+    None is returned if the chain is not local.  If the index on disk
+    was made from signatures that are not a prefix of the chain, it is
+    rebuilt from scratch.
+    """
+    if not sig_chain.islocal():
+        return None
+    index = SigIndex(sig_chain.archive_dir, sig_chain.fullsig)
+    sigfiles = sig_chain.get_filenames()
+    merged = index.get_filenames()
+    if merged != sigfiles[:len(merged)]:
+        index.delete()
+        merged = []
+    remove_stale(sig_chain.archive_dir, index)
+    index.update(sigfiles[len(merged):])
+    return index
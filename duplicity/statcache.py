@@ -0,0 +1,256 @@
+# -*- Mode:Python; indent-tabs-mode:nil; tab-width:4 -*-
+#
+# This file is part of duplicity.
+#
+# Duplicity is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 2 of the License, or (at your
+# option) any later version.
+#
+# Duplicity is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with duplicity; if not, write to the Free Software Foundation,
+# Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+
+"""
+Stat data of the files of the last backup, kept in the archive dir
+
+Signatures only keep what is needed to restore files, so incremental
+backups find unchanged files by comparing their type, permissions and
+mtime with the signatures, which have to be read for every file.  The
+stat cache written by the last backup also holds the device and inode
+numbers, size and ctime of each file.  A file whose stat data are
+still all the same has not changed, since writing to a file or
+changing its attributes updates its ctime, so its signature does not
+have to be looked at.  If nothing changed, the signatures are not read
+at all.
+
+Filesystem snapshots are often mounted on a new device each time; the
+device number of the files on the same device as the root of the
+backup is therefore recorded relative to it.
+"""
+
+import marshal, struct
+
+from duplicity import log
+
+# Bump when the record layout changes; old caches are then ignored.
+cache_version = 1
+
+
+class StatCache:
+    """
+    Stat cache in archive_dir, read and written in index order
+
+    The file is a marshal stream of one record per file, followed by
+    a trailer and the offset of the trailer.  A record is (name,
+    type, dev, ino, size, mtime, ctime), where name is the index
+    joined with "/" and dev is None for the device of the root.  The
+    trailer holds the time of the backup the cache was written by and
+    the names of the files which could not be backed up.
+    """
+    def __init__(self, archive_dir):
+        """
+        StatCache initializer
+
+        @type archive_dir: path.Path
+        @param archive_dir: directory holding the cache
+        """
+        self.cache_path = archive_dir.append("statcache")
+        self.new_path = archive_dir.append("statcache.new")
+        self.fp = None # file being read
+        self.end = None # offset of the trailer of the file being read
+        self.record = None # next record read, with the index as a tuple
+        self.root_dev = None # device of the root of the backup
+        self.failed = {}
+        self.inodes = None # (dev, ino) -> index, see find_inode
+        self.outfp = None # file being written
+        self.new_failed = {}
+
+    def get_trailer(self, fp):
+        """
+        Return (offset, trailer) of cache file fp, or None if it is
+        unusable
+        """
+        try:
+            fp.seek(-8, 2)
+            offset = struct.unpack(">Q", fp.read(8))[0]
+            fp.seek(offset)
+            trailer = marshal.load(fp)
+        except (IOError, EOFError, ValueError, TypeError, struct.error):
+            return None
+        if type(trailer) is not dict or trailer.get("version") != cache_version:
+            return None
+        return (offset, trailer)
+
+    def open(self, backup_time, rootpath):
+        """
+        Start reading the cache, if it was written by the backup at
+        backup_time.  Return true if it can be used.
+
+        @type backup_time: int
+        @param backup_time: end time of the signature chain
+        @type rootpath: path.Path
+        @param rootpath: root of the files being backed up
+        """
+        self.cache_path.setdata()
+        if not self.cache_path.exists() or not rootpath.stat:
+            return False
+        fp = self.cache_path.open("rb")
+        result = self.get_trailer(fp)
+        if not result or result[1]["time"] != backup_time:
+            log.Info(_("Stat cache %s is not of the last backup, ignoring it")
+                     % (self.cache_path.name,))
+            fp.close()
+            return False
+        self.end, trailer = result
+        self.root_dev = rootpath.stat.st_dev
+        self.failed = dict.fromkeys(trailer["failed"])
+        fp.seek(0)
+        self.fp = fp
+        self.read_record()
+        return True
+
+    def read_record(self):
+        """
+        Set self.record to the next record, or None at the end
+        """
+        if self.fp.tell() >= self.end:
+            self.record = None
+            self.fp.close()
+            return
+        record = marshal.load(self.fp)
+        if record[0]:
+            index = tuple(record[0].split("/"))
+        else:
+            index = ()
+        self.record = (index,) + record[1:]
+
+    def pass_to(self, index):
+        """
+        Move to the record of index, if any, and return the records
+        of the files before it, which are not in the source any more
+        """
+        passed = []
+        while self.record and self.record[0] < index:
+            passed.append(self.record)
+            self.read_record()
+        return passed
+
+    def pass_rest(self):
+        """
+        Return the records left
+        """
+        passed = []
+        while self.record:
+            passed.append(self.record)
+            self.read_record()
+        return passed
+
+    def get_stat(self, new_path):
+        """
+        Return (dev, ino, size, mtime, ctime) of new_path, or None if
+        it was not stat'ed (ROPaths from signatures for instance)
+        """
+        stat = new_path.stat
+        if not hasattr(stat, "st_ino"):
+            return None
+        dev = stat.st_dev
+        if dev == self.root_dev:
+            dev = None # same as root
+        return (dev, stat.st_ino, stat.st_size, stat.st_mtime, stat.st_ctime)
+
+    def unchanged(self, new_path):
+        """
+        Return true if new_path has the same stat data as recorded
+
+        Call pass_to(new_path.index) first.  The record of new_path,
+        if any, is passed over.  If new_path is a regular file whose
+        stat data changed, new_path.stat_changed is set, so it is
+        backed up even if its mtime was kept.
+        """
+        record = self.record
+        if not record or record[0] != new_path.index:
+            return False
+        self.read_record()
+        if self.failed and "/".join(new_path.index) in self.failed:
+            return False
+        if (record[1] == new_path.type and
+            record[2:] == self.get_stat(new_path)):
+            return True
+        if record[1] == "reg" and new_path.isreg():
+            new_path.stat_changed = True
+        return False
+
+    def find_inode(self, dev, ino):
+        """
+        Return index of the file recorded with device and inode
+        numbers dev and ino, or None
+
+        The whole cache is read into memory the first time.
+        """
+        if self.inodes is None:
+            self.inodes = {}
+            fp = self.cache_path.open("rb")
+            while fp.tell() < self.end:
+                record = marshal.load(fp)
+                self.inodes[(record[2], record[3])] = record[0]
+            fp.close()
+        if dev == self.root_dev:
+            dev = None
+        name = self.inodes.get((dev, ino))
+        if name is None:
+            return None
+        elif name:
+            return tuple(name.split("/"))
+        else:
+            return ()
+
+    def start_write(self, rootpath):
+        """
+        Start writing a new cache for the files under rootpath
+        """
+        self.outfp = self.new_path.open("wb")
+        self.root_dev = rootpath.stat.st_dev
+        self.new_failed = {}
+
+    def add(self, new_path):
+        """
+        Record stat data of new_path, which is backed up
+
+        Paths must be added in index order.  Those which were not
+        stat'ed are recorded so they will never be found unchanged.
+        """
+        if not self.outfp:
+            return
+        stat = self.get_stat(new_path)
+        if not stat:
+            stat = (None, None, None, None, None)
+        marshal.dump(("/".join(new_path.index), new_path.type) + stat,
+                     self.outfp)
+
+    def add_failed(self, index):
+        """
+        Record that the file at index could not be backed up
+        """
+        if self.outfp:
+            self.new_failed["/".join(index)] = None
+
+    def commit(self, backup_time):
+        """
+        Finish writing the cache of the backup made at backup_time
+        """
+        if not self.outfp:
+            return
+        offset = self.outfp.tell()
+        marshal.dump({"version": cache_version,
+                      "time": backup_time,
+                      "failed": self.new_failed.keys()}, self.outfp)
+        self.outfp.write(struct.pack(">Q", offset))
+        assert not self.outfp.close()
+        self.outfp = None
+        self.new_path.rename(self.cache_path)
@@ -0,0 +1,150 @@
+# -*- Mode:Python; indent-tabs-mode:nil; tab-width:4 -*-
+#
+# This file is part of duplicity.
+#
+# Duplicity is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 2 of the License, or (at your
+# option) any later version.
+#
+# Duplicity is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with duplicity; if not, write to the Free Software Foundation,
+# Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+
+"""
+Time the ways patchdir.patch_seq2ropath can patch a file
+
+Usage: python patchbench.py [size in KB ...]
+
+For each size, a random file is changed a few times, and the chain of
+deltas is applied:
+
+  chain       each delta by librsync in turn, through temporary files
+  string      each delta by librsync.PatchMaker, from a string basis
+  composed    composed deltas, basis and literal data in memory
+  composed/f  composed deltas, basis and literal data in temporary files
+
+The basis_memory_size of patchdir decides between the last two.
+"""
+
+import sys, os, random, tempfile, time, cStringIO
+sys.path.insert(0, os.path.join(os.path.dirname(sys.argv[0]), "..", ".."))
+
+from duplicity import librsync
+from duplicity import misc
+
+num_deltas = 4
+
+
+def make_versions(size):
+    """Return list of num_deltas + 1 versions of a random file"""
+    rand = random.Random(size)
+    data = os.urandom(size)
+    versions = [data]
+    for i in range(num_deltas):
+        for j in range(8):
+            pos = rand.randrange(len(data))
+            data = data[:pos] + os.urandom(rand.randrange(4096)) + \
+                   data[pos + rand.randrange(4096):]
+        versions.append(data)
+    return versions
+
+
+def make_deltas(versions):
+    """Return deltas between consecutive versions"""
+    deltas = []
+    for old, new in zip(versions, versions[1:]):
+        sig = librsync.SigFile(cStringIO.StringIO(old)).read()
+        deltas.append(librsync.DeltaFile(sig, cStringIO.StringIO(new)).read())
+    return deltas
+
+
+def read_all(fp):
+    """Read fp in blocks like Path.copy does, return its length"""
+    size = 0
+    while 1:
+        buf = fp.read(64 * 1024)
+        if not buf:
+            break
+        size += len(buf)
+    assert not fp.close()
+    return size
+
+
+def to_tempfile(fp):
+    """Return real temporary file with the contents of fp"""
+    tempfp = tempfile.TemporaryFile()
+    misc.copyfileobj(fp, tempfp)
+    assert not fp.close()
+    tempfp.seek(0)
+    return tempfp
+
+
+def chain(basis, deltas):
+    current = cStringIO.StringIO(basis)
+    for delta in deltas:
+        current = librsync.PatchedFile(to_tempfile(current),
+                                       cStringIO.StringIO(delta))
+    return read_all(current)
+
+
+def string(basis, deltas):
+    for delta in deltas:
+        patched = librsync.PatchedFile(basis, cStringIO.StringIO(delta))
+        basis = patched.read()
+        assert not patched.close()
+    return len(basis)
+
+
+def composed(basis, deltas, in_memory = True):
+    if in_memory:
+        literal_file = cStringIO.StringIO()
+    else:
+        literal_file = tempfile.TemporaryFile()
+        basis = to_tempfile(cStringIO.StringIO(basis))
+    composed = librsync.ComposedDelta(literal_file)
+    for delta in deltas:
+        composed.add(cStringIO.StringIO(delta))
+    return read_all(librsync.ComposedPatchedFile(basis, composed))
+
+
+def composed_file(basis, deltas):
+    return composed(basis, deltas, False)
+
+
+def timeit(function, basis, deltas):
+    """Return best time of three runs of function"""
+    best = None
+    for i in range(3):
+        start = time.time()
+        function(basis, deltas)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def main(sizes):
+    functions = [("chain", chain), ("string", string),
+                 ("composed", composed), ("composed/f", composed_file)]
+    print "%10s %6s" % ("size KB", "deltas"),
+    for name, function in functions:
+        print "%11s" % (name,),
+    print
+    for size in sizes:
+        versions = make_versions(size * 1024)
+        deltas = make_deltas(versions)
+        for count in [1, num_deltas]:
+            print "%10d %6d" % (size, count),
+            for name, function in functions:
+                print "%10.3fs" % timeit(function, versions[0], deltas[:count]),
+            print
+
+
+if __name__ == "__main__":
+    main(map(int, sys.argv[1:]) or [64, 256, 1024, 4096, 16384])
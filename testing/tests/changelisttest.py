@@ -0,0 +1,147 @@
+# -*- Mode:Python; indent-tabs-mode:nil; tab-width:4 -*-
+#
+# This file is part of duplicity.
+#
+# Duplicity is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 2 of the License, or (at your
+# option) any later version.
+#
+# Duplicity is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with duplicity; if not, write to the Free Software Foundation,
+# Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+
+import helper
+import os, unittest, StringIO
+
+from duplicity.path import * #@UnusedWildImport
+from duplicity import changelist
+from duplicity import diffdir
+from duplicity import selection
+from duplicity import statistics
+
+helper.setup()
+
+class ChangeListTest(unittest.TestCase):
+    """Test incrementals looking only at a list of changed files"""
+    def setUp(self):
+        assert not os.system("tar xzf testfiles.tar.gz > /dev/null 2>&1")
+        assert not os.system("rm -rf testfiles/output")
+        os.mkdir("testfiles/output")
+        self.sig = Path("testfiles/output/dir1.sigtar")
+        self.write_sig()
+
+    def tearDown(self):
+        assert not os.system("rm -rf testfiles tempdir temp2.tar")
+
+    def write_sig(self):
+        """Write signatures of testfiles/dir1"""
+        select = selection.Select(Path("testfiles/dir1"))
+        select.set_iter()
+        diffdir.write_block_iter(diffdir.SigTarBlockIter(select), self.sig)
+
+    def get_select(self, tuplelist = []):
+        """Return Select of testfiles/dir2"""
+        select = selection.Select(Path("testfiles/dir2"))
+        select.ParseArgs(tuplelist, [])
+        select.set_iter()
+        return select
+
+    def get_deltas(self, path_iter, sig_iter):
+        """Return list of (index, difftype, data) of the deltas"""
+        diffdir.stats = statistics.StatsDeltaProcess()
+        deltas = []
+        for delta_path in diffdir.get_delta_iter(path_iter, sig_iter):
+            data = None
+            if delta_path.isreg():
+                data = delta_path.get_data()
+            deltas.append((delta_path.index,
+                           getattr(delta_path, "difftype", None), data))
+        return deltas
+
+    def get_changed_deltas(self, select, filenames):
+        """Return deltas looking only at filenames of dir2"""
+        changed_fp = StringIO.StringIO("".join(["testfiles/dir2/%s\n" % f
+                                                for f in filenames]))
+        changed = changelist.read_changed(changed_fp, select)
+        sig_iter = diffdir.get_combined_path_iter([self.sig.open("rb")])
+        return self.get_deltas(*changelist.get_path_iters(select, sig_iter,
+                                                          changed))
+
+    def get_walk_deltas(self, select):
+        """Return deltas walking all of dir2"""
+        sig_iter = diffdir.get_combined_path_iter([self.sig.open("rb")])
+        return self.get_deltas(select, sig_iter)
+
+    def test_read_changed(self):
+        """Test reading list adds directories above and sorts"""
+        select = self.get_select()
+        changed_fp = StringIO.StringIO("testfiles/dir2/b/c\n"
+                                       "testfiles/dir2/a\n\n")
+        assert changelist.read_changed(changed_fp, select) == \
+               [(), ("a",), ("b",), ("b", "c")]
+        changed_fp = StringIO.StringIO("testfiles/dir2x/a\n")
+        self.assertRaises(changelist.ChangeListError,
+                          changelist.read_changed, changed_fp, select)
+
+    def test_all_changed(self):
+        """Test listing every file gives the same deltas as walking"""
+        filenames = os.listdir("testfiles/dir1") + os.listdir("testfiles/dir2")
+        filenames += ["directory_to_file/file", "executable2/another_file"]
+        walked = self.get_walk_deltas(self.get_select())
+        assert len(walked) > 5, walked
+        assert self.get_changed_deltas(self.get_select(), filenames) == walked
+
+    def test_some_changed(self):
+        """Test files missing from the list are taken as unchanged"""
+        filenames = ["new_file", "deleted_file", "executable2",
+                     "directory_to_file"]
+        walked = self.get_walk_deltas(self.get_select())
+        expected = [delta for delta in walked
+                    if delta[0][:1] in [(), ("new_file",), ("deleted_file",),
+                                        ("executable2",), ("directory_to_file",)]]
+        assert len(expected) < len(walked), walked
+        assert self.get_changed_deltas(self.get_select(), filenames) == expected
+
+    def test_selection(self):
+        """Test listed files are still run through selection"""
+        tuplelist = [("--exclude", "testfiles/dir2/executable2"),
+                     ("--exclude", "testfiles/dir2/new_file")]
+        filenames = ["new_file", "executable2/another_file", "regular_file"]
+        walked = self.get_walk_deltas(self.get_select(tuplelist))
+        expected = [delta for delta in walked
+                    if delta[0][:1] in [(), ("executable2",), ("regular_file",)]]
+        assert ("executable2",) in [delta[0] for delta in expected]
+        assert self.get_changed_deltas(self.get_select(tuplelist),
+                                       filenames) == expected
+
+    def test_scanned_dirs(self):
+        """Test directories only scanned need something selected under them"""
+        for name in ["dir1/scanned_dir/old", "dir2/scanned_dir/unwanted",
+                     "dir1/kept_dir/old", "dir2/kept_dir/wanted"]:
+            dirname, filename = os.path.split("testfiles/" + name)
+            if not os.path.isdir(dirname):
+                os.mkdir(dirname)
+            open(os.path.join(dirname, filename), "w").close()
+        self.write_sig()
+        tuplelist = [("--include", "testfiles/dir2/scanned_dir/wanted*"),
+                     ("--include", "testfiles/dir2/kept_dir/wanted*"),
+                     ("--exclude", "**")]
+        filenames = ["scanned_dir/old", "scanned_dir/unwanted",
+                     "kept_dir/old", "kept_dir/wanted"]
+        walked = self.get_walk_deltas(self.get_select(tuplelist))
+        expected = [delta for delta in walked
+                    if delta[0][:1] in [(), ("scanned_dir",), ("kept_dir",)]]
+        assert (("scanned_dir",), None, None) in expected, expected
+        assert ("kept_dir", "wanted") in [delta[0] for delta in expected]
+        assert self.get_changed_deltas(self.get_select(tuplelist),
+                                       filenames) == expected
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -70,6 +70,21 @@ filename_list2 = ["duplicity-full.2001-01-01T16:17:01-07:00.manifest.gpg",
                   "duplicity-inc.2000-08-17T16:17:01-07:00.to.2000-08-18T00:04:30-07:00.vol1.difftar.gpg",
                   "Extra stuff to be ignored"]
 
+# A chain whose two incremental sets were merged into a third one,
+# before the old sets were deleted.
+merged_filename_list = ["duplicity-full.2002-08-17T16:17:01-07:00.manifest.gpg",
+                        "duplicity-full.2002-08-17T16:17:01-07:00.vol1.difftar.gpg",
+                        "duplicity-inc.2002-08-17T16:17:01-07:00.to.2002-08-18T00:04:30-07:00.manifest.gpg",
+                        "duplicity-inc.2002-08-17T16:17:01-07:00.to.2002-08-18T00:04:30-07:00.vol1.difftar.gpg",
+                        "duplicity-inc.2002-08-18T00:04:30-07:00.to.2002-08-20T00:00:00-07:00.manifest.gpg",
+                        "duplicity-inc.2002-08-18T00:04:30-07:00.to.2002-08-20T00:00:00-07:00.vol1.difftar.gpg",
+                        "duplicity-inc.2002-08-17T16:17:01-07:00.to.2002-08-20T00:00:00-07:00.manifest.gpg",
+                        "duplicity-inc.2002-08-17T16:17:01-07:00.to.2002-08-20T00:00:00-07:00.vol1.difftar.gpg",
+                        "duplicity-full-signatures.2002-08-17T16:17:01-07:00.sigtar.gpg",
+                        "duplicity-new-signatures.2002-08-17T16:17:01-07:00.to.2002-08-18T00:04:30-07:00.sigtar.gpg",
+                        "duplicity-new-signatures.2002-08-18T00:04:30-07:00.to.2002-08-20T00:00:00-07:00.sigtar.gpg",
+                        "duplicity-new-signatures.2002-08-17T16:17:01-07:00.to.2002-08-20T00:00:00-07:00.sigtar.gpg"]
+
 assert not os.system("tar xzf testfiles.tar.gz > /dev/null 2>&1")
 
 col_test_dir = path.Path("testfiles/collectionstest")
@@ -117,6 +132,26 @@ class CollectionTest(unittest.TestCase):
         assert chain.end_time == 1029654270L
         assert chain.fullset.time == 1029626221L
 
+    def test_merged_chains(self):
+        """Test merged set is preferred over old sets, in any order"""
+        cs = collections.CollectionsStatus(dummy_backend, archive_dir)
+        for filename_list in [merged_filename_list,
+                              merged_filename_list[::-1]]:
+            chains, orphaned, incomplete = cs.get_backup_chains(filename_list) #@UnusedVariable
+            assert len(chains) == 1, chains
+            assert len(chains[0].incset_list) == 1, chains[0].incset_list
+            incset = chains[0].incset_list[0]
+            assert incset.start_time == 1029626221L, incset.start_time
+            assert incset.end_time == 1029826800L, incset.end_time
+            assert len(orphaned) == 2, orphaned
+
+            chains, orphaned = cs.get_signature_chains(local = None,
+                                                       filelist = filename_list)
+            assert len(chains) == 1, chains
+            assert len(chains[0].inclist) == 1, chains[0].inclist
+            assert chains[0].end_time == 1029826800L, chains[0].end_time
+            assert len(orphaned) == 2, orphaned
+
     def test_collections_status(self):
         """Test CollectionStatus object's set_values()"""
         def check_cs(cs):
@@ -0,0 +1,181 @@
+# -*- Mode:Python; indent-tabs-mode:nil; tab-width:4 -*-
+#
+# This file is part of duplicity.
+#
+# Duplicity is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 2 of the License, or (at your
+# option) any later version.
+#
+# Duplicity is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with duplicity; if not, write to the Free Software Foundation,
+# Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+
+import helper
+import os, random, unittest, cStringIO
+
+from duplicity.path import * #@UnusedWildImport
+from duplicity import dedup
+
+helper.setup()
+
+class DedupTest(unittest.TestCase):
+    """Test chunking and chunked entries"""
+    def setUp(self):
+        assert not os.system("rm -rf testfiles")
+        os.makedirs("testfiles/output")
+        self.archive = Path("testfiles/output")
+        size = 2000000
+        bits = random.Random(1).getrandbits(8 * size)
+        self.data = ("%0*x" % (2 * size, bits)).decode("hex")
+
+    def tearDown(self):
+        assert not os.system("rm -rf testfiles tempdir temp2.tar")
+
+    def get_chunks(self, data):
+        """Return list of chunks of data"""
+        chunks, pos = [], 0
+        while pos < len(data):
+            cut = dedup.find_cut(data, pos, len(data))
+            chunks.append(data[pos:cut])
+            pos = cut
+        return chunks
+
+    def encode(self, data, chunk_index, index):
+        """Return chunked entry of data"""
+        encoder = dedup.ChunkEncoder(cStringIO.StringIO(data), chunk_index,
+                                     index)
+        result = []
+        while 1:
+            buf = encoder.read(1000)
+            if not buf:
+                break
+            result.append(buf)
+        assert not encoder.close()
+        return "".join(result)
+
+    def decode(self, entry, get_basis = None):
+        """Return contents of chunked entry"""
+        fp = dedup.decode(cStringIO.StringIO(entry), get_basis)
+        data = fp.read()
+        assert not fp.close()
+        return data
+
+    def write_basis(self, name, data):
+        """Return Path of a file holding data, as restored for BasisCache"""
+        fp = open("testfiles/output/%s" % (name,), "wb")
+        fp.write(data)
+        assert not fp.close()
+        return Path("testfiles/output/%s" % (name,))
+
+    def test_find_cut(self):
+        """Test chunks are within bounds and found again when shifted"""
+        chunks = self.get_chunks(self.data)
+        assert len(chunks) > 3, len(chunks)
+        for chunk in chunks[:-1]:
+            assert dedup.chunk_min <= len(chunk) <= dedup.chunk_max, len(chunk)
+        shifted = self.get_chunks("shifted" + self.data)
+        assert shifted[1:] == chunks[1:]
+
+    def test_self_ref(self):
+        """Test repeated data in a file is stored once"""
+        chunk_index = dedup.ChunkIndex(self.archive, 1000, 0)
+        data = self.data + self.data
+        entry = self.encode(data, chunk_index, ("a",))
+        assert len(entry) < len(self.data) * 1.2, len(entry)
+        assert self.decode(entry) == data
+
+    def test_ref(self):
+        """Test chunks stored with another file are read from it"""
+        chunk_index = dedup.ChunkIndex(self.archive, 1000, 0)
+        entry_a = self.encode(self.data, chunk_index, ("dir", "a"))
+        data_b = "header" + self.data
+        entry_b = self.encode(data_b, chunk_index, ("b",))
+        assert len(entry_b) < len(data_b) * 0.2, len(entry_b)
+        self.assertRaises(dedup.DedupError, self.decode, entry_b)
+
+        restored = []
+        def restore(index, num_sets):
+            assert (index, num_sets) == (("dir", "a"), 1), (index, num_sets)
+            restored.append(index)
+            return self.write_basis("a", self.decode(entry_a, get_basis))
+        get_basis = dedup.BasisCache(restore)
+        assert self.decode(entry_b, get_basis) == data_b
+        assert self.decode(entry_b, get_basis) == data_b
+        assert len(restored) == 1, restored
+
+        # chunks decoded earlier in the restore are read directly
+        restored = []
+        get_basis = dedup.BasisCache(restore)
+        assert self.decode(entry_a, get_basis) == self.data
+        assert self.decode(entry_b, get_basis) == data_b
+        assert not restored, restored
+
+    def test_basis_files(self):
+        """Test restored files are kept, and read independently"""
+        restored = []
+        def restore(index, num_sets):
+            restored.append(index)
+            return self.write_basis(index[0], self.data)
+        get_basis = dedup.BasisCache(restore, max_files = 2)
+        fp1 = get_basis(("a",), 1)
+        fp2 = get_basis(("a",), 1)
+        assert fp1.read(1000) == self.data[:1000]
+        assert fp2.read(1000) == self.data[:1000]
+        assert not fp1.close()
+        assert not fp2.close()
+        assert restored == [("a",)], restored
+        get_basis(("b",), 1).close()
+        get_basis(("c",), 1).close()
+        assert not os.path.exists("testfiles/output/a")
+        get_basis(("a",), 1).close()
+        assert len(restored) == 4, restored
+
+    def test_bad_digest(self):
+        """Test chunk not matching its digest is found"""
+        chunk_index = dedup.ChunkIndex(self.archive, 1000, 0)
+        entry = self.encode(self.data, chunk_index, ("a",))
+        pos = len(entry) // 2
+        entry = entry[:pos] + chr(ord(entry[pos]) ^ 1) + entry[pos + 1:]
+        self.assertRaises(dedup.DedupError, self.decode, entry)
+
+    def test_index(self):
+        """Test index is saved, and only used by later sets of the chain"""
+        chunk_index = dedup.ChunkIndex(self.archive, 1000, 0)
+        self.encode(self.data, chunk_index, ("a",))
+        chunk_index.save()
+        self.archive.append("chunkindex.stale").touch()
+
+        chunk_index = dedup.ChunkIndex(self.archive, 1000, 1)
+        entry = self.encode(self.data, chunk_index, ("b",))
+        assert len(entry) < 1000, len(entry)
+        chunk_index.save()
+        assert dedup.ChunkIndex(self.archive, 1000, 0).chunks == {}
+        assert dedup.ChunkIndex(self.archive, 2000, 1).chunks == {}
+        assert self.archive.listdir() == [chunk_index.index_path.get_filename()]
+
+    def test_truncate(self):
+        """Test chunks of replaced sets are forgotten"""
+        chunk_index = dedup.ChunkIndex(self.archive, 1000, 0)
+        self.encode(self.data[:1000000], chunk_index, ("a",))
+        chunk_index.save()
+        chunk_index = dedup.ChunkIndex(self.archive, 1000, 1)
+        self.encode(self.data[1000000:], chunk_index, ("b",))
+        chunk_index.save()
+
+        chunk_index = dedup.ChunkIndex(self.archive, 1000, 2)
+        num_chunks = len(chunk_index.chunks)
+        chunk_index.truncate(1)
+        chunk_index = dedup.ChunkIndex(self.archive, 1000, 1)
+        assert 0 < len(chunk_index.chunks) < num_chunks
+        for value in chunk_index.chunks.values():
+            assert value[1] == 0, value
+
+
+if __name__ == "__main__":
+    unittest.main()
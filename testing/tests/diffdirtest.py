@@ -20,7 +20,7 @@
 # Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
 
 import helper
-import os, sys, unittest
+import os, sys, unittest, cStringIO
 
 from duplicity.path import * #@UnusedWildImport
 from duplicity import diffdir
@@ -255,6 +255,36 @@ class DDTest(unittest.TestCase):
         except StopIteration: pass
         else: assert 0, elem5
 
+    def test_tar_stream(self):
+        """Test writing a plain tar stream of paths"""
+        def get_paths():
+            select = selection.Select(Path("testfiles/dir1"))
+            return list(select.set_iter())
+
+        old_size = diffdir.stream_memory_size
+        diffdir.stream_memory_size = 100 # spool larger files to disk
+        try:
+            block_iter = diffdir.TarStreamBlockIter(iter(get_paths()))
+            blocks = [block.data for block in block_iter]
+            blocks.append(block_iter.get_footer())
+        finally:
+            diffdir.stream_memory_size = old_size
+        buf = "".join(blocks)
+        assert len(buf) % tarfile.RECORDSIZE == 0, len(buf)
+
+        tf = tarfile.TarFile("none", "r", cStringIO.StringIO(buf))
+        paths = get_paths()
+        for ti in tf:
+            path = paths.pop(0)
+            ti2 = path.get_tarinfo()
+            ti2.name = ti2.name.rstrip("/") # stripped from dirs when read
+            assert tarinfo_eq(ti, ti2), (ti.name, ti2.name)
+            if path.isreg():
+                fp = tf.extractfile(ti)
+                assert fp.read() == path.get_data(), path
+                fp.close()
+        assert not paths, paths
+
 
 def compare_tar(tarfile1, tarfile2):
     """Compare two tarfiles"""
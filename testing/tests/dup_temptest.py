@@ -24,6 +24,7 @@ import sys, os, unittest, gzip
 
 from duplicity import dup_temp
 from duplicity import file_naming
+from duplicity import gpg
 
 helper.setup()
 
@@ -84,6 +85,31 @@ class TempTest(unittest.TestCase):
         fin2.close()
         assert not tdp.exists()
 
+    def test_tempduppath_hash(self):
+        """Test hashing data written to tempduppath"""
+        pr = file_naming.ParseResults("full", volume_number = 1,
+                                      time = 1, compressed = 1)
+        tdp = dup_temp.new_tempduppath(pr)
+        tdp.hash_writes("SHA1")
+        assert tdp.get_written_hash() is None
+
+        fout = tdp.open("wb")
+        fout.write("partial")
+        fout.close()
+        # writing again starts over
+        fout = tdp.open("wb")
+        fout.write("hello, ")
+        fout.write("there")
+        fout.close()
+        assert tdp.get_written_hash() == gpg.get_hash("SHA1", tdp)
+
+        # data not written through open is not hashed
+        fout = open(tdp.name, "ab")
+        fout.write("!")
+        fout.close()
+        assert tdp.get_written_hash() is None
+        tdp.delete()
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -20,7 +20,7 @@
 # Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
 
 import helper
-import sys, os, unittest
+import sys, os, glob, time, unittest, subprocess
 
 import duplicity.backend
 from duplicity import path
@@ -50,8 +50,14 @@ class FinalTest:
     """
     Test backup/restore using duplicity binary
     """
-    def run_duplicity(self, arglist, options = [], current_time = None):
-        """Run duplicity binary with given arguments and options"""
+    def run_duplicity(self, arglist, options = [], current_time = None,
+                      timeout = None):
+        """Run duplicity binary with given arguments and options
+
+        If timeout is given, duplicity is killed if it has not exited
+        after that many seconds.
+
+        """
         options.append("--archive-dir testfiles/cache")
         cmd_list = ["duplicity"]
         cmd_list.extend(options + ["--allow-source-mismatch"])
@@ -64,7 +70,18 @@ class FinalTest:
         #print "Running '%s'." % cmdline
         if not os.environ.has_key('PASSPHRASE'):
             os.environ['PASSPHRASE'] = 'foobar'
-        return_val = os.system(cmdline)
+        if timeout is None:
+            return_val = os.system(cmdline)
+        else:
+            process = subprocess.Popen("exec " + cmdline, shell = True)
+            end_time = time.time() + timeout
+            while process.poll() is None and time.time() < end_time:
+                time.sleep(0.1)
+            if process.poll() is None:
+                os.kill(process.pid, 9)
+                process.wait()
+                raise CmdError("duplicity did not exit in %d seconds" % timeout)
+            return_val = process.returncode
         if return_val:
             raise CmdError(return_val)
 
@@ -77,7 +94,7 @@ class FinalTest:
         self.run_duplicity(args, options, current_time)
 
     def restore(self, file_to_restore = None, time = None, options = [],
-                current_time = None):
+                current_time = None, timeout = None):
         options = options[:] # just nip any mutability problems in bud
         assert not os.system("rm -rf testfiles/restore_out")
         args = ["'%s'" % backend_url, "testfiles/restore_out"]
@@ -85,7 +102,7 @@ class FinalTest:
             options.extend(['--file-to-restore', file_to_restore])
         if time:
             options.extend(['--restore-time', str(time)])
-        self.run_duplicity(args, options, current_time)
+        self.run_duplicity(args, options, current_time, timeout)
 
     def verify(self, dirname, file_to_verify = None, time = None, options = [],
                current_time = None):
@@ -178,6 +195,57 @@ class FinalTest:
         self.test_basic_cycle(backup_options = backup_options,
                               restore_options = restore_options)
 
+    def test_restore_file_exits(self):
+        """Test restoring one file from an encrypted backup exits
+
+        Restoring a file from the middle of a volume must not leave
+        gpg waiting to write the rest of it.
+
+        """
+        self.deltmp()
+        self.backup("full", "testfiles/dir1", current_time = 100000)
+        self.backup("inc", "testfiles/dir2", current_time = 200000)
+        self.restore("directory_to_file", 100100, timeout = 300)
+        self.check_same("testfiles/dir1/directory_to_file",
+                        "testfiles/restore_out")
+
+    def test_restore_prefetch(self):
+        """Test restoring with volumes of the chain fetched ahead"""
+        self.runtest(["testfiles/dir1",
+                      "testfiles/dir2",
+                      "testfiles/dir3"],
+                     restore_options = ["--restore-prefetch 3"])
+        self.restore("directory_to_file", 200100,
+                     options = ["--restore-prefetch 3"])
+        self.check_same("testfiles/dir2/directory_to_file",
+                        "testfiles/restore_out")
+
+    def test_merge_interrupted(self):
+        """Test merged set is used if old sets were not all deleted"""
+        self.deltmp()
+        self.backup("full", "testfiles/dir1", current_time = 100000)
+        self.backup("inc", "testfiles/dir2", current_time = 200000)
+        self.backup("inc", "testfiles/dir3", current_time = 300000)
+        assert not os.system("rm -rf testfiles/saved && mkdir testfiles/saved && "
+                             "cp -r testfiles/output testfiles/cache testfiles/saved")
+        self.run_duplicity(["'%s'" % backend_url], options = ["merge-incrementals"])
+        assert len(glob.glob("testfiles/output/duplicity-inc.*.manifest*")) == 1
+
+        # put the old sets back, as if the merge stopped before deleting them
+        assert not os.system("cp -rn testfiles/saved/output/. testfiles/output && "
+                             "cp -rn testfiles/saved/cache/. testfiles/cache")
+        assert len(glob.glob("testfiles/output/duplicity-inc.*.manifest*")) == 3
+        self.restore()
+        self.check_same("testfiles/dir3", "testfiles/restore_out")
+        self.backup("inc", "testfiles/dir2", current_time = 400000)
+        self.restore()
+        self.check_same("testfiles/dir2", "testfiles/restore_out")
+
+        self.run_duplicity(["--force", "'%s'" % backend_url], options = ["cleanup"])
+        assert len(glob.glob("testfiles/output/duplicity-inc.*.manifest*")) == 2
+        self.restore(time = 300000)
+        self.check_same("testfiles/dir3", "testfiles/restore_out")
+
     def test_single_regfile(self):
         """Test backing and restoring up a single regular file"""
         self.runtest(["testfiles/various_file_types/regular_file"])
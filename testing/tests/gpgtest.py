@@ -20,7 +20,7 @@
 # Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
 
 import helper
-import sys, os, unittest, random
+import sys, os, unittest, random, gzip
 
 from duplicity import gpg
 from duplicity import path
@@ -168,6 +168,53 @@ class GPGTest(unittest.TestCase):
         gpg.GzipWriteFile(gwfh, "testfiles/output/gzwrite.gz", size = size)
         #print os.stat("testfiles/output/gzwrite.gz").st_size
 
+    def test_hashed_writes(self):
+        """Test hashes computed by GPGWriteFile and GzipWriteFile"""
+        self.deltmp()
+        profile = gpg.GPGProfile(passphrase = "foobar")
+        hashes = gpg.new_hashes(["SHA1", "SHA256"])
+        gpg.GPGWriteFile(GPGWriteFile_Helper(), "testfiles/output/hashed.gpg",
+                         profile, size = 400 * 1000, hashes = hashes)
+        self.check_hashes(hashes, "testfiles/output/hashed.gpg")
+
+        hashes = gpg.new_hashes(["SHA1", "SHA256"])
+        gpg.GzipWriteFile(GPGWriteFile_Helper(), "testfiles/output/hashed.gz",
+                          size = 400 * 1000, hashes = hashes)
+        self.check_hashes(hashes, "testfiles/output/hashed.gz")
+
+    def check_hashes(self, hashes, filename):
+        """Check hashes hold the hashes of filename"""
+        for hash_name, hash_obj in hashes.items():
+            assert (hash_obj.hexdigest() ==
+                    gpg.get_hash(hash_name, path.Path(filename))), hash_name
+
+    def test_GzipCopyFile(self):
+        """Test GzipCopyFile writes the whole input"""
+        self.deltmp()
+        s = GPGWriteFile_Helper().get_buffer(300 * 1000)
+        fp = open("testfiles/output/gzcopy.in", "wb")
+        fp.write(s)
+        fp.close()
+        fp = open("testfiles/output/gzcopy.in", "rb")
+        gpg.GzipCopyFile(fp, "testfiles/output/gzcopy.gz")
+        fp.close()
+        assert gzip.open("testfiles/output/gzcopy.gz").read() == s
+
+    def test_GPGCopyFile(self):
+        """Test GPGCopyFile writes the whole input"""
+        self.deltmp()
+        s = GPGWriteFile_Helper().get_buffer(300 * 1000)
+        fp = open("testfiles/output/gpgcopy.in", "wb")
+        fp.write(s)
+        fp.close()
+        fp = open("testfiles/output/gpgcopy.in", "rb")
+        gpg.GPGCopyFile(fp, "testfiles/output/gpgcopy.gpg", default_profile)
+        fp.close()
+        decrypted_file = gpg.GPGFile(0, path.Path("testfiles/output/gpgcopy.gpg"),
+                                     default_profile)
+        assert decrypted_file.read() == s
+        decrypted_file.close()
+
 
 class GPGWriteHelper2:
     def __init__(self, data): self.data = data
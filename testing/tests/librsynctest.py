@@ -0,0 +1,208 @@
+# -*- Mode:Python; indent-tabs-mode:nil; tab-width:4 -*-
+#
+# This file is part of duplicity.
+#
+# Duplicity is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 2 of the License, or (at your
+# option) any later version.
+#
+# Duplicity is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with duplicity; if not, write to the Free Software Foundation,
+# Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+
+import helper
+import os, random, struct, threading, unittest, cStringIO
+
+from duplicity import librsync
+
+helper.setup()
+
+def literal(data):
+    """Return delta command adding data"""
+    if len(data) <= 0x40:
+        return chr(len(data)) + data
+    return struct.pack(">BI", 0x43, len(data)) + data
+
+def copy(start, length):
+    """Return delta command copying length bytes of basis from start"""
+    return struct.pack(">BQH", 0x52, start, length)
+
+def make_delta(*commands):
+    """Return delta of commands"""
+    return librsync.delta_magic + "".join(commands) + "\0"
+
+
+class PatchMakerTest(unittest.TestCase):
+    """Test patching from a basis in memory"""
+    def setUp(self):
+        bits = random.Random(1).getrandbits(8 * 200000)
+        self.basis = ("%0*x" % (400000, bits)).decode("hex")
+
+    def patch(self, basis, delta, readsize = -1):
+        """Return result of patching basis with delta string"""
+        patched = librsync.PatchedFile(basis, cStringIO.StringIO(delta))
+        result = []
+        while 1:
+            buf = patched.read(readsize)
+            result.append(buf)
+            if not buf or readsize < 0:
+                break
+        patched.close()
+        return "".join(result)
+
+    def test_commands(self):
+        """Test each kind of command"""
+        delta = make_delta(literal("short"),
+                           copy(10, 20),
+                           literal("x" * 1000),
+                           struct.pack(">BBB", 0x45, 5, 3),
+                           struct.pack(">BB", 0x41, 2) + "ab",
+                           struct.pack(">BQQ", 0x54, 100, 60000))
+        expected = ("short" + self.basis[10:30] + "x" * 1000 +
+                    self.basis[5:8] + "ab" + self.basis[100:60100])
+        assert self.patch(self.basis, delta) == expected
+        assert self.patch(self.basis, delta, 777) == expected
+
+    def test_large(self):
+        """Test copies and literals bigger than a block"""
+        delta = make_delta(struct.pack(">BII", 0x4f, 0, len(self.basis)),
+                           literal(self.basis[:150000]),
+                           struct.pack(">BII", 0x4f, 1, 100000))
+        expected = self.basis + self.basis[:150000] + self.basis[1:100001]
+        assert self.patch(self.basis, delta) == expected
+        assert self.patch(self.basis, delta, 1000) == expected
+
+    def test_errors(self):
+        """Test bad deltas are found"""
+        for delta in ["xxxx\0",
+                      make_delta(copy(len(self.basis) - 10, 20)),
+                      make_delta("\x99"),
+                      librsync.delta_magic + literal("abc")[:-1],
+                      librsync.delta_magic + copy(0, 10)[:3],
+                      librsync.delta_magic[:2]]:
+            self.assertRaises(librsync.librsyncError,
+                              self.patch, self.basis, delta)
+
+    def test_same_as_file(self):
+        """Test patching from a string gives same result as from a file"""
+        new = (self.basis[:5000] + "inserted" + self.basis[5000:300000] +
+               self.basis[100:1000])
+        sig = librsync.SigFile(cStringIO.StringIO(self.basis)).read()
+        delta = librsync.DeltaFile(sig, cStringIO.StringIO(new)).read()
+        assert self.patch(self.basis, delta) == new
+
+        assert not os.system("rm -rf testfiles && mkdir testfiles")
+        fp = open("testfiles/basis", "w+b")
+        fp.write(self.basis)
+        fp.seek(0)
+        assert self.patch(fp, delta) == new
+        assert not os.system("rm -rf testfiles")
+
+
+class ComposedDeltaTest(unittest.TestCase):
+    """Test merging chains of deltas"""
+    def setUp(self):
+        bits = random.Random(2).getrandbits(8 * 200000)
+        self.basis = ("%0*x" % (400000, bits)).decode("hex")
+
+    def compose(self, basis, deltas, readsize = 1000):
+        """Return result of patching basis with composed deltas"""
+        composed = librsync.ComposedDelta(cStringIO.StringIO())
+        for delta in deltas:
+            composed.add(cStringIO.StringIO(delta))
+        patched = librsync.ComposedPatchedFile(basis, composed)
+        result = []
+        while 1:
+            buf = patched.read(readsize)
+            if not buf:
+                break
+            result.append(buf)
+        patched.close()
+        return "".join(result)
+
+    def test_compose(self):
+        """Test composed deltas give the same result as patching in turn"""
+        deltas = [make_delta(copy(100, 50000), literal("new" * 30000),
+                             copy(0, 20)),
+                  make_delta(literal("front"), copy(49990, 60000),
+                             copy(10, 30), copy(140000, 10)),
+                  make_delta(copy(5, 50000), literal("end"),
+                             struct.pack(">BII", 0x4f, 60000, 45))]
+        expected = self.basis
+        for delta in deltas:
+            patched = librsync.PatchedFile(expected, cStringIO.StringIO(delta))
+            expected = patched.read()
+            patched.close()
+        assert len(expected) == 50048, len(expected)
+        assert self.compose(self.basis, deltas) == expected
+        assert self.compose(self.basis, deltas, 65536 * 3) == expected
+        assert self.compose(self.basis, deltas[:1]) == \
+               self.compose(self.basis, deltas[:1], 7)
+
+    def test_copy_past_end(self):
+        """Test copy past the end of an earlier result is found"""
+        deltas = [make_delta(copy(0, 1000)), make_delta(copy(500, 501))]
+        self.assertRaises(librsync.librsyncError,
+                          self.compose, self.basis, deltas)
+
+    def test_chain(self):
+        """Test composing deltas made by librsync"""
+        versions = [self.basis,
+                    self.basis[:1000] + "one" + self.basis[1000:],
+                    self.basis[:300000] + "two" + self.basis[5000:9000],
+                    "three" + self.basis[100:350000]]
+        deltas = []
+        for old, new in zip(versions, versions[1:]):
+            sig = librsync.SigFile(cStringIO.StringIO(old)).read()
+            deltas.append(librsync.DeltaFile(sig, cStringIO.StringIO(new)).read())
+        assert self.compose(self.basis, deltas) == versions[-1]
+
+
+class CycleTest(unittest.TestCase):
+    """Test the makers of _librsync with output buffers and threads"""
+    def setUp(self):
+        bits = random.Random(3).getrandbits(8 * 500000)
+        self.basis = ("%0*x" % (1000000, bits)).decode("hex")
+        self.new = self.basis[:200000] + "changed" + self.basis[300000:]
+
+    def get_delta(self, cyclebuf = True):
+        """Return delta of self.new from self.basis"""
+        sigfile = librsync.SigFile(cStringIO.StringIO(self.basis))
+        if not cyclebuf:
+            sigfile.cyclebuf = None
+        deltafile = librsync.DeltaFile(sigfile, cStringIO.StringIO(self.new))
+        if not cyclebuf:
+            deltafile.cyclebuf = None
+        delta = deltafile.read()
+        deltafile.close()
+        return delta
+
+    def test_cyclebuf(self):
+        """Test output buffers give the same results as strings"""
+        delta = self.get_delta()
+        assert delta == self.get_delta(False)
+        patched = librsync.PatchedFile(self.basis, cStringIO.StringIO(delta))
+        assert patched.read() == self.new
+
+    def test_threads(self):
+        """Test deltas made in several threads at once"""
+        expected = self.get_delta()
+        results = []
+        def run():
+            results.append(self.get_delta())
+        threads = [threading.Thread(target = run) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert results == [expected] * 4
+
+
+if __name__ == "__main__":
+    unittest.main()
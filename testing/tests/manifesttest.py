@@ -98,6 +98,45 @@ class ManifestTest(unittest.TestCase):
         m2 = manifest.Manifest().from_string(s)
         assert m == m2
 
+    def get_linear_volumes(self, m, index_prefix):
+        """Return volumes containing index_prefix, found the slow way"""
+        vol_num_list = [vol_num for vol_num, vi in m.volume_info_dict.items()
+                        if vi.contains(index_prefix)]
+        vol_num_list.sort()
+        return vol_num_list
+
+    def test_containing_volumes(self):
+        """Test get_containing_volumes against checking every volume"""
+        bounds = [("a",), ("b", "1"), ("b", "5"), ("b", "5"), ("b", "9"),
+                  ("c",), ("c", "x", "y"), ("d",), ("e",)]
+        m = manifest.Manifest()
+        for i in range(len(bounds) - 1):
+            vi = manifest.VolumeInfo()
+            vi.set_info(i + 1, bounds[i], None, bounds[i + 1], None)
+            m.add_volume_info(vi)
+
+        for index_prefix in [(), ("0",), ("a",), ("b",), ("b", "5"),
+                             ("b", "5", "q"), ("b", "7"), ("c",),
+                             ("c", "x"), ("c", "z"), ("d",), ("e",), ("f",)]:
+            assert (m.get_containing_volumes(index_prefix) ==
+                    self.get_linear_volumes(m, index_prefix)), index_prefix
+        assert m.get_containing_volumes(("b", "5")) == [2, 3, 4]
+        assert m.get_containing_volumes(("f",)) == []
+
+        m.del_volume_info(3)
+        assert m.get_containing_volumes(("b", "5")) == [2, 4]
+
+    def test_containing_volumes_unordered(self):
+        """Test get_containing_volumes with volumes out of index order"""
+        m = manifest.Manifest()
+        for vol_num, start, end in [(1, ("m",), ("p",)), (2, ("a",), ("c",)),
+                                    (3, ("b",), ("z",))]:
+            vi = manifest.VolumeInfo()
+            vi.set_info(vol_num, start, None, end, None)
+            m.add_volume_info(vi)
+        assert m.get_containing_volumes(("b",)) == [2, 3]
+        assert m.get_containing_volumes(("n",)) == [1, 3]
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,114 @@
+# -*- Mode:Python; indent-tabs-mode:nil; tab-width:4 -*-
+#
+# This file is part of duplicity.
+#
+# Duplicity is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 2 of the License, or (at your
+# option) any later version.
+#
+# Duplicity is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with duplicity; if not, write to the Free Software Foundation,
+# Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+
+import helper
+import os, threading, time, types, unittest
+
+from duplicity import backend
+from duplicity import diffdir
+from duplicity import dup_time
+from duplicity import globals
+from duplicity import path
+from duplicity import selection
+
+helper.setup()
+
+# bin/duplicity is a script, so run it as a module to get write_multivol
+duplicity_main = types.ModuleType("duplicity_main")
+execfile("../bin/duplicity", duplicity_main.__dict__)
+
+
+class CountingBackend(backend.Backend):
+    """Backend keeping only the sizes of the files put, slowly
+
+    Counts how many puts run at the same time.
+
+    """
+    def __init__(self):
+        self.sizes = {}
+        self.running = self.max_running = 0
+        self.lock = threading.Lock()
+
+    def put(self, source_path, remote_filename = None):
+        self.lock.acquire()
+        self.running += 1
+        self.max_running = max(self.max_running, self.running)
+        self.lock.release()
+        time.sleep(0.2)
+        self.sizes[remote_filename] = source_path.getsize()
+        self.lock.acquire()
+        self.running -= 1
+        self.lock.release()
+
+    def _query_file_info(self, filename):
+        return {'size': self.sizes.get(filename, -1)}
+
+
+class SafeCountingBackend(CountingBackend):
+    concurrency_safe = True
+
+
+class WriteMultivolTest(unittest.TestCase):
+    """Test writing volumes with asynchronous uploads"""
+    def setUp(self):
+        assert not os.system("tar xzf testfiles.tar.gz > /dev/null 2>&1")
+        assert not os.system("mkdir testfiles/cache testfiles/multivol")
+        for i in range(4):
+            fp = open("testfiles/multivol/%d" % i, "wb")
+            fp.write(os.urandom(100 * 1024))
+            fp.close()
+        globals.archive_dir = path.Path("testfiles/cache")
+        globals.encryption = False
+        globals.volsize = 128 * 1024
+        globals.async_concurrency = 3
+
+    def tearDown(self):
+        globals.encryption = True
+        globals.volsize = 25 * 1024 * 1024
+        globals.async_concurrency = 0
+        assert not os.system("rm -rf testfiles tempdir temp2.tar")
+
+    def backup(self, backend):
+        """Write a full backup of testfiles/multivol to backend"""
+        dup_time.setcurtime()
+        select = selection.Select(path.Path("testfiles/multivol"))
+        select.set_iter()
+        sig_outfp = duplicity_main.get_sig_fileobj("full-sig")
+        man_outfp = duplicity_main.get_man_fileobj("full")
+        tarblock_iter = diffdir.DirFull_WriteSig(select, sig_outfp)
+        duplicity_main.write_multivol("full", tarblock_iter, man_outfp,
+                                      sig_outfp, backend)
+        sig_outfp.close()
+        man_outfp.close()
+        assert len(backend.sizes) > 3, backend.sizes
+
+    def test_unsafe_backend(self):
+        """Test uploads to a backend not safe for concurrency are serial"""
+        backend = CountingBackend()
+        self.backup(backend)
+        assert backend.max_running == 1, backend.max_running
+
+    def test_safe_backend(self):
+        """Test uploads to a backend safe for concurrency overlap"""
+        backend = SafeCountingBackend()
+        self.backup(backend)
+        assert backend.max_running > 1, backend.max_running
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -22,10 +22,15 @@
 import helper
 import sys, cStringIO, unittest
 
+from duplicity import dedup
 from duplicity import diffdir
+from duplicity import dup_time
+from duplicity import globals
 from duplicity import patchdir
 from duplicity import log #@UnusedImport
 from duplicity import selection
+from duplicity import sigindex
+from duplicity import statcache
 from duplicity import tarfile #@UnusedImport
 from duplicity import librsync #@UnusedImport
 from duplicity.path import * #@UnusedWildImport
@@ -133,6 +138,52 @@ class PatchingTest(unittest.TestCase):
                           open("testfiles/output/bad.tar"))
         assert not Path("testfiles/output/warning-security-error").exists()
 
+    def test_restore_writers(self):
+        """Test restoring with writer threads keeps data and times"""
+        self.deltmp()
+        src = "testfiles/output/src"
+        for i in range(5):
+            os.makedirs("%s/dir%d/sub" % (src, i))
+            for j in range(20):
+                fp = open("%s/dir%d/file%d" % (src, i, j), "wb")
+                fp.write("data %d %d\n" % (i, j) * (j * 1000))
+                fp.close()
+            os.symlink("file0", "%s/dir%d/link" % (src, i))
+            os.chmod("%s/dir%d/file1" % (src, i), 0600)
+            for name in ("dir%d/sub" % i, "dir%d" % i):
+                os.utime("%s/%s" % (src, name), (1000000000, 1000000000))
+        os.utime(src, (1000000000, 1000000000))
+
+        diffdir.write_block_iter(diffdir.DirFull(self.get_sel(Path(src))),
+                                 "testfiles/output/full.tar")
+        restored = Path("testfiles/output/restored")
+        globals.restore_writers = 4
+        try:
+            tf = tarfile.TarFile("arbitrary", "r",
+                                 open("testfiles/output/full.tar", "rb"))
+            assert patchdir.Write_ROPaths(restored,
+                                          patchdir.tarfiles2rop_iter([tf]))
+        finally:
+            globals.restore_writers = 0
+        assert restored.compare_recursive(Path(src), 1)
+
+    def test_restrict_stops(self):
+        """Test restoring one file stops reading once past it"""
+        self.deltmp()
+        diffdir.write_block_iter(diffdir.DirFull(self.get_sel(Path("testfiles/dir1"))),
+                                 "testfiles/output/full.tar")
+        opened = []
+        def fileobj_iter():
+            for i in range(2):
+                fp = open("testfiles/output/full.tar", "rb")
+                opened.append(fp)
+                yield fp
+        tf = patchdir.TarFile_FromFileobjs(fileobj_iter())
+        ropaths = list(patchdir.tarfiles2rop_iter([tf], ("largefile",)))
+        assert len(ropaths) == 1, ropaths
+        assert len(opened) == 1, opened
+        assert opened[0].closed
+
 
 class index:
     """Used below to test the iter collation"""
@@ -299,6 +350,136 @@ class TestInnerFuncs(unittest.TestCase):
         testseq([self.snapshot(), self.delta1(), self.delta2()], ("%s 644" % ids),
                 "3499 34957839485792357 458348573")
 
+    def test_get_patch_basis(self):
+        """Test bases are kept in memory up to basis_memory_size"""
+        basis = patchdir.get_patch_basis(cStringIO.StringIO("basis " * 100))
+        assert basis == "basis " * 100, basis
+        old_size = patchdir.basis_memory_size
+        patchdir.basis_memory_size = 599
+        try:
+            basis = patchdir.get_patch_basis(cStringIO.StringIO("basis " * 100))
+        finally:
+            patchdir.basis_memory_size = old_size
+        assert isinstance(basis, file)
+        assert basis.read() == "basis " * 100
+        assert not basis.close()
+
+    def test_spooled_file(self):
+        """Test spooled file moves to disk past its maximum size"""
+        fp = patchdir.SpooledFile(10)
+        fp.write("12345")
+        assert not fp.spilled
+        fp.write("67890abc")
+        assert fp.spilled and isinstance(fp.fp, file)
+        fp.write("def")
+        fp.seek(3)
+        assert fp.read(5) == "45678"
+        fp.seek(0)
+        assert fp.read() == "1234567890abcdef"
+        assert not fp.close()
+
+    def test_spool_rop_iter(self):
+        """Test patched ropaths get the size of their data"""
+        ropath = ROPath(("snapshot",))
+        ropath.init_from_tarinfo(self.snapshot().get_tarinfo())
+        assert ropath.getsize() == 13, ropath.getsize()
+        ropath.setfileobj(cStringIO.StringIO("patched " * 100))
+        spooled = list(patchdir.spool_rop_iter(iter([ropath])))
+        assert len(spooled) == 1 and spooled[0] is ropath
+        assert ropath.getsize() == 800, ropath.getsize()
+        assert ropath.get_data() == "patched " * 100
+
+
+class MovedTest(unittest.TestCase):
+    """Test backing up moved files as deltas of where they were"""
+    def setUp(self):
+        assert not os.system("tar xzf testfiles.tar.gz > /dev/null 2>&1")
+        assert not os.system("rm -rf testfiles/output testfiles/src")
+        assert not os.system("mkdir -p testfiles/output testfiles/src/dir1")
+        fp = open("testfiles/src/dir1/moved", "wb")
+        for i in range(2000):
+            fp.write("line %d of the moved file\n" % i)
+        fp.close()
+        self.old_min_size = diffdir.rename_min_size
+        diffdir.rename_min_size = 0
+        self.archive = Path("testfiles/output")
+        self.fullsig = ("duplicity-full-signatures.%s.sigtar" %
+                        dup_time.timetostring(1000000000))
+
+    def tearDown(self):
+        diffdir.rename_min_size = self.old_min_size
+        assert not os.system("rm -rf testfiles tempdir temp2.tar")
+
+    def get_sel(self):
+        """Get selection iter over testfiles/src"""
+        return selection.Select(Path("testfiles/src")).set_iter()
+
+    def backup(self):
+        """Make full backup, move file, then make incremental backup"""
+        cache = statcache.StatCache(self.archive)
+        cache.start_write(Path("testfiles/src"))
+        sig_fp = self.archive.append(self.fullsig).open("wb")
+        diffdir.write_block_iter(diffdir.DirFull_WriteSig(self.get_sel(),
+                                                          sig_fp, cache),
+                                 "testfiles/output/full.tar")
+        assert not sig_fp.close()
+        cache.commit(1000000000)
+
+        os.mkdir("testfiles/src/dir2")
+        os.rename("testfiles/src/dir1/moved", "testfiles/src/dir2/moved")
+        index = sigindex.SigIndex(self.archive, self.fullsig)
+        index.update([self.fullsig])
+        cache = statcache.StatCache(self.archive)
+        assert cache.open(1000000000, Path("testfiles/src"))
+        diffdir.write_block_iter(diffdir.DirDelta(self.get_sel(),
+                                                  index.get_path_iter(), cache,
+                                                  diffdir.RenameFinder(cache, index)),
+                                 "testfiles/output/inc.tar")
+
+    def get_tarfiles(self, names):
+        """Return list of TarFiles of names in testfiles/output"""
+        return [tarfile.TarFile("arbitrary", "r",
+                                open("testfiles/output/%s" % name, "rb"))
+                for name in names]
+
+    def test_moved(self):
+        """Test moved file is stored as delta and restored"""
+        self.backup()
+        moved = [ti for ti in self.get_tarfiles(["inc.tar"])[0]
+                 if ti.name.startswith("moved/")]
+        assert len(moved) == 1, moved
+        assert moved[0].name == "moved/dir2/moved", moved[0].name
+        assert moved[0].linkname == "dir1/moved", moved[0].linkname
+        assert moved[0].size < 2000, moved[0].size
+
+        names = ["full.tar", "inc.tar"]
+        def restore_basis(index, set_num):
+            return patchdir.tarfiles2basis(self.get_tarfiles(names[:set_num]),
+                                           index, get_basis)
+        get_basis = dedup.BasisCache(restore_basis)
+        rop_iter = patchdir.tarfiles2rop_iter(self.get_tarfiles(names), (),
+                                              get_basis)
+        restored = Path("testfiles/output/restored")
+        patchdir.Write_ROPaths(restored, rop_iter)
+        assert restored.compare_recursive(Path("testfiles/src"), 1)
+
+    def test_patch(self):
+        """Test patching a tree in place with a moved file"""
+        self.backup()
+        patched = Path("testfiles/output/patched")
+        for name in ["full.tar", "inc.tar"]:
+            patchdir.Patch(patched, open("testfiles/output/%s" % name, "rb"))
+        assert patched.compare_recursive(Path("testfiles/src"), 1)
+        assert not [name for name in patched.append("dir1").listdir()
+                    if name.startswith("duplicity_temp.")]
+
+    def test_no_basis(self):
+        """Test restoring moved file needs a way to get its basis"""
+        self.backup()
+        rop_iter = patchdir.tarfiles2rop_iter(self.get_tarfiles(["full.tar",
+                                                                 "inc.tar"]))
+        self.assertRaises(patchdir.PatchDirException, list, rop_iter)
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -510,5 +510,33 @@ class RestartTestWithoutEncryption(RestartTest):
         # Confirm we can restore it (which in buggy versions, would fail)
         self.restore()
 
+    def test_restart_dedup_incremental(self):
+        """
+        Test that an interrupted incremental backup with --dedup is made
+        again instead of restarted, even if the next run does not use
+        --dedup: the entries of the restarted run would not be encoded
+        like those of the interrupted one
+        """
+        self.make_largefiles()
+        self.backup("full", "testfiles/largefiles", options = ["--dedup"])
+        # reuse chunks of the full backup and of the new files themselves
+        assert not os.system("cp testfiles/largefiles/file1 "
+                             "testfiles/largefiles/file4")
+        assert not os.system("cat testfiles/largefiles/file2 "
+                             "testfiles/largefiles/file2 > "
+                             "testfiles/largefiles/file5")
+        assert not os.system("dd if=/dev/urandom of=testfiles/largefiles/file6 "
+                             "bs=1024 count=3072 > /dev/null 2>&1")
+        try:
+            self.backup("inc", "testfiles/largefiles",
+                        options = ["--dedup", "--vols 1", "--fail 2"])
+            self.fail()
+        except CmdError, e:
+            self.assertEqual(30, e.exit_status)
+        self.backup("inc", "testfiles/largefiles", options = ["--vols 1"])
+        self.assertEqual(1, len(glob.glob("testfiles/output/duplicity-inc*.manifest*")))
+        self.restore()
+        self.check_same("testfiles/largefiles", "testfiles/restore_out")
+
 if __name__ == "__main__":
     unittest.main()
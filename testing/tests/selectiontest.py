@@ -191,6 +191,41 @@ testfiles/select/1/1
         assert sf(self.makeext("2")) == None
         assert sf(self.makeext("3")) == 0
 
+    def testFilelistOrder(self):
+        """Test filelist lookups do not depend on order of lines or paths"""
+        fp = StringIO.StringIO("""
+testfiles/select/3/3/2
+- testfiles/select/1/2
+testfiles/select/1/3""")
+        sf = self.Select.filelist_get_sf(fp, 1, "test")
+        assert sf(self.makeext("3/3/2")) == 1
+        assert sf(self.makeext("1/2/1")) == 0
+        assert sf(self.makeext("1")) == 1
+        assert sf(self.makeext("1/3")) == 1
+        assert sf(self.makeext("1/2")) == 0
+        assert sf(self.makeext("3")) == 1
+        assert sf(self.makeext("1/1")) == None
+        assert sf(self.makeext("3/3/2")) == 1
+        assert sf.below(self.makeext("1")) == 1
+        assert sf.below(self.makeext("1/2")) == 0
+        assert sf.below(self.makeext("1/3")) == None
+
+    def testFilelistLarge(self):
+        """Test filelist longer than the blocks it is read in"""
+        lines = ["testfiles/select/%d/%d" % (i, j)
+                 for i in range(100) for j in range(1000)]
+        for null_separator in [0, 1]:
+            globals.null_separator = null_separator
+            separator = null_separator and "\0" or "\n"
+            fp = StringIO.StringIO(separator.join(lines))
+            sf = self.Select.filelist_get_sf(fp, 0, "test")
+            globals.null_separator = 0
+            for i, j in [(0, 0), (1, 412), (17, 999), (99, 999)]:
+                assert sf(self.makeext("%d/%d" % (i, j))) == 0, (i, j)
+                assert sf(self.makeext("%d/%d/1" % (i, j))) == 0, (i, j)
+            assert sf(self.makeext("17")) == None
+            assert sf(self.makeext("17/1000")) == None
+
     def testGlobRE(self):
         """testGlobRE - test translation of shell pattern to regular exp"""
         assert self.Select.glob_to_re("hello") == "hello"
@@ -441,5 +476,205 @@ testfiles/select**/2
                         ("--exclude", "/")],
                        [(), ("home",)])
 
+
+class CompiledRulesTest(unittest.TestCase):
+    """Test merged selection functions select the same as separate ones"""
+    globs = ["testfiles/select/1", "testfiles/select/1/2",
+             "testfiles/select/3/3/2", "testfiles/select", "**",
+             "**[3-5]", "testfiles/select/*/1", "**/2/1",
+             "ignorecase:TESTFILES/SELECT/2", "testfiles/select/[12]/**/3",
+             "testfiles/select/2/*", "ignorecase:**/3/1"]
+
+    def setUp(self):
+        assert not os.system("tar xzf testfiles.tar.gz > /dev/null 2>&1")
+
+    def tearDown(self):
+        assert not os.system("rm -rf testfiles tempdir temp2.tar")
+
+    def get_all_paths(self, path):
+        """Return path and everything under it"""
+        paths = [path]
+        if path.isdir():
+            filenames = path.listdir()
+            filenames.sort()
+            for filename in filenames:
+                paths.extend(self.get_all_paths(path.append(filename)))
+        return paths
+
+    def testRandomRules(self):
+        """Test random rule lists on every path"""
+        import random
+        rand = random.Random(12345)
+        paths = self.get_all_paths(Path("testfiles/select"))
+        for i in range(200):
+            tuplelist = []
+            for j in range(rand.randint(1, 8)):
+                tuplelist.append((rand.choice(["--include", "--exclude"]),
+                                  rand.choice(self.globs)))
+            tuplelist.append(("--exclude", rand.choice(self.globs)))
+            select = Select(Path("testfiles/select"))
+            select.ParseArgs(tuplelist, [])
+            select.compile_selection_functions()
+            compiled = [select.Select(path) for path in paths]
+            select.compiled_functions = select.selection_functions[:-1]
+            separate = [select.Select(path) for path in paths]
+            assert compiled == separate, tuplelist
+
+    def testManyRules(self):
+        """Test more rules than fit in one regular expression"""
+        tuplelist = [("--exclude", "testfiles/select/*/%d*" % i)
+                     for i in range(4, 250)]
+        tuplelist += [("--include", "testfiles/select/3/**/2"),
+                      ("--exclude", "**")]
+        select = Select(Path("testfiles/select"))
+        select.ParseArgs(tuplelist, [])
+        select.compile_selection_functions()
+        assert len(select.compiled_functions) == 1
+        assert select.Select(Path("testfiles/select/3")) == 2
+        assert select.Select(Path("testfiles/select/3/3/2")) == 1
+        assert select.Select(Path("testfiles/select/2/1")) == 0
+
+
+class ScanWorkersTest(unittest.TestCase):
+    """Test selection with directories scanned in worker threads"""
+    def setUp(self):
+        assert not os.system("tar xzf testfiles.tar.gz > /dev/null 2>&1")
+
+    def tearDown(self):
+        globals.scan_workers = 0
+        assert not os.system("rm -rf testfiles tempdir temp2.tar")
+
+    def get_indicies(self, root, tuplelist, filelists):
+        """Return indicies of paths selected"""
+        select = Select(Path(root))
+        select.ParseArgs(tuplelist, [StringIO.StringIO(f) for f in filelists])
+        select.set_iter()
+        return [path.index for path in select]
+
+    def testSameSelection(self):
+        """Test the same paths are selected in the same order"""
+        for root, tuplelist, filelists in [
+            ("testfiles", [], []),
+            ("testfiles/select", [("--exclude", "**[3-5]"),
+                                  ("--include", "testfiles/select/1"),
+                                  ("--exclude", "**")], []),
+            ("testfiles/select", [("--include-globbing-filelist", "file")],
+             ["- testfiles/select/1/1/1\ntestfiles/select/1/1\n"
+              "- testfiles/select/1\n- **\n"]),
+            ("testfiles/select", [("--include", "testfiles/select/3/3"),
+                                  ("--exclude", "**")], [])]:
+            globals.scan_workers = 0
+            serial = self.get_indicies(root, tuplelist, filelists)
+            globals.scan_workers = 3
+            parallel = self.get_indicies(root, tuplelist, filelists)
+            assert len(serial) > 1, (root, tuplelist)
+            assert serial == parallel, (root, tuplelist)
+
+    def testScannerWindow(self):
+        """Test DirScanner with a small window, skipping directories"""
+        scanner = DirScanner(2, max_ahead = 1)
+        root = Path("testfiles/select")
+        try:
+            for index in [(), ("1",), ("1", "2"), ("3",), ("3", "3")]:
+                dir_path = root.new_index(index)
+                scanned = scanner.get(dir_path)
+                listing = dir_path.listdir()
+                listing.sort()
+                assert scanned.listdir() == listing, index
+                for filename in listing:
+                    new_path = scanned.append(dir_path, filename)
+                    assert new_path.index == index + (filename,)
+                    assert new_path.type
+        finally:
+            scanner.stop()
+
+    def testExcludedNotScanned(self):
+        """Test directories excluded by name are not scanned ahead"""
+        from duplicity import selection
+        scanned = []
+        class RecordingScannedDir(ScannedDir):
+            def __init__(self, path):
+                scanned.append(path.index)
+                ScannedDir.__init__(self, path)
+        selection.ScannedDir = RecordingScannedDir
+        try:
+            globals.scan_workers = 3
+            indicies = self.get_indicies("testfiles/select",
+                                         [("--exclude", "testfiles/select/1"),
+                                          ("--exclude", "**/2/*")], [])
+        finally:
+            selection.ScannedDir = ScannedDir
+        assert ("2",) in indicies and ("2", "1") not in indicies
+        assert ("2",) in scanned
+        for index in scanned:
+            assert index[:1] != ("1",), index
+            assert index[:2] != ("2", "1"), index
+
+class PruneTest(unittest.TestCase):
+    """Test directories which cannot contain anything selected are skipped"""
+    globs = ["testfiles/select/1", "testfiles/select/1/**",
+             "testfiles/select/*/3", "testfiles/select/*/2/*", "**",
+             "**[3-5]", "testfiles/select/3/3/2", "**/2/1",
+             "ignorecase:TESTFILES/SELECT/2/*", "testfiles/select/[12]/**/3"]
+
+    def setUp(self):
+        assert not os.system("tar xzf testfiles.tar.gz > /dev/null 2>&1")
+
+    def tearDown(self):
+        assert not os.system("rm -rf testfiles tempdir temp2.tar")
+
+    def get_indicies(self, tuplelist, plain = None):
+        """Return indicies of paths selected
+
+        If plain is true, a selection function which Select knows
+        nothing about is added, so nothing is skipped.
+
+        """
+        select = Select(Path("testfiles/select"))
+        select.ParseArgs(tuplelist, [])
+        if plain:
+            select.add_selection_func(lambda path: None, 1)
+        select.set_iter()
+        return [path.index for path in select]
+
+    def testRandomRules(self):
+        """Test random rule lists select the same as without skipping"""
+        import random
+        rand = random.Random(54321)
+        for i in range(200):
+            tuplelist = []
+            for j in range(rand.randint(1, 6)):
+                tuplelist.append((rand.choice(["--include", "--exclude"]),
+                                  rand.choice(self.globs)))
+            tuplelist.append(("--exclude", rand.choice(self.globs)))
+            assert (self.get_indicies(tuplelist) ==
+                    self.get_indicies(tuplelist, 1)), tuplelist
+
+    def testNotListed(self):
+        """Test an excluded subtree is not listed although scanned"""
+        tuplelist = [("--exclude", "testfiles/select/1/**"),
+                     ("--include", "testfiles/select/*/3"),
+                     ("--exclude", "**")]
+        select = Select(Path("testfiles/select"))
+        select.ParseArgs(tuplelist, [])
+        assert select.Select(Path("testfiles/select/1")) == 2
+        assert not select.subtree_may_select(Path("testfiles/select/1"))
+        assert select.subtree_may_select(Path("testfiles/select/2"))
+
+        listed = []
+        old_listdir = Path.listdir
+        def listdir(path):
+            listed.append(path.index)
+            return old_listdir(path)
+        Path.listdir = listdir
+        try:
+            indicies = self.get_indicies(tuplelist)
+        finally:
+            Path.listdir = old_listdir
+        assert ("2", "3", "1") in indicies, indicies
+        assert [i for i in indicies if i[:1] == ("1",)] == [], indicies
+        assert ("1",) not in listed, listed
+        assert self.get_indicies(tuplelist, 1) == indicies
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,112 @@
+# -*- Mode:Python; indent-tabs-mode:nil; tab-width:4 -*-
+#
+# This file is part of duplicity.
+#
+# Duplicity is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 2 of the License, or (at your
+# option) any later version.
+#
+# Duplicity is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with duplicity; if not, write to the Free Software Foundation,
+# Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+
+import helper
+import os, unittest
+
+from duplicity.path import * #@UnusedWildImport
+from duplicity import diffdir
+from duplicity import dup_time
+from duplicity import selection
+from duplicity import sigindex
+
+helper.setup()
+
+class SigIndexTest(unittest.TestCase):
+    """Test the signature index against the combined signature tars"""
+    def setUp(self):
+        assert not os.system("tar xzf testfiles.tar.gz > /dev/null 2>&1")
+        assert not os.system("rm -rf testfiles/output")
+        os.mkdir("testfiles/output")
+        self.archive = Path("testfiles/output")
+        t1, t2 = dup_time.timetostring(1000000000), dup_time.timetostring(1000001000)
+        self.fullsig = "duplicity-full-signatures.%s.sigtar" % t1
+        self.newsig = "duplicity-new-signatures.%s.to.%s.sigtar" % (t1, t2)
+
+        select = selection.Select(Path("testfiles/dir1"))
+        select.set_iter()
+        diffdir.write_block_iter(diffdir.SigTarBlockIter(select),
+                                 self.archive.append(self.fullsig))
+
+        select = selection.Select(Path("testfiles/dir2"))
+        select.set_iter()
+        newsig_fp = open(self.archive.append(self.newsig).name, "wb")
+        diffdir.write_block_iter(diffdir.DirDelta_WriteSig(select,
+                                     [open(self.archive.append(self.fullsig).name, "rb")],
+                                     newsig_fp),
+                                 "testfiles/output/delta")
+
+    def tearDown(self):
+        assert not os.system("rm -rf testfiles tempdir temp2.tar")
+
+    def compare(self, index, sigfiles):
+        """Check index yields the same as combining sigfiles"""
+        fps = [open(self.archive.append(f).name, "rb") for f in sigfiles]
+        expected = []
+        for p in diffdir.get_combined_path_iter(fps):
+            if p.difftype != "deleted":
+                if p.isreg():
+                    p.sigdata = p.get_data()
+                expected.append(p)
+        expected = iter(expected)
+        # signature data has to be read while iterating
+        count = 0
+        for p1 in index.get_path_iter():
+            p2 = expected.next()
+            assert p1.index == p2.index, (p1.index, p2.index)
+            assert p1.difftype == p2.difftype, p1.index
+            assert p1 == p2, p1.index
+            if p2.isreg():
+                assert p1.get_data() == p2.sigdata, p1.index
+            count += 1
+        self.assertRaises(StopIteration, expected.next)
+        assert count > 0
+
+    def test_build_and_update(self):
+        """Test building index from full sig, then merging a new sig"""
+        index = sigindex.SigIndex(self.archive, self.fullsig)
+        assert index.get_filenames() == []
+        index.update([self.fullsig])
+        assert index.get_filenames() == [self.fullsig]
+        self.compare(index, [self.fullsig])
+
+        index.update([self.newsig])
+        assert index.get_filenames() == [self.fullsig, self.newsig]
+        self.compare(index, [self.fullsig, self.newsig])
+
+    def test_compact(self):
+        """Test compacting keeps the same contents"""
+        index = sigindex.SigIndex(self.archive, self.fullsig)
+        index.update([self.fullsig, self.newsig])
+        index.compact()
+        self.compare(index, [self.fullsig, self.newsig])
+
+    def test_remove_stale(self):
+        """Test stale index files are removed"""
+        index = sigindex.SigIndex(self.archive, self.fullsig)
+        index.update([self.fullsig])
+        self.archive.append("sigindex.stale.idx").touch()
+        sigindex.remove_stale(self.archive, index)
+        names = [n for n in self.archive.listdir() if n.startswith("sigindex.")]
+        names.sort()
+        assert names == [index.blob_path.get_filename(),
+                         index.idx_path.get_filename()], names
+
+
+if __name__ == "__main__":
+    unittest.main()
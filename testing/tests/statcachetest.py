@@ -0,0 +1,126 @@
+# -*- Mode:Python; indent-tabs-mode:nil; tab-width:4 -*-
+#
+# This file is part of duplicity.
+#
+# Duplicity is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 2 of the License, or (at your
+# option) any later version.
+#
+# Duplicity is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with duplicity; if not, write to the Free Software Foundation,
+# Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+
+import helper
+import os, unittest
+
+from duplicity.path import * #@UnusedWildImport
+from duplicity import diffdir
+from duplicity import selection
+from duplicity import statcache
+from duplicity import statistics
+
+helper.setup()
+
+class StatCacheTest(unittest.TestCase):
+    """Test passing over unchanged files with the stat cache"""
+    def setUp(self):
+        assert not os.system("tar xzf testfiles.tar.gz > /dev/null 2>&1")
+        assert not os.system("rm -rf testfiles/output testfiles/src")
+        assert not os.system("cp -pR testfiles/dir1 testfiles/src")
+        os.mkdir("testfiles/output")
+        self.archive = Path("testfiles/output")
+        self.sig = self.archive.append("full.sigtar")
+
+        cache = statcache.StatCache(self.archive)
+        cache.start_write(Path("testfiles/src"))
+        sig_fp = self.sig.open("wb")
+        diffdir.stats = statistics.StatsDeltaProcess()
+        for delta_path in diffdir.get_delta_iter(self.get_select(), iter([]),
+                                                 sig_fp, cache):
+            if delta_path.isreg():
+                delta_path.get_data()
+        assert not sig_fp.close()
+        cache.commit(1000)
+
+    def tearDown(self):
+        assert not os.system("rm -rf testfiles tempdir temp2.tar")
+
+    def get_select(self):
+        """Return Select of testfiles/src"""
+        select = selection.Select(Path("testfiles/src"))
+        select.set_iter()
+        return select
+
+    def get_deltas(self, sig_iter, cache = None):
+        """Return list of (index, difftype) of the deltas of src"""
+        diffdir.stats = statistics.StatsDeltaProcess()
+        return [(delta_path.index, getattr(delta_path, "difftype", None))
+                for delta_path in diffdir.get_delta_iter(self.get_select(),
+                                                         sig_iter,
+                                                         stat_cache = cache)]
+
+    def get_sig_iter(self):
+        """Return signature path iter of the full backup"""
+        return diffdir.get_combined_path_iter([self.sig.open("rb")])
+
+    def get_cache(self):
+        """Return stat cache opened for reading"""
+        cache = statcache.StatCache(self.archive)
+        assert cache.open(1000, Path("testfiles/src"))
+        return cache
+
+    def test_unchanged(self):
+        """Test signatures are not read if nothing changed"""
+        def sig_iter():
+            assert 0, "signatures read"
+            yield None
+        assert self.get_deltas(self.get_sig_iter()) == []
+        assert self.get_deltas(sig_iter(), self.get_cache()) == []
+
+    def test_wrong_time(self):
+        """Test a cache written by another backup is not used"""
+        cache = statcache.StatCache(self.archive)
+        assert not cache.open(999, Path("testfiles/src"))
+        assert not cache.fp
+
+    def test_changed(self):
+        """Test changed and deleted files are found"""
+        os.unlink("testfiles/src/deleted_file")
+        fp = open("testfiles/src/regular_file", "ab")
+        fp.write("more")
+        fp.close()
+        expected = self.get_deltas(self.get_sig_iter())
+        assert (("deleted_file",), None) in expected, expected
+        assert (("regular_file",), "diff") in expected, expected
+        assert self.get_deltas(self.get_sig_iter(), self.get_cache()) == expected
+
+    def test_same_mtime(self):
+        """Test a file changed without changing its mtime is found"""
+        path = Path("testfiles/src/regular_file")
+        size = path.getsize()
+        fp = open(path.name, "r+b")
+        fp.write("x")
+        fp.close()
+        os.utime(path.name, (path.stat.st_atime, path.stat.st_mtime))
+        assert Path(path.name).getsize() == size
+        assert self.get_deltas(self.get_sig_iter()) == []
+        assert self.get_deltas(self.get_sig_iter(), self.get_cache()) == \
+               [(("regular_file",), "diff")]
+
+    def test_find_inode(self):
+        """Test looking up files by inode number"""
+        path = Path("testfiles/src/regular_file")
+        cache = self.get_cache()
+        assert cache.find_inode(path.stat.st_dev, path.stat.st_ino) == \
+               ("regular_file",)
+        assert cache.find_inode(path.stat.st_dev + 1, path.stat.st_ino) is None
+
+
+if __name__ == "__main__":
+    unittest.main()